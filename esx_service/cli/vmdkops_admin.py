@@ -29,6 +29,7 @@ import cli_table
 import vsan_policy
 import vmdk_utils
 import vsan_info
+import vol_trash
 import log_config
 
 NOT_AVAILABLE = 'N/A'
@@ -489,20 +490,20 @@ def all_ls_headers():
 def generate_ls_rows():
     """ Gather all volume metadata into rows that can be used to format a table """
     rows = []
-    for v in vmdk_utils.get_volumes():
-        path = os.path.join(v['path'], v['filename'])
-        name = vmdk_utils.strip_vmdk_extension(v['filename'])
-        metadata = get_metadata(path)
-        attached_to = get_attached_to(metadata)
-        policy = get_policy(metadata, path)
-        size_info = get_vmdk_size_info(path)
-        created, created_by = get_creation_info(metadata)
-        fstype = get_fstype(metadata)
-        access = get_access(metadata)
-        attach_as = get_attach_as(metadata)
-        rows.append([name, v['datastore'], created_by, created, attached_to,
-                     policy, size_info['capacity'], size_info['used'],
-                     fstype, access, attach_as])
+    for (datastore, url_name, dockvols_path) in vmdk_utils.get_datastores():
+        for file_name, metadata in sorted(kv.list_volumes(dockvols_path).items()):
+            path = os.path.join(dockvols_path, file_name)
+            name = vmdk_utils.strip_vmdk_extension(file_name)
+            attached_to = get_attached_to(metadata)
+            policy = get_policy(metadata, path)
+            size_info = get_vmdk_size_info(path)
+            created, created_by = get_creation_info(metadata)
+            fstype = get_fstype(metadata)
+            access = get_access(metadata)
+            attach_as = get_attach_as(metadata)
+            rows.append([name, datastore, created_by, created, attached_to,
+                         policy, size_info['capacity'], size_info['used'],
+                         fstype, access, attach_as])
     return rows
 
 
@@ -569,13 +570,17 @@ def get_vmdk_size_info(path):
     Get the capacity and used space for a given VMDK given its absolute path.
     Values are returned as strings in human readable form (e.g. 10.00MB)
 
-    Currently this data is retrieved via a call to vmkfstools.
-    The output being parsed looks like the following:
+    The data is retrieved via volume_kv (DiskLib), or if that fails via a call
+    to vmkfstools. The vmkfstools output being parsed looks like the following:
 
     Capacity bytes: 209715200
     Used bytes: 27262976
     Unshared bytes: 27262976
     """
+    size_info = kv.get_vol_info(path)
+    if size_info:
+        return {'capacity': vmdk_utils.human_readable(size_info[kv.VOL_SIZE]),
+                'used': vmdk_utils.human_readable(size_info[kv.VOL_ALLOC])}
     try:
         cmd = "vmkfstools --extendedstatinfo {0}".format(path).split()
         output = subprocess.check_output(cmd)
@@ -583,34 +588,13 @@ def get_vmdk_size_info(path):
         lines = result.split('\n')
         capacity_in_bytes = lines[0].split()[2]
         used_in_bytes = lines[1].split()[2]
-        return {'capacity': human_readable(int(capacity_in_bytes)),
-                'used': human_readable(int(used_in_bytes))}
+        return {'capacity': vmdk_utils.human_readable(int(capacity_in_bytes)),
+                'used': vmdk_utils.human_readable(int(used_in_bytes))}
     except subprocess.CalledProcessError:
         sys.exit("Failed to stat {0}.".format(path) \
             + " VMDK corrupted. Please remove and then retry")
 
 
-KB = 1024
-MB = 1024*KB
-GB = 1024*MB
-TB = 1024*GB
-def human_readable(size_in_bytes):
-    """
-    Take an integer size in bytes and convert it to MB, GB, or TB depending
-    upon size.
-    """
-    if size_in_bytes >= TB:
-        return '{:.2f}TB'.format(size_in_bytes/TB)
-    if size_in_bytes >= GB:
-        return '{:.2f}GB'.format(size_in_bytes/GB)
-    if size_in_bytes >= MB:
-        return '{:.2f}MB'.format(size_in_bytes/MB)
-    if size_in_bytes >= KB:
-        return '{:.2f}KB'.format(size_in_bytes/KB)
-
-    return '{0}B'.format(size_in_bytes)
-
-
 def policy_create(args):
     output = vsan_policy.create(args.name, args.content)
     if output:
@@ -668,6 +652,7 @@ def status(args):
     print("LogConfigFile: {0}".format(log_config.LOG_CONFIG_FILE))
     print("LogFile: {0}".format(log_config.LOG_FILE))
     print("LogLevel: {0}".format(log_config.get_log_level()))
+    print("RemovedVolumesPending: {0}".format(get_trash_count()))
 
 
 def set_vol_opts(args):
@@ -705,6 +690,15 @@ def get_service_status():
         return NOT_RUNNING_STATUS
 
 
+def get_trash_count():
+    """ Return the number of removed volumes waiting for deletion """
+    try:
+        return sum(len(vol_trash.list_trash(path))
+                   for path in vmdk_ops.get_dockvols())
+    except:
+        return NOT_AVAILABLE
+
+
 def get_listening_port(pid):
     """ Return the configured port that the service is listening on """
     try:
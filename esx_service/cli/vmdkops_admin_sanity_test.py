@@ -59,9 +59,9 @@ class TestVmdkopsAdminSanity(unittest.TestCase):
         output = subprocess.check_output(cmd, shell=True, stderr=self.devnull)
         # Remove the last "line" which is just the empty string from the split
         lines = output.split('\n')[:-1]
-        self.assertEqual(len(lines), 7)
+        self.assertEqual(len(lines), 8)
         expected_headers = ['Version', 'Status', 'Pid', 'Port', 'LogConfigFile',
-                           'LogFile', 'LogLevel']
+                           'LogFile', 'LogLevel', 'RemovedVolumesPending']
         headers = map(lambda s: s.split(': ')[0], lines)
         self.assertEqual(expected_headers, headers)
 
@@ -0,0 +1,211 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Runs external tools (vmkfstools, objtool...) with timeouts, optionally
+## through a pool of helper processes.
+##
+## Forking the service, a large multi-threaded process, for every command is
+## expensive on ESX. Helpers are small processes started once (this module
+## run as a script), which fork the commands instead. Requests and replies
+## are JSON lines on helper stdin/stdout. Helpers run only commands whose
+## executable is in the list they were started with, never through a shell.
+##
+
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Return code of commands killed on timeout
+TIMEOUT_RC = -9
+
+# Return code of commands a helper refused to run
+REFUSED_RC = -1
+
+# Return code of commands whose helper failed after getting the request.
+# The command may or may not have run, so it is not run again.
+HELPER_FAILED_RC = -2
+
+# Request and reply keys
+ARGV = 'argv'
+TIMEOUT = 'timeout'
+RC = 'rc'
+OUT = 'out'
+
+# Command output is passed as latin-1 text, which maps bytes 1:1
+OUT_ENCODING = 'latin-1'
+
+
+def run_command(cmd, timeout=None):
+    """
+    Run cmd, a string run by the shell or an argument list executed directly.
+    The command is killed after timeout seconds, if passed.
+    Returns (return code, stdout) on success and (return code, stderr) on error.
+    """
+    p = subprocess.Popen(cmd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         shell=not isinstance(cmd, list))
+    timed_out = threading.Event()
+    timer = None
+    if timeout:
+        def kill():
+            if p.poll() is None:
+                timed_out.set()
+                p.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    o, e = p.communicate()
+    if timer:
+        timer.cancel()
+    # the timer may fire as the command exits on its own: then it was not
+    # killed, and its own return code and output are returned
+    if timed_out.is_set() and p.returncode == -signal.SIGKILL:
+        return (TIMEOUT_RC,
+                "Killed after {0} seconds".format(timeout).encode())
+
+    s = p.returncode
+    if s != 0:
+        return (s, e)
+
+    return (s, o)
+
+
+class CommandRunner(object):
+    """ Pool of helper processes running commands from a fixed list of executables """
+
+    def __init__(self, size, timeouts):
+        """
+        timeouts is {executable path: seconds}, for the executables helpers
+        may run; None means no timeout.
+        """
+        self.size = size
+        self.timeouts = timeouts
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.restarts = 0
+
+    def start(self):
+        """ Start the helpers. Best done early, while the service is small """
+        for _ in range(self.size):
+            # a helper failing to start is restarted on use, see run()
+            self._idle.put(self._spawn())
+
+    def allowed(self, cmd):
+        """ Returns True if cmd is an argument list helpers run """
+        return isinstance(cmd, list) and len(cmd) > 0 and cmd[0] in self.timeouts
+
+    def run(self, cmd):
+        """
+        Run cmd (see allowed()) in a helper, waiting for an idle one.
+        Returns (return code, stdout or stderr) as run_command(), with
+        HELPER_FAILED_RC if the helper failed while running it,
+        or None if no helper got the request, so it can be run otherwise.
+        """
+        if self.size < 1:
+            return None
+        helper = self._idle.get()
+        try:
+            if helper is None or helper.poll() is not None:
+                helper = self._restart(helper)
+                if helper is None:
+                    return None
+            request = {ARGV: cmd, TIMEOUT: self.timeouts[cmd[0]]}
+            try:
+                helper.stdin.write(json.dumps(request) + "\n")
+                helper.stdin.flush()
+            except (IOError, OSError) as ex:
+                # the helper is gone, it can't have read the request
+                logging.warning("Command helper %d failed: %s", helper.pid, ex)
+                helper = self._restart(helper)
+                return None
+            try:
+                reply = json.loads(helper.stdout.readline())
+            except (IOError, OSError, ValueError) as ex:
+                logging.warning("Command helper %d failed running %s: %s",
+                                helper.pid, cmd, ex)
+                helper = self._restart(helper)
+                return (HELPER_FAILED_RC,
+                        "Command helper failed: {0}".format(ex).encode())
+            with self._lock:
+                self.runs += 1
+            return (reply[RC], reply[OUT].encode(OUT_ENCODING))
+        finally:
+            self._idle.put(helper)
+
+    def stats(self):
+        """ Return a dict with helper counters """
+        with self._lock:
+            return {'helpers': self.size,
+                    'idle': self._idle.qsize(),
+                    'runs': self.runs,
+                    'restarts': self.restarts}
+
+    def _spawn(self):
+        argv = [sys.executable, os.path.abspath(__file__)] + list(self.timeouts)
+        try:
+            helper = subprocess.Popen(argv,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      universal_newlines=True)
+        except OSError as ex:
+            logging.warning("Failed to start command helper: %s", ex)
+            return None
+        logging.debug("Started command helper %d", helper.pid)
+        return helper
+
+    def _restart(self, helper):
+        if helper:
+            try:
+                helper.kill()
+                helper.wait()
+            except OSError:
+                pass
+        with self._lock:
+            self.restarts += 1
+        return self._spawn()
+
+
+def helper_main(executables):
+    """ Serve requests from stdin until it is closed """
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            return
+        request = json.loads(line)
+        argv = request[ARGV]
+        if not isinstance(argv, list) or not argv or argv[0] not in executables:
+            rc, out = REFUSED_RC, "Command not allowed: {0}".format(argv).encode()
+        else:
+            try:
+                rc, out = run_command(argv, request.get(TIMEOUT))
+            except OSError as ex:
+                rc, out = REFUSED_RC, str(ex).encode()
+        sys.stdout.write(json.dumps({RC: rc, OUT: out.decode(OUT_ENCODING)}) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    helper_main(sys.argv[1:])
@@ -0,0 +1,111 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for cmd_runner.py
+
+import unittest
+import cmd_runner
+
+ECHO = "/bin/echo"
+SLEEP = "/bin/sleep"
+
+
+class KillOnFlush(object):
+    """ Helper stdin killing the helper once a request is sent to it """
+
+    def __init__(self, helper):
+        self.helper = helper
+        self.stdin = helper.stdin
+
+    def write(self, data):
+        self.stdin.write(data)
+
+    def flush(self):
+        self.stdin.flush()
+        self.helper.kill()
+
+
+class TestRunCommand(unittest.TestCase):
+    """ Test running commands directly """
+
+    def test_argv(self):
+        self.assertEqual(cmd_runner.run_command([ECHO, "a b"]), (0, b"a b\n"))
+
+    def test_shell(self):
+        rc, out = cmd_runner.run_command("echo a >&2; exit 3")
+        self.assertEqual((rc, out), (3, b"a\n"))
+
+    def test_timeout(self):
+        rc, _ = cmd_runner.run_command([SLEEP, "10"], timeout=0.2)
+        self.assertEqual(rc, cmd_runner.TIMEOUT_RC)
+
+
+class TestCommandRunner(unittest.TestCase):
+    """ Test running commands in helper processes """
+
+    def setUp(self):
+        self.runner = cmd_runner.CommandRunner(2, {ECHO: 10, SLEEP: 0.2})
+        self.runner.start()
+
+    def tearDown(self):
+        while not self.runner._idle.empty():
+            helper = self.runner._idle.get()
+            helper.stdin.close()
+            helper.wait()
+
+    def test_run(self):
+        self.assertTrue(self.runner.allowed([ECHO, "x"]))
+        self.assertFalse(self.runner.allowed("echo x"))
+        for i in range(5):
+            self.assertEqual(self.runner.run([ECHO, str(i)]),
+                             (0, "{0}\n".format(i).encode()))
+        self.assertEqual(self.runner.stats()['runs'], 5)
+
+    def test_binary_output(self):
+        rc, out = self.runner.run([ECHO, "-n", u"é"])
+        self.assertEqual((rc, out), (0, u"é".encode('utf-8')))
+
+    def test_timeout(self):
+        rc, _ = self.runner.run([SLEEP, "10"])
+        self.assertEqual(rc, cmd_runner.TIMEOUT_RC)
+
+    def test_dead_helper(self):
+        helper = self.runner._idle.get()
+        helper.kill()
+        helper.wait()
+        self.runner._idle.put(helper)
+        # the dead helper is next in line
+        self.runner._idle.put(self.runner._idle.get())
+        for i in range(2):
+            self.assertEqual(self.runner.run([ECHO, "x"]), (0, b"x\n"))
+        self.assertEqual(self.runner.stats()['restarts'], 1)
+
+    def test_helper_killed_while_running(self):
+        runner = cmd_runner.CommandRunner(1, {SLEEP: 10})
+        runner.start()
+        helper = runner._idle.get()
+        stdin = helper.stdin
+        helper.stdin = KillOnFlush(helper)
+        runner._idle.put(helper)
+        # the command is not run again, as it may have run
+        rc, _ = runner.run([SLEEP, "1"])
+        self.assertEqual(rc, cmd_runner.HELPER_FAILED_RC)
+        self.assertEqual(runner.stats(), {'helpers': 1, 'idle': 1,
+                                          'runs': 0, 'restarts': 1})
+        stdin.close()
+        runner._idle.get().stdin.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Test helpers for vol_pool.py and vol_trash.py: volumes are plain files in a
+# temporary dockvols folder, created, moved and deleted by the functions below.
+# Named *_test.py so the Makefile leaves it out of the VIB.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+
+def create_disk(vmdk_path):
+    open(vmdk_path, 'w').close()
+    return True
+
+
+def move_disk(src, dst):
+    os.rename(src, dst)
+    return True
+
+
+def delete_disk(vmdk_path):
+    os.remove(vmdk_path)
+    return True
+
+
+def fail(*args):
+    """ Stands for any of the above failing """
+    return False
+
+
+class DockvolsTestCase(unittest.TestCase):
+    """ Base for tests needing a dockvols folder, self.dir """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.vmdk_path = os.path.join(self.dir, 'vol1.vmdk')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
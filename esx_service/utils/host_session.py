@@ -0,0 +1,148 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Shared session with local hostd.
+##
+## All modules borrow the ServiceInstance from here (get_si()) instead of
+## opening their own connections. The session is opened on first use; when
+## the keepalive thread is started (vmdk_ops service), it pings hostd
+## periodically so the session does not idle out, and re-connects with
+## backoff if the session is lost, so requests do not pay for the login.
+##
+
+import atexit
+import logging
+import threading
+import time
+
+import pyVim.connect
+from pyVmomi import VmomiSupport
+
+# Seconds between keepalive calls. hostd drops sessions idle for 30 min
+KEEPALIVE_SEC = 300
+
+# Reconnect backoff, doubled on each failed attempt
+RECONNECT_MIN_SEC = 1
+RECONNECT_MAX_SEC = 60
+
+
+def connect_local():
+    """ Open a new session to local hostd, returns ServiceInstance """
+    # Connect to localhost as dcui
+    # User "dcui" is a local Admin that does not lose permissions
+    # when the host is in lockdown mode.
+    si = pyVim.connect.Connect(host='localhost', user='dcui')
+    if not si:
+        raise RuntimeError("Failed to connect to localhost as 'dcui'.")
+
+    # set out ID in context to be used in request - so we'll see it in logs
+    reqCtx = VmomiSupport.GetRequestContext()
+    reqCtx["realUser"] = 'dvolplug'
+    return si
+
+
+class HostSession(object):
+    """ Lazily opened hostd session, kept alive and re-connected as needed """
+
+    def __init__(self, connect, keepalive_sec=KEEPALIVE_SEC):
+        """ connect is a function returning a new ServiceInstance """
+        self._connect = connect
+        self.keepalive_sec = keepalive_sec
+        self._lock = threading.Lock()
+        self._si = None
+        self._thread = None
+        self.connects = 0
+        atexit.register(self.disconnect)
+
+    def get(self):
+        """ Return ServiceInstance, connecting if there is no session yet """
+        with self._lock:
+            if not self._si:
+                self._open()
+            return self._si
+
+    def reconnect(self, stale_si=None):
+        """
+        Replace a session which failed for the caller (e.g. NotAuthenticated).
+        If stale_si was already replaced by another thread, the current
+        session is returned and no new login is done.
+        """
+        with self._lock:
+            if self._si and self._si is not stale_si:
+                return self._si
+            logging.warning("Reconnecting to hostd")
+            self._close()
+            self._open()
+            return self._si
+
+    def disconnect(self):
+        with self._lock:
+            self._close()
+
+    def start_keepalive(self):
+        """ Start thread keeping the session alive """
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._keepalive,
+                                        name="HostSession")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        return {'connected': self._si is not None, 'connects': self.connects}
+
+    def _open(self):
+        self._si = self._connect()
+        self.connects += 1
+        logging.debug("Connected to hostd (connects=%d)", self.connects)
+
+    def _close(self):
+        if self._si:
+            try:
+                pyVim.connect.Disconnect(self._si)
+            except Exception:
+                pass  # the session is likely gone already
+            self._si = None
+
+    def _keepalive(self):
+        delay = RECONNECT_MIN_SEC
+        while True:
+            si = self._si
+            try:
+                if si:
+                    si.CurrentTime()
+                else:
+                    self.get()
+                delay = RECONNECT_MIN_SEC
+                time.sleep(self.keepalive_sec)
+            except Exception as ex:
+                logging.warning("hostd session check failed (%s), reconnecting "
+                                "in %d sec", str(ex), delay)
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_SEC)
+                try:
+                    self.reconnect(si)
+                    delay = RECONNECT_MIN_SEC
+                except Exception as ex:
+                    logging.warning("Failed to reconnect to hostd: %s", str(ex))
+
+
+# Session shared by all modules in the process
+session = HostSession(connect_local)
+
+
+def get_si():
+    """ Return ServiceInstance of the shared hostd session """
+    return session.get()
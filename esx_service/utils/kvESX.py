@@ -22,16 +22,18 @@ from ctypes import \
         c_void_p, c_char_p, c_int32, c_bool, c_uint32, c_uint64
 import json
 import logging
+import os
+import re
+import struct
 import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
 
 # Python version 3.5.1
 PYTHON64_VERSION = 50659824
 
-# Conversion constants
-KB = 1024
-MB = (1024 * 1024)
-GB = (MB * 1024)
-
 # Side car create/open options
 KV_SIDECAR_CREATE = 0
 
@@ -57,9 +59,46 @@ VMDK_OPEN_NOIO = 524289
 # Default kv side car alignment
 KV_ALIGN = 4096
 
+# Side car content is {META: <meta-data dict>, VERSION: n, CHECKSUM: crc}.
+# Side cars written before versioning hold the meta-data dict only.
+META = 'meta'
+VERSION = 'version'
+CHECKSUM = 'crc'
+
+# Suffix of temp files used to replace side cars atomically, followed by
+# ".<pid>.<thread id>" of the writer
+TMP_SUFFIX = '.tmp'
+TMP_FILE_REGEXP = r"^.*\.tmp\.[0-9]+\.[0-9]+$"
+
+# Temp files older than that (seconds) are left from a crashed writer
+STALE_TMP_SEC = 600
+
+# Side car formats. Both are always readable, new side cars (and side cars
+# being updated) are written in the format configured for the host.
+FORMAT_JSON = 'json'      # JSON padded to KV_ALIGN
+FORMAT_BINARY = 'binary'  # header and length-prefixed fields, see encode_binary()
+SIDECAR_FORMATS = [FORMAT_JSON, FORMAT_BINARY]
+sidecar_format = FORMAT_JSON
+
+# Host wide config, e.g. {"sidecar_format": "binary"}
+KV_CONFIG_FILE = "/etc/vmware/vmdkops/kv_config.json"
+SIDECAR_FORMAT_KEY = "sidecar_format"
+
+# Binary format header:
+# magic, format version, meta-data version, crc32 of fields, number of fields
+BIN_MAGIC = b'DVKV'
+BIN_FORMAT_VERSION = 1
+BIN_HEADER = struct.Struct('>4sBIIH')
+# Each field is a key (utf8) and a value (json), each prefixed by its length
+BIN_KEY_LEN = struct.Struct('>H')
+BIN_VALUE_LEN = struct.Struct('>I')
+
 # Flag to track the version of Python on the platform
 is_64bits = False
 
+# Disks opened by disk_open() in the current thread, {volpath: (handle, flags)}
+open_disks = threading.local()
+
 class disk_info(Structure):
    _fields_ = [('size', c_uint64),
                ('allocated', c_uint64),
@@ -154,8 +193,30 @@ def disk_lib_init():
 
     return
 
-def kv_esx_init():
+def init(config_file=KV_CONFIG_FILE):
    disk_lib_init()
+   load_config(config_file)
+
+# Read side car format for the host from config_file, if it exists
+def load_config(config_file=KV_CONFIG_FILE):
+    global sidecar_format
+
+    if not os.path.isfile(config_file):
+       return
+    try:
+       with open(config_file) as fh:
+          conf = json.load(fh)
+    except:
+       logging.exception("Failed to read %s, using defaults", config_file)
+       return
+
+    fmt = conf.get(SIDECAR_FORMAT_KEY, FORMAT_JSON)
+    if fmt not in SIDECAR_FORMATS:
+       logging.warning("Unknown side car format '%s' in %s, supported: %s",
+                       fmt, config_file, SIDECAR_FORMATS)
+       return
+    sidecar_format = fmt
+    logging.debug("Side car format is %s", sidecar_format)
 
 def get_uint(val):
    if is_64bits:
@@ -185,44 +246,75 @@ def vol_open_path(volpath, open_flags=VMDK_OPEN_DEFAULT):
 
     return dhandle
 
-# Create the side car for the volume identified by volpath.
-def create(volpath, kv_dict):
-    obj_handle = get_uint(0)
-    dhandle = vol_open_path(volpath)
-
+# Context manager keeping the disk open for the scope, yields disk handle
+# (check it with disk_is_valid). Disk operations within the scope (side car
+# create/delete, size, DB get/set) use the same handle instead of opening
+# the disk again, e.g.
+#     with disk_open(volpath):
+#        create(volpath, kv_dict)
+#        get_info(volpath)
+def disk_open(volpath, open_flags=VMDK_OPEN_DEFAULT):
+    disks = open_disks.__dict__.setdefault('disks', {})
+    opened = disks.get(volpath)
+    # A handle opened for I/O serves no-I/O requests too, not the other way
+    if opened and (opened[1] == open_flags or opened[1] == VMDK_OPEN_DEFAULT):
+       return _reuse_handle(opened[0])
+    return _open_handle(disks, volpath, open_flags)
+
+@contextmanager
+def _reuse_handle(dhandle):
+    yield dhandle
+
+@contextmanager
+def _open_handle(disks, volpath, open_flags):
+    dhandle = vol_open_path(volpath, open_flags)
     if not disk_is_valid(dhandle):
-       return False
-    if use_sidecar_create:
-       res = lib.DiskLib_SidecarCreate(dhandle, DVOL_KEY.encode(),
-                                       KV_CREATE_SIZE, KV_SIDECAR_CREATE,
-                                       byref(obj_handle))
-    else:
-       res = lib.DiskLib_SidecarOpen(dhandle, DVOL_KEY.encode(),
-                                     KV_SIDECAR_CREATE,
-                                     byref(obj_handle))
-    if res != 0:
-       logging.warning("Side car create for %s failed - %x", volpath, res)
-       lib.DiskLib_Close(dhandle)
-       return False
+       yield dhandle
+       return
 
-    lib.DiskLib_SidecarClose(dhandle, DVOL_KEY.encode(), byref(obj_handle))
-    lib.DiskLib_Close(dhandle)
+    outer = disks.get(volpath)
+    disks[volpath] = (dhandle, open_flags)
+    try:
+       yield dhandle
+    finally:
+       if outer:
+          disks[volpath] = outer
+       else:
+          del disks[volpath]
+       lib.DiskLib_Close(dhandle)
 
-    return save(volpath, kv_dict)
+# Create the side car for the volume identified by volpath.
+def create(volpath, kv_dict):
+    obj_handle = get_uint(0)
+    with disk_open(volpath) as dhandle:
+       if not disk_is_valid(dhandle):
+          return False
+       if use_sidecar_create:
+          res = lib.DiskLib_SidecarCreate(dhandle, DVOL_KEY.encode(),
+                                          KV_CREATE_SIZE, KV_SIDECAR_CREATE,
+                                          byref(obj_handle))
+       else:
+          res = lib.DiskLib_SidecarOpen(dhandle, DVOL_KEY.encode(),
+                                        KV_SIDECAR_CREATE,
+                                        byref(obj_handle))
+       if res != 0:
+          logging.warning("Side car create for %s failed - %x", volpath, res)
+          return False
+
+       lib.DiskLib_SidecarClose(dhandle, DVOL_KEY.encode(), byref(obj_handle))
+
+    return save(volpath, kv_dict, version=1)
 
 # Delete the the side car for the given volume
 def delete(volpath):
-    dhandle = vol_open_path(volpath)
+    with disk_open(volpath) as dhandle:
+       if not disk_is_valid(dhandle):
+          return False
+       res = lib.DiskLib_SidecarDelete(dhandle, DVOL_KEY.encode())
+       if res != 0:
+          logging.warning("Side car delete for %s failed - %x", volpath, res)
+          return False
 
-    if not disk_is_valid(dhandle):
-       return False
-    res = lib.DiskLib_SidecarDelete(dhandle, DVOL_KEY.encode())
-    if res != 0:
-       logging.warning("Side car delete for %s failed - %x", volpath, res)
-       lib.DiskLib_Close(dhandle)
-       return False
-
-    lib.DiskLib_Close(dhandle)
     return True
 
 # Align a given string to the specified block boundary.
@@ -233,66 +325,198 @@ def align_str(kv_str, block):
    return '{:<{width}}\n'.format(kv_str, width=aligned_len)
 
 
-# Load and return dictionary from the sidecar
-def load(volpath):
+# Return the path of the side car file for the volume, as a str
+# (DiskLib returns bytes on Python 3)
+def get_meta_file(volpath):
     meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(),
                                                 DVOL_KEY.encode())
-
+    if meta_file is not None and not isinstance(meta_file, str):
+       meta_file = meta_file.decode()
+    return meta_file
+
+# Checksum of the serialized meta-data
+def meta_checksum(meta_str):
+    return zlib.crc32(meta_str.encode()) & 0xffffffff
+
+# Encode meta-data dictionary and version in the binary format
+def encode_binary(kv_dict, version):
+    fields = []
+    for key in sorted(kv_dict.keys()):
+        key_bytes = key.encode('utf-8')
+        value_bytes = json.dumps(kv_dict[key], sort_keys=True).encode('utf-8')
+        fields.append(BIN_KEY_LEN.pack(len(key_bytes)))
+        fields.append(key_bytes)
+        fields.append(BIN_VALUE_LEN.pack(len(value_bytes)))
+        fields.append(value_bytes)
+    payload = b''.join(fields)
+    header = BIN_HEADER.pack(BIN_MAGIC, BIN_FORMAT_VERSION, version,
+                             zlib.crc32(payload) & 0xffffffff, len(kv_dict))
+    return header + payload
+
+# Decode binary format, returns (dictionary, version). Raises ValueError
+def decode_binary(data):
+    if len(data) < BIN_HEADER.size:
+       raise ValueError("truncated header")
+    magic, fmt_version, version, crc, count = BIN_HEADER.unpack_from(data)
+    if fmt_version != BIN_FORMAT_VERSION:
+       raise ValueError("unsupported format version {0}".format(fmt_version))
+    payload = data[BIN_HEADER.size:]
+    if zlib.crc32(payload) & 0xffffffff != crc:
+       raise ValueError("checksum mismatch")
+
+    kv_dict = {}
+    offset = 0
+    for _ in range(count):
+        key_len, = BIN_KEY_LEN.unpack_from(payload, offset)
+        offset += BIN_KEY_LEN.size
+        key = payload[offset:offset + key_len].decode('utf-8')
+        offset += key_len
+        value_len, = BIN_VALUE_LEN.unpack_from(payload, offset)
+        offset += BIN_VALUE_LEN.size
+        kv_dict[key] = json.loads(payload[offset:offset + value_len].decode('utf-8'))
+        offset += value_len
+    return kv_dict, version
+
+# Read the side car, returns (dictionary, version) or (None, None)
+def read_meta_file(meta_file):
     try:
-       with open(meta_file, "r") as fh:
-          kv_str = fh.read()
+       with open(meta_file, "rb") as fh:
+          data = fh.read()
     except:
         logging.exception("Failed to access %s", meta_file)
-        return None
+        return None, None
+
+    if data.startswith(BIN_MAGIC):
+       try:
+          return decode_binary(data)
+       except (ValueError, struct.error) as ex:
+          logging.error("Failed to decode meta-data in %s: %s", meta_file, ex)
+          return None, None
 
     try:
-       return json.loads(kv_str)
+       content = json.loads(data.decode('utf-8'))
     except ValueError:
-       logging.exception("Failed to decode meta-data for %s", volpath);
-       return None
+       logging.exception("Failed to decode meta-data in %s", meta_file);
+       return None, None
 
+    if not (isinstance(content, dict) and META in content and
+            CHECKSUM in content):
+       # Written before versioning
+       return content, 0
 
-# Save the dictionary to side car.
-def save(volpath, kv_dict):
-    meta_file = lib.DiskLib_SidecarMakeFileName(volpath.encode(),
-                                                DVOL_KEY.encode())
+    meta = content[META]
+    if meta_checksum(json.dumps(meta, sort_keys=True)) != content[CHECKSUM]:
+       logging.error("Checksum mismatch for meta-data in %s", meta_file)
+       return None, None
+    return meta, content.get(VERSION, 0)
+
+# Load and return dictionary from the sidecar
+def load(volpath):
+    meta, _ = read_meta_file(get_meta_file(volpath))
+    return meta
+
+# Write file content (bytes) to a temp file and rename it over path, so the file
+# holds either the old or the new content even if we crash half way.
+# path may be str or bytes.
+def replace_file(path, content):
+    suffix = "{0}.{1}.{2}".format(TMP_SUFFIX, os.getpid(),
+                                  threading.current_thread().ident)
+    if isinstance(path, bytes) and not isinstance(suffix, bytes):
+       suffix = suffix.encode()
+    tmp_path = path + suffix
+    try:
+       with open(tmp_path, "wb") as fh:
+          fh.write(content)
+          fh.flush()
+          os.fsync(fh.fileno())
+       os.rename(tmp_path, path)
+    except:
+       try:
+          os.remove(tmp_path)
+       except OSError:
+          pass
+       raise
+    fsync_dir(os.path.dirname(path))
 
-    kv_str = json.dumps(kv_dict)
+# Flush a rename in dir_path to disk. Best effort, as not all file systems
+# allow fsync on a folder.
+def fsync_dir(dir_path):
+    try:
+       dir_fd = os.open(dir_path or os.curdir, os.O_RDONLY)
+    except OSError:
+       return
+    try:
+       os.fsync(dir_fd)
+    except OSError:
+       pass
+    finally:
+       os.close(dir_fd)
+
+# Remove temp files of replace_file() left in dir_path by crashed writers,
+# i.e. older than max_age seconds. Returns the number of files removed.
+def remove_stale_tmp_files(dir_path, max_age=STALE_TMP_SEC):
+    expr = re.compile(TMP_FILE_REGEXP)
+    removed = 0
+    try:
+       names = os.listdir(dir_path)
+    except OSError:
+       return 0
+    now = time.time()
+    for name in names:
+       if not expr.match(name):
+          continue
+       path = os.path.join(dir_path, name)
+       try:
+          if now - os.stat(path).st_mtime > max_age:
+             os.remove(path)
+             removed += 1
+             logging.info("Removed stale temp file %s", path)
+       except OSError:
+          pass  # removed meanwhile
+    return removed
+
+# Save the dictionary to side car.
+# version is the new meta-data version, by default the side car version + 1
+# Returns the saved version (always > 0), or False on failure
+def save(volpath, kv_dict, version=None):
+    return write_meta_file(get_meta_file(volpath), kv_dict, version)
+
+# Write the dictionary to meta_file in the configured format, see save()
+def write_meta_file(meta_file, kv_dict, version=None):
+    if version is None:
+       _, cur_version = read_meta_file(meta_file)
+       version = (cur_version or 0) + 1
+
+    if sidecar_format == FORMAT_BINARY:
+       content = encode_binary(kv_dict, version)
+    else:
+       meta_str = json.dumps(kv_dict, sort_keys=True)
+       kv_str = json.dumps({META: kv_dict,
+                            VERSION: version,
+                            CHECKSUM: meta_checksum(meta_str)})
+       content = align_str(kv_str, KV_ALIGN).encode('utf-8')
 
     try:
-       with open(meta_file, "w") as fh:
-          fh.write(align_str(kv_str, KV_ALIGN))
+       replace_file(meta_file, content)
     except:
-        logging.exception("Failed to save meta-data for %s", volpath);
+        logging.exception("Failed to save meta-data to %s", meta_file);
         return False
 
-    return True
-
-def convert(size):
-   if size < KB:
-      return size
-   elif size < MB:
-      return '{0}{1}'.format(size / KB, 'KB')
-   elif size < GB:
-      return '{0}{1}'.format(size / MB, 'MB')
-   else:
-      return '{0}{1}'.format(size / GB, 'GB')
+    return version
 
-# Return disk stats for the volume
+# Return disk stats for the volume, sizes in bytes
 def get_info(volpath):
-    dhandle = vol_open_path(volpath, VMDK_OPEN_NOIO)
-
-    if not disk_is_valid(dhandle):
-       logging.warning("Failed to open disk - %x", volpath)
-       return None
+    with disk_open(volpath, VMDK_OPEN_NOIO) as dhandle:
+       if not disk_is_valid(dhandle):
+          logging.warning("Failed to open disk - %s", volpath)
+          return None
 
-    sinfo = disk_info()
-    res = lib.DiskLib_GetSize(dhandle, 0, 1, byref(sinfo))
+       sinfo = disk_info()
+       res = lib.DiskLib_GetSize(dhandle, 0, 1, byref(sinfo))
 
-    lib.DiskLib_Close(dhandle)
     if res != 0:
-       logging.warning("Failed to get size of disk - %x", volpath, res)
+       logging.warning("Failed to get size of disk %s - %x", volpath, res)
        return None
 
-    return {VOL_SIZE: convert(sinfo.size), VOL_ALLOC: convert(sinfo.allocated)}
+    return {VOL_SIZE: sinfo.size, VOL_ALLOC: sinfo.allocated}
 
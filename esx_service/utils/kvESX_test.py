@@ -0,0 +1,86 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for side car encoding in kvESX.py. These do not need DiskLib.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import kvESX
+
+
+class TestSidecarFormats(unittest.TestCase):
+    """ Test reading and writing side car content in both formats """
+
+    meta = {u'status': u'attached',
+            u'attachedVMUuid': None,
+            u'volOpts': {u'size': u'10gb', u'fstype': u'ext4'}}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.meta_file = os.path.join(self.dir, "vol-docker-volume-vsphere.vmfd")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        with open(self.meta_file, "wb") as fh:
+            fh.write(content)
+
+    def test_binary_round_trip(self):
+        self.write(kvESX.encode_binary(self.meta, 3))
+        self.assertEqual(kvESX.read_meta_file(self.meta_file), (self.meta, 3))
+
+    def test_binary_is_compact(self):
+        binary = kvESX.encode_binary(self.meta, 3)
+        self.assertTrue(len(binary) < len(json.dumps(self.meta)) + 32)
+
+    def test_binary_damaged(self):
+        binary = kvESX.encode_binary(self.meta, 3)
+        self.write(binary[:-2])
+        self.assertEqual(kvESX.read_meta_file(self.meta_file), (None, None))
+
+    def test_bytes_path(self):
+        # as returned by DiskLib on Python 3
+        meta_file = self.meta_file.encode()
+        self.assertEqual(kvESX.write_meta_file(meta_file, self.meta, 1), 1)
+        self.assertEqual(kvESX.read_meta_file(self.meta_file), (self.meta, 1))
+        self.assertEqual(os.listdir(self.dir), [os.path.basename(self.meta_file)])
+
+    def test_remove_stale_tmp_files(self):
+        stale = "{0}.tmp.1.2".format(self.meta_file)
+        recent = "{0}.tmp.3.4".format(self.meta_file)
+        for path in [stale, recent, self.meta_file]:
+            open(path, "w").close()
+        os.utime(stale, (0, 0))
+        self.assertEqual(kvESX.remove_stale_tmp_files(self.dir), 1)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         sorted(os.path.basename(p) for p in [recent, self.meta_file]))
+
+    def test_unversioned_json(self):
+        # side cars written before versioning
+        self.write(kvESX.align_str(json.dumps(self.meta), kvESX.KV_ALIGN).encode())
+        self.assertEqual(kvESX.read_meta_file(self.meta_file), (self.meta, 0))
+
+    def test_replace_file(self):
+        kvESX.replace_file(self.meta_file, kvESX.encode_binary(self.meta, 1))
+        kvESX.replace_file(self.meta_file, kvESX.encode_binary(self.meta, 2))
+        self.assertEqual(kvESX.read_meta_file(self.meta_file), (self.meta, 2))
+        self.assertEqual(os.listdir(self.dir), [os.path.basename(self.meta_file)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Side car KV store for volumes in a plain local directory, with the same
+## interface and side car content as kvESX but no DiskLib. Volumes are any
+## files named *.vmdk and side cars are files next to them.
+## Used to run and measure the meta-data code off ESX, see volume_kv.init().
+##
+
+import logging
+import os
+from contextlib import contextmanager
+
+import kvESX
+
+# Side car file suffix, after the volume name
+SIDECAR_SUFFIX = "-{0}.vmfd".format(kvESX.DVOL_KEY)
+
+def init(config_file=kvESX.KV_CONFIG_FILE):
+   # Side car format is shared with kvESX
+   kvESX.load_config(config_file)
+
+# Return the path of the side car file for the volume
+def get_meta_file(volpath):
+    return os.path.splitext(volpath)[0] + SIDECAR_SUFFIX
+
+# Nothing to keep open, the volume path serves as the handle
+@contextmanager
+def disk_open(volpath, open_flags=kvESX.VMDK_OPEN_DEFAULT):
+    yield volpath
+
+# Create the side car for the volume identified by volpath.
+def create(volpath, kv_dict):
+    if not os.path.isfile(volpath):
+       logging.warning("Side car create for %s failed - no such volume", volpath)
+       return False
+    return save(volpath, kv_dict, version=1)
+
+# Delete the the side car for the given volume
+def delete(volpath):
+    try:
+       os.remove(get_meta_file(volpath))
+    except OSError as ex:
+       logging.warning("Side car delete for %s failed - %s", volpath, ex)
+       return False
+    return True
+
+def read_meta_file(meta_file):
+    return kvESX.read_meta_file(meta_file)
+
+# Load and return dictionary from the sidecar
+def load(volpath):
+    meta, _ = read_meta_file(get_meta_file(volpath))
+    return meta
+
+# Save the dictionary to side car, see kvESX.save()
+def save(volpath, kv_dict, version=None):
+    return kvESX.write_meta_file(get_meta_file(volpath), kv_dict, version)
+
+# Return disk stats for the volume from the volume file, sizes in bytes
+def get_info(volpath):
+    try:
+       st = os.stat(volpath)
+    except OSError as ex:
+       logging.warning("Failed to get size of disk %s - %s", volpath, ex)
+       return None
+
+    allocated = getattr(st, 'st_blocks', 0) * 512
+    return {kvESX.VOL_SIZE: st.st_size, kvESX.VOL_ALLOC: allocated}
@@ -0,0 +1,204 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Shared waiter for vSphere task completion.
+##
+## A single background thread owns one PropertyCollector filter over the
+## host's recent tasks (TaskManager.recentTask), watching only 'info.state'
+## and 'info.error'. Callers register the tasks they wait for and block on
+## per-task events, so the number of filters (and the hostd load) does not
+## grow with the number of requests in flight.
+##
+## When the dispatcher is not running (startup, lost session), wait() returns
+## False and the caller is expected to watch the tasks on its own.
+##
+
+import logging
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+# Seconds to block in WaitForUpdatesEx before re-checking the thread state
+WAIT_UPDATES_SEC = 60
+
+# Seconds to wait before re-subscribing after a failure (e.g. lost session)
+RETRY_SEC = 10
+
+# Task properties we watch
+STATE_PROP = 'info.state'
+ERROR_PROP = 'info.error'
+
+FINAL_STATES = (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+
+
+class _TaskFuture(object):
+    """ Completion of a single task, as seen by the dispatcher """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.state = None
+        self.error = None
+        self.lost = False  # dispatcher stopped before the task completed
+
+    def complete(self, state, error):
+        self.state = state
+        self.error = error
+        self.event.set()
+
+    def abandon(self):
+        self.lost = True
+        self.event.set()
+
+
+class TaskWaiter(object):
+    """ Dispatches task completion updates from hostd to waiting threads """
+
+    def __init__(self, get_si):
+        """ get_si is a function returning the current ServiceInstance """
+        self._get_si = get_si
+        self._lock = threading.Lock()
+        self._futures = {}  # task moId -> _TaskFuture
+        self._done = {}     # task moId -> (state, error), for completed tasks
+        self._ready = False  # True when initial task list is loaded
+        self._thread = None
+        self.completed = 0
+        self.fallbacks = 0
+
+    def start(self):
+        """ Start the dispatcher thread. wait() returns False until it is ready """
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._watch, name="TaskWaiter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self, tasks):
+        """
+        Block until all tasks complete.
+        Returns True if all tasks succeeded, raises task error on a failure,
+        returns False if the dispatcher could not track the tasks.
+        """
+        futures = []
+        with self._lock:
+            if not self._ready:
+                self.fallbacks += 1
+                return False
+            for task in tasks:
+                key = task._moId
+                future = self._futures.setdefault(key, _TaskFuture())
+                if key in self._done:
+                    future.complete(*self._done[key])
+                futures.append((key, future))
+
+        try:
+            for _, future in futures:
+                future.event.wait()
+        finally:
+            with self._lock:
+                for key, _ in futures:
+                    self._futures.pop(key, None)
+
+        if any(future.lost for _, future in futures):
+            with self._lock:
+                self.fallbacks += 1
+            return False
+        for _, future in futures:
+            if future.state == vim.TaskInfo.State.error:
+                if not future.error:
+                    # error not delivered with the state, let caller fetch it
+                    return False
+                raise future.error
+        return True
+
+    def stats(self):
+        """ Return a dict with dispatcher state and counters """
+        with self._lock:
+            return {'ready': self._ready,
+                    'waiting': len(self._futures),
+                    'completed': self.completed,
+                    'fallbacks': self.fallbacks}
+
+    def _reset(self):
+        with self._lock:
+            self._ready = False
+            self._done = {}
+            for future in self._futures.values():
+                future.abandon()
+            self._futures = {}
+
+    def _apply(self, update):
+        """ Apply PropertyCollector update set, completing finished tasks """
+        with self._lock:
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    key = obj_set.obj._moId
+                    if obj_set.kind == 'leave':
+                        # Dropped from recentTask, nobody can be waiting for it
+                        self._done.pop(key, None)
+                        continue
+                    changes = dict((c.name, c.val) for c in obj_set.changeSet)
+                    state = changes.get(STATE_PROP)
+                    if state not in FINAL_STATES:
+                        continue
+                    result = (state, changes.get(ERROR_PROP))
+                    self._done[key] = result
+                    self.completed += 1
+                    future = self._futures.get(key)
+                    if future:
+                        future.complete(*result)
+            if not update.truncated:
+                self._ready = True
+
+    def _watch(self):
+        while True:
+            try:
+                self._watch_updates()
+            except Exception as ex:
+                logging.warning("TaskWaiter: stopped receiving task updates (%s), "
+                                "retrying in %d sec", str(ex), RETRY_SEC)
+            self._reset()
+            time.sleep(RETRY_SEC)
+
+    def _watch_updates(self):
+        """ Subscribe to task state changes and apply them until an error """
+        content = self._get_si().content
+        # Private collector, so we do not mix with other users of the default one
+        collector = content.propertyCollector.CreatePropertyCollector()
+        try:
+            traversal = vmodl.query.PropertyCollector.TraversalSpec(
+                name='traverseTasks', path='recentTask', skip=False,
+                type=vim.TaskManager)
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+                obj=content.taskManager, skip=True, selectSet=[traversal])
+            prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+                type=vim.Task, pathSet=[STATE_PROP, ERROR_PROP])
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[obj_spec], propSet=[prop_spec])
+            collector.CreateFilter(filter_spec, True)
+
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=WAIT_UPDATES_SEC)
+            version = ''
+            while True:
+                update = collector.WaitForUpdatesEx(version, options)
+                if update:
+                    self._apply(update)
+                    version = update.version
+        finally:
+            try:
+                collector.Destroy()
+            except Exception:
+                pass
@@ -0,0 +1,180 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Threading helpers for vmdkops service.
+##
+## WorkerPool is a fixed size pool of daemon threads pulling jobs from a
+## bounded queue. When the queue is full, submit() blocks, which pushes back
+## on the producer (e.g. the VMCI accept loop) instead of growing unbounded.
+##
+## LockManager is a table of named locks (e.g. one per volume), so that
+## operations on the same object are serialized while unrelated ones run
+## in parallel.
+##
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Pending jobs allowed per worker before submit() blocks
+QUEUE_DEPTH_PER_WORKER = 4
+
+# Marker telling a worker thread to exit
+_STOP = None
+
+# Lock waits longer than that are logged as warnings
+LOCK_WAIT_WARN_SEC = 5
+
+
+class WorkerPool(object):
+    """ Fixed size pool of threads executing submitted callables """
+
+    def __init__(self, name, size, max_pending=None):
+        if size < 1:
+            raise ValueError("WorkerPool size must be >= 1 (got {0})".format(size))
+        if max_pending is None:
+            max_pending = size * QUEUE_DEPTH_PER_WORKER
+        self.name = name
+        self.size = size
+        self._jobs = queue.Queue(max_pending)
+        self._threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._worker,
+                                 name="{0}-{1}".format(name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        logging.info("Started worker pool '%s' with %d threads", name, size)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) for execution in a worker thread.
+        Blocks if there are too many jobs pending.
+        """
+        self._jobs.put((func, args, kwargs))
+
+    def pending(self):
+        """ Return (approximate) number of jobs waiting for a worker """
+        return self._jobs.qsize()
+
+    def shutdown(self, wait=True):
+        """ Stop the workers after already queued jobs are done """
+        for _ in self._threads:
+            self._jobs.put(_STOP)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get()
+            if job is _STOP:
+                return
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except:
+                # Job failures should never kill the worker thread
+                logging.exception("Worker pool '%s': job %s failed",
+                                  self.name, func.__name__)
+
+
+class LockManager(object):
+    """
+    Table of named reentrant locks.
+    A lock is created when first requested and dropped from the table when
+    no thread holds or waits for it, so the table does not grow with the
+    number of keys ever used.
+    Several locks are always taken in sorted key order to avoid deadlocks.
+    """
+
+    def __init__(self, name, warn_wait_sec=LOCK_WAIT_WARN_SEC):
+        self.name = name
+        self.warn_wait_sec = warn_wait_sec
+        self._table_lock = threading.Lock()
+        self._locks = {}  # key -> [RLock, number of holders and waiters]
+        # Lock wait instrumentation, see stats()
+        self._acquired = 0
+        self._contended = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    @contextmanager
+    def lock(self, *keys):
+        """
+        Context manager holding the locks for all keys.
+        Usage: with manager.lock(key1, key2): ...
+        """
+        taken = []
+        try:
+            for key in sorted(set(keys)):
+                self.acquire(key)
+                taken.append(key)
+            yield
+        finally:
+            for key in reversed(taken):
+                self.release(key)
+
+    def acquire(self, key):
+        """ Acquire lock for key, blocking if needed. Prefer lock() """
+        with self._table_lock:
+            entry = self._locks.setdefault(key, [threading.RLock(), 0])
+            entry[1] += 1
+        lock = entry[0]
+
+        start = time.time()
+        contended = not lock.acquire(False)
+        if contended:
+            logging.debug("Lock '%s' %s: waiting", self.name, key)
+            lock.acquire()
+        wait = time.time() - start
+
+        with self._table_lock:
+            self._acquired += 1
+            if contended:
+                self._contended += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+
+        if wait > self.warn_wait_sec:
+            logging.warning("Lock '%s' %s: waited %.2f sec", self.name, key, wait)
+        elif contended:
+            logging.debug("Lock '%s' %s: acquired after %.3f sec",
+                          self.name, key, wait)
+
+    def release(self, key):
+        """ Release lock for key taken with acquire() """
+        with self._table_lock:
+            entry = self._locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def stats(self):
+        """ Return a dict with lock usage and wait time counters """
+        with self._table_lock:
+            return {'name': self.name,
+                    'locks': len(self._locks),
+                    'acquired': self._acquired,
+                    'contended': self._contended,
+                    'total_wait_sec': self._total_wait,
+                    'max_wait_sec': self._max_wait}
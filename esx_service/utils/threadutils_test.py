@@ -0,0 +1,136 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for threadutils.py
+
+import threading
+import time
+import unittest
+import threadutils
+
+
+class TestWorkerPool(unittest.TestCase):
+    """ Test WorkerPool job execution """
+
+    def test_runs_all_jobs(self):
+        done = []
+        lock = threading.Lock()
+
+        def job(i):
+            with lock:
+                done.append(i)
+
+        pool = threadutils.WorkerPool("test", 4)
+        for i in range(100):
+            pool.submit(job, i)
+        pool.shutdown()
+        self.assertEqual(sorted(done), list(range(100)))
+
+    def test_jobs_run_in_parallel(self):
+        # Two jobs waiting for each other can only finish if they run concurrently
+        events = [threading.Event(), threading.Event()]
+        results = []
+
+        def job(mine, other):
+            events[mine].set()
+            results.append(events[other].wait(5))
+
+        pool = threadutils.WorkerPool("test", 2)
+        pool.submit(job, 0, 1)
+        pool.submit(job, 1, 0)
+        pool.shutdown()
+        self.assertEqual(results, [True, True])
+
+    def test_failed_job_does_not_kill_worker(self):
+        done = []
+
+        def bad_job():
+            raise RuntimeError("expected failure")
+
+        pool = threadutils.WorkerPool("test", 1)
+        pool.submit(bad_job)
+        pool.submit(done.append, 1)
+        pool.shutdown()
+        self.assertEqual(done, [1])
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            threadutils.WorkerPool("test", 0)
+
+
+class TestLockManager(unittest.TestCase):
+    """ Test LockManager locking and instrumentation """
+
+    def test_same_key_is_serialized(self):
+        locks = threadutils.LockManager("test")
+        active = []
+        overlaps = []
+
+        def job():
+            with locks.lock("vol1"):
+                active.append(1)
+                overlaps.append(len(active) > 1)
+                time.sleep(0.01)
+                active.pop()
+
+        pool = threadutils.WorkerPool("test", 4)
+        for _ in range(8):
+            pool.submit(job)
+        pool.shutdown()
+        self.assertEqual(overlaps, [False] * 8)
+        self.assertEqual(locks.stats()['acquired'], 8)
+
+    def test_different_keys_run_in_parallel(self):
+        locks = threadutils.LockManager("test")
+        events = [threading.Event(), threading.Event()]
+        results = []
+
+        def job(key, mine, other):
+            with locks.lock(key):
+                events[mine].set()
+                results.append(events[other].wait(5))
+
+        pool = threadutils.WorkerPool("test", 2)
+        pool.submit(job, "vol1", 0, 1)
+        pool.submit(job, "vol2", 1, 0)
+        pool.shutdown()
+        self.assertEqual(results, [True, True])
+        self.assertEqual(locks.stats()['contended'], 0)
+
+    def test_reentrant_and_cleanup(self):
+        locks = threadutils.LockManager("test")
+        with locks.lock("vol1", "vm1"):
+            with locks.lock("vol1"):
+                self.assertEqual(locks.stats()['locks'], 2)
+        self.assertEqual(locks.stats()['locks'], 0)
+
+    def test_multi_key_order_no_deadlock(self):
+        locks = threadutils.LockManager("test")
+        done = []
+
+        def job(keys):
+            for _ in range(50):
+                with locks.lock(*keys):
+                    pass
+            done.append(keys)
+
+        pool = threadutils.WorkerPool("test", 2)
+        pool.submit(job, ["a", "b"])
+        pool.submit(job, ["b", "a"])
+        pool.shutdown()
+        self.assertEqual(len(done), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## In-process cache of VM managed objects, keyed by VM BIOS UUID.
+##
+## A background thread subscribes (via a private PropertyCollector) to
+## 'config.uuid' of all VMs on the host, so VM create, destroy and reconfigure
+## update the cache as they happen. Lookups never talk to hostd; on a miss the
+## caller falls back to searchIndex.FindByUuid.
+##
+
+import logging
+import threading
+import time
+
+from pyVmomi import vim, vmodl
+
+# Seconds to block in WaitForUpdatesEx before re-checking the thread state
+WAIT_UPDATES_SEC = 60
+
+# Seconds to wait before re-subscribing after a failure (e.g. lost session)
+RETRY_SEC = 10
+
+# VM property the cache is keyed by
+UUID_PROP = 'config.uuid'
+
+
+class VmCache(object):
+    """ Map of VM BIOS UUID to vim.VirtualMachine, kept current by hostd updates """
+
+    def __init__(self, get_si):
+        """ get_si is a function returning the current ServiceInstance """
+        self._get_si = get_si
+        self._lock = threading.Lock()
+        self._vms = {}    # uuid -> vim.VirtualMachine
+        self._uuids = {}  # VM moId -> uuid
+        self._ready = False  # True when initial VM list is loaded
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        """ Start the thread populating the cache. Lookups miss until it is loaded """
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._watch, name="VmCache")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get(self, vm_uuid):
+        """ Return VM managed object for vm_uuid, or None if it is not cached """
+        with self._lock:
+            vm = self._vms.get(vm_uuid.lower()) if self._ready else None
+            if vm:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return vm
+
+    def stats(self):
+        """ Return a dict with cache size and hit/miss counters """
+        with self._lock:
+            return {'ready': self._ready,
+                    'vms': len(self._vms),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+    def _set(self, vm, vm_uuid):
+        self._remove(vm)
+        if vm_uuid:
+            self._vms[vm_uuid.lower()] = vm
+            self._uuids[vm._moId] = vm_uuid.lower()
+
+    def _remove(self, vm):
+        old_uuid = self._uuids.pop(vm._moId, None)
+        if old_uuid and self._vms.get(old_uuid) == vm:
+            del self._vms[old_uuid]
+
+    def _reset(self):
+        with self._lock:
+            self._vms = {}
+            self._uuids = {}
+            self._ready = False
+
+    def _apply(self, update):
+        """ Apply PropertyCollector update set to the cache """
+        with self._lock:
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    vm = obj_set.obj
+                    if obj_set.kind == 'leave':
+                        logging.debug("VmCache: VM %s is gone", vm._moId)
+                        self._remove(vm)
+                        continue
+                    for change in obj_set.changeSet:
+                        if change.name != UUID_PROP:
+                            continue
+                        if change.op == 'assign':
+                            self._set(vm, change.val)
+                        else:
+                            self._remove(vm)
+            if not update.truncated:
+                self._ready = True
+
+    def _watch(self):
+        while True:
+            try:
+                self._watch_updates()
+            except Exception as ex:
+                logging.warning("VmCache: stopped receiving VM updates (%s), "
+                                "retrying in %d sec", str(ex), RETRY_SEC)
+            self._reset()
+            time.sleep(RETRY_SEC)
+
+    def _watch_updates(self):
+        """ Subscribe to VM uuid changes and apply them until an error """
+        content = self._get_si().content
+        # Private collector, so we do not steal updates from wait_for_tasks()
+        collector = content.propertyCollector.CreatePropertyCollector()
+        view = content.viewManager.CreateContainerView(content.rootFolder,
+                                                       [vim.VirtualMachine],
+                                                       True)
+        try:
+            traversal = vmodl.query.PropertyCollector.TraversalSpec(
+                name='traverseView', path='view', skip=False,
+                type=vim.view.ContainerView)
+            obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+                obj=view, skip=True, selectSet=[traversal])
+            prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+                type=vim.VirtualMachine, pathSet=[UUID_PROP])
+            filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+                objectSet=[obj_spec], propSet=[prop_spec])
+            collector.CreateFilter(filter_spec, True)
+
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=WAIT_UPDATES_SEC)
+            version = ''
+            while True:
+                update = collector.WaitForUpdatesEx(version, options)
+                if update:
+                    self._apply(update)
+                    version = update.version
+        finally:
+            try:
+                collector.Destroy()
+                view.Destroy()
+            except Exception:
+                pass
@@ -0,0 +1,150 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Device inventory of a VM, used for disk placement on attach and disk
+## lookup on detach.
+##
+## Accessing vm.config on a pyVmomi managed object fetches the whole
+## VirtualMachineConfigInfo from hostd, every time. VmDevices fetches only the
+## properties we need, with a single RetrieveContents call, and is then
+## updated in memory with the devices each attach adds, so that slot
+## placement does not go back to hostd.
+##
+
+import os
+
+from pyVmomi import vim, vmodl
+
+# VM properties fetched for the inventory
+VM_NAME = 'config.name'
+VM_UUID = 'config.uuid'
+VM_DEVICES = 'config.hardware.device'
+VM_EXTRA_CONFIG = 'config.extraConfig'
+
+# Unit 7 is reserved for the SCSI controller itself
+PVSCSI_MAX_TARGETS = 16
+SCSI_DISK_UNITS = frozenset(range(0, 7)) | frozenset(range(8, PVSCSI_MAX_TARGETS))
+
+
+def retrieve_properties(si, vm, props):
+    """ Return dict {property path: value} for the given VM properties """
+    collector = si.content.propertyCollector
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=vm)],
+        propSet=[vmodl.query.PropertyCollector.PropertySpec(
+            type=vim.VirtualMachine, pathSet=props)])
+    result = collector.RetrieveContents([filter_spec])
+    if not result:
+        return {}
+    return dict((p.name, p.val) for p in result[0].propSet)
+
+
+class VmDevices(object):
+    """
+    VM name, uuid, SCSI controllers and disks, with PCI slots of controllers.
+    Use VmDevices.retrieve() to create.
+    """
+
+    def __init__(self, si, vm, name, uuid, devices):
+        self.si = si
+        self.vm = vm
+        self.name = name
+        self.uuid = uuid
+        self.devices = list(devices)
+        self._extra_config = None  # fetched only if needed, see pci_slot()
+        self._disk_index = None  # built on first use, see find_disk()
+
+    @classmethod
+    def retrieve(cls, si, vm):
+        """ Fetch device inventory for vm with one call to hostd """
+        props = retrieve_properties(si, vm, [VM_NAME, VM_UUID, VM_DEVICES])
+        return cls(si, vm,
+                   props.get(VM_NAME),
+                   props.get(VM_UUID),
+                   props.get(VM_DEVICES, []))
+
+    def controllers(self):
+        """ All SCSI controllers (pvscsi, lsi logic, whatever) """
+        return [d for d in self.devices
+                if isinstance(d, vim.VirtualSCSIController)]
+
+    def pvscsi_controllers(self):
+        return [d for d in self.devices
+                if type(d) == vim.ParaVirtualSCSIController]
+
+    def controller(self, key):
+        """ Return SCSI controller with the given device key, or None """
+        for d in self.controllers():
+            if d.key == key:
+                return d
+        return None
+
+    def controller_by_bus(self, bus_number):
+        """ Return SCSI controller on the given bus, or None """
+        for d in self.controllers():
+            if d.busNumber == bus_number:
+                return d
+        return None
+
+    def disks(self):
+        return [d for d in self.devices if type(d) == vim.VirtualDisk]
+
+    def find_disk(self, backing_disk):
+        """
+        Return VirtualDisk with the given backing, or None.
+        backing_disk is "<parent-directory>/<vmdk-descriptor-name>"
+        """
+        return self._backing_index().get(backing_disk)
+
+    def has_disk_named(self, vmdk_name):
+        """ Return True if a VirtualDisk backing has the descriptor name vmdk_name """
+        return any(os.path.basename(b) == vmdk_name
+                   for b in self._backing_index())
+
+    def _backing_index(self):
+        if self._disk_index is None:
+            # Disks of all backing have a backing object with a filename attribute.
+            # Filename format is as follows:
+            #   "[<datastore name>] <parent-directory>/<vmdk-descriptor-name>"
+            self._disk_index = dict((d.backing.fileName.split(" ")[1], d)
+                                    for d in self.disks())
+        return self._disk_index
+
+    def free_disk_units(self, controller_key):
+        """ Return sorted list of unit numbers not used on the controller """
+        taken = set([d.unitNumber for d in self.disks()
+                     if d.controllerKey == controller_key])
+        return sorted(SCSI_DISK_UNITS - taken)
+
+    def pci_slot(self, controller, key_offset):
+        """
+        Return PCI slot number (as a string) of the given controller, or None.
+        key_offset: controller_key - key_offset is the controller bus number
+        """
+        if controller.slotInfo:
+            return str(controller.slotInfo.pciSlotNumber)
+
+        # Slot number is got from from the VM config
+        if self._extra_config is None:
+            props = retrieve_properties(self.si, self.vm, [VM_EXTRA_CONFIG])
+            self._extra_config = dict((o.key, o.value)
+                                      for o in props.get(VM_EXTRA_CONFIG, []))
+        key = 'scsi{0}.pciSlotNumber'.format(controller.key - key_offset)
+        return self._extra_config.get(key)
+
+    def device_added(self, device):
+        """ Record a device added by a successful reconfigure """
+        self.devices.append(device)
+        self._disk_index = None
@@ -20,15 +20,28 @@ import os.path
 import glob
 import re
 import logging
-import pyVim.connect
+import threading
+import time
 
-# datastores should not change during 'vmdkops_admin' run,
-# so using global to avoid multiple scans of /vmfs/volumes
-datastores = None
+# Datastore list is re-read from hostd when older than that (seconds)
+DATASTORES_TTL_SEC = 60
+
+# A lookup of an unknown datastore re-reads the list, but not more often
+# than that (seconds), so bad names from clients do not hammer hostd
+DATASTORES_MISS_REFRESH_SEC = 5
+
+# dockvols path -> name of the folder it resolves to, see get_real_dir_name()
+real_dir_names = {}
 
 # we assume files smaller that that to be descriptor files
 MAX_DESCR_SIZE = 5000
 
+# Size units, see human_readable()
+KB = 1024
+MB = 1024*KB
+GB = 1024*MB
+TB = 1024*GB
+
 # regexp for finding "snapshot" (aka delta disk) descriptor names
 SNAP_NAME_REGEXP = r"^.*-[0-9]{6}$"        # used for names without .vmdk suffix
 SNAP_VMDK_REGEXP = r"^.*-[0-9]{6}\.vmdk$"  # used for file names
@@ -38,6 +51,82 @@ SPECIAL_FILES_REGEXP = r"\A.*-(delta|ctk|digest|flat)\.vmdk$"
 
 # glob expression to match end of 'delta' (aka snapshots) file names.
 SNAP_SUFFIX_GLOB = "-[0-9][0-9][0-9][0-9][0-9][0-9].vmdk"
+# regexp for the same
+SNAP_SUFFIX_REGEXP = r"-[0-9]{6}\.vmdk$"
+
+
+class DatastoreRegistry(object):
+    """
+    Datastores known to the host, indexed by name and by url-name.
+    The list is loaded from hostd on first use and re-loaded when older
+    than ttl_sec, or when a lookup misses (e.g. a datastore was just added).
+    """
+
+    def __init__(self, ttl_sec=DATASTORES_TTL_SEC,
+                 miss_refresh_sec=DATASTORES_MISS_REFRESH_SEC):
+        self.ttl_sec = ttl_sec
+        self.miss_refresh_sec = miss_refresh_sec
+        self._lock = threading.Lock()
+        self._datastores = None
+        self._by_name = {}
+        self._by_url_name = {}
+        self._loaded_at = 0
+
+    def get_all(self):
+        """ Returns list of (name, url-name, dockvol_path) """
+        with self._lock:
+            if self._datastores is None or \
+               time.time() - self._loaded_at > self.ttl_sec:
+                self._load()
+            return self._datastores
+
+    def find(self, name):
+        """
+        Returns (name, url-name, dockvol_path) for datastore with the given
+        name or url-name, or None if there is no such datastore.
+        """
+        self.get_all()
+        with self._lock:
+            ds = self._lookup(name)
+            if not ds and \
+               time.time() - self._loaded_at > self.miss_refresh_sec:
+                self._load()
+                ds = self._lookup(name)
+            return ds
+
+    def refresh(self):
+        """ Forget the list, it is re-loaded on the next use """
+        with self._lock:
+            self._datastores = None
+
+    def _lookup(self, name):
+        return self._by_name.get(name) or self._by_url_name.get(name)
+
+    def _load(self):
+        # imported here, so that volume meta-data code using this module
+        # does not need pyVmomi, see volume_kv.init()
+        import host_session
+        si = host_session.get_si()
+        #  We are connected to ESX so childEntity[0] is current DC/Host
+        ds_objects = \
+          si.content.rootFolder.childEntity[0].datastoreFolder.childEntity
+        datastores = []
+        for d in ds_objects:
+            info = d.info
+            datastores.append((info.name,
+                               os.path.split(info.url)[1],
+                               os.path.join(info.url, 'dockvols')))
+        self._datastores = datastores
+        # dockvols folders may have been re-created along with datastores
+        real_dir_names.clear()
+        self._by_name = dict((ds[0], ds) for ds in datastores)
+        self._by_url_name = dict((ds[1], ds) for ds in datastores)
+        self._loaded_at = time.time()
+        logging.debug("Loaded %d datastores", len(datastores))
+
+
+# Datastores shared by the service and vmdkops_admin
+datastores = DatastoreRegistry()
 
 
 def get_datastores():
@@ -48,22 +137,16 @@ def get_datastores():
     'url-name' is the last element of datastore URL (e.g. 'vsan:572904f8c031435f-3513e0db551fcc82')
     'dockvol-path; is a full path to 'dockvols' folder on datastore 
     """
+    return datastores.get_all()
 
-    global datastores
-    if datastores != None:
-        return datastores
 
-    si = pyVim.connect.Connect()
-    #  We are connected to ESX so childEntity[0] is current DC/Host
-    ds_objects = \
-      si.content.rootFolder.childEntity[0].datastoreFolder.childEntity
-    datastores = [(d.info.name,
-                   os.path.split(d.info.url)[1],
-                   os.path.join(d.info.url, 'dockvols'))
-                  for d in ds_objects]
-    pyVim.connect.Disconnect(si)
+def get_datastore(name):
+    """
+    Returns (name, url-name, dockvol_path) for datastore <name>, which may be
+    either the datastore name or url-name. Returns None for unknown datastores.
+    """
+    return datastores.find(name)
 
-    return datastores
 
 def get_volumes():
     """ Return dicts of docker volumes, their datastore and their paths """
@@ -150,6 +233,57 @@ def vmdk_is_a_descriptor(path, file_name):
     return True
 
 
+def service_dir(dockvols_path, name):
+    """
+    Return path of the hidden folder name (e.g. ".pool") the service keeps
+    in dockvols_path, creating it if needed, or None if it can't be created.
+    """
+    path = os.path.join(dockvols_path, name)
+    if not os.path.isdir(path):
+        try:
+            os.mkdir(path)
+        except OSError as ex:
+            # a parallel request may have just created it
+            if not os.path.isdir(path):
+                logging.warning("Failed to create %s: %s", path, ex)
+                return None
+    return path
+
+
+def list_vmdk_paths(path):
+    """ Return paths of the VMDKs list_vmdks() finds in path """
+    return [os.path.join(path, f) for f in list_vmdks(path)]
+
+
+def get_real_dir_name(path, refresh=False):
+    """
+    Returns base name of the folder <path> resolves to, following links.
+    E.g. on VSAN, dockvols is a link to a namespace folder named by its UUID.
+    Results are remembered, since resolving the links on VMFS is a chain of
+    syscalls; pass refresh=True to resolve again.
+    """
+    if refresh or path not in real_dir_names:
+        real_dir_names[path] = os.path.basename(os.path.realpath(path))
+    return real_dir_names[path]
+
+
+def human_readable(size_in_bytes):
+    """
+    Take an integer size in bytes and convert it to MB, GB, or TB depending
+    upon size.
+    """
+    if size_in_bytes >= TB:
+        return '{:.2f}TB'.format(float(size_in_bytes)/TB)
+    if size_in_bytes >= GB:
+        return '{:.2f}GB'.format(float(size_in_bytes)/GB)
+    if size_in_bytes >= MB:
+        return '{:.2f}MB'.format(float(size_in_bytes)/MB)
+    if size_in_bytes >= KB:
+        return '{:.2f}KB'.format(float(size_in_bytes)/KB)
+
+    return '{0}B'.format(size_in_bytes)
+
+
 def strip_vmdk_extension(filename):
     """ Remove the .vmdk file extension from a string """
     return filename.replace(".vmdk", "")
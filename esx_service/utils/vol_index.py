@@ -0,0 +1,227 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Per datastore index of docker volumes and their meta-data, so that
+## listing volumes is one file read instead of a side car read per volume.
+##
+## The index lives in dockvols/.vol_index/ (so writing it does not change
+## the dockvols folder). It records the side car signature of each volume
+## and dockvols mtime at the time the index was written.
+##
+## An index is used as is only if dockvols mtime is unchanged and was
+## already older than RACY_SEC when the index was written. Otherwise a change
+## made in the same mtime tick (e.g. by another process, or by a writer that
+## did not update the index) could go unnoticed, and the index is refreshed:
+## side cars are listed and stat-ed, and only those with a changed signature
+## are read again.
+##
+## Writers record their changes after the fact, see VolumeIndex.update().
+## Locks are per dockvols folder and are held only to merge and write the
+## index, never while disks are created or side cars are read.
+##
+
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import threadutils
+
+INDEX_DIR = ".vol_index"
+INDEX_FILE = "index.json"
+LOCK_FILE = "lock"
+INDEX_FORMAT = 2
+
+# Index file keys
+FORMAT = "format"
+MTIME = "mtime"
+VOLUMES = "volumes"
+SIGNATURES = "signatures"
+
+# Seconds a dockvols mtime must be older than the index to be trusted.
+# Covers file systems with coarse (1 sec) mtime.
+RACY_SEC = 2
+
+# Serializes index writes between threads, per dockvols folder (keyed by its
+# real path, as it is reached by datastore name and by URL); a file lock does
+# it between processes
+index_locks = threadutils.LockManager("index")
+
+
+def dir_mtime(path):
+    """ Return mtime of path, or None if it can't be accessed """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def as_list(signature):
+    """ Return signature as stored in the index (JSON has no tuples) """
+    return list(signature) if signature is not None else None
+
+
+class VolumeIndex(object):
+    """ Index of volumes in a dockvols folder: {vmdk file name: meta-data} """
+
+    def __init__(self, dockvols_path):
+        self.path = dockvols_path
+        self.index_dir = os.path.join(dockvols_path, INDEX_DIR)
+        self.index_file = os.path.join(self.index_dir, INDEX_FILE)
+
+    def read(self):
+        """
+        Return {vmdk file name: meta-data}, or None if the index is missing
+        or may be stale, see refresh()
+        """
+        mtime = dir_mtime(self.path)
+        index, written = self._load()
+        if not index or mtime is None or index[MTIME] != mtime:
+            return None
+        if written - mtime <= RACY_SEC:
+            return None
+        return index[VOLUMES]
+
+    @contextmanager
+    def update(self):
+        """
+        Context manager for changing volumes in dockvols.
+        Yields a dict of changes to be filled by the caller as
+        {vmdk file name: (meta-data, side car signature), or None if removed}.
+        Changes are merged into the index on exit, see apply().
+        Usage:
+            with index.update() as changes:
+                <create volume, write side car>
+                changes[name] = (meta, signature)
+        """
+        changes = {}
+        yield changes
+        if changes:
+            self.apply(changes)
+
+    def apply(self, changes):
+        """
+        Merge changes (see update()) into the index, if there is one.
+        The signature should be taken right after the side car write, so
+        that changes merged out of order are noticed by the next refresh().
+        """
+        with self._locked():
+            index, _ = self._load()
+            if not index:
+                # built by the next reader
+                return
+            volumes = index[VOLUMES]
+            signatures = index[SIGNATURES]
+            for name, change in changes.items():
+                if change is None:
+                    volumes.pop(name, None)
+                    signatures.pop(name, None)
+                else:
+                    volumes[name], signatures[name] = change[0], as_list(change[1])
+            # mtime may include changes not in the index yet; it is too recent
+            # to be trusted, so the next reader checks the side cars
+            self._write(volumes, signatures, dir_mtime(self.path))
+
+    def refresh(self, scan, load):
+        """
+        Bring the index up to date and return {vmdk file name: meta-data}.
+        scan() returns {vmdk file name: side car signature} for volumes in
+        dockvols, load(names) returns {vmdk file name: meta-data}. Only
+        volumes with a changed (or unknown) signature are loaded.
+        """
+        # Creating the index folder changes dockvols, so it is done first
+        try:
+            self._make_dir()
+        except OSError:
+            pass  # reported by _locked()
+        # Taken before the scan: a change made while loading leaves the index stale
+        mtime = dir_mtime(self.path)
+        index, _ = self._load()
+        old_volumes = index[VOLUMES] if index else {}
+        old_signatures = index[SIGNATURES] if index else {}
+
+        signatures = dict((name, as_list(sig)) for name, sig in scan().items())
+        volumes = {}
+        to_load = []
+        for name, sig in signatures.items():
+            if sig is not None and name in old_volumes and \
+               old_signatures.get(name) == sig:
+                volumes[name] = old_volumes[name]
+            else:
+                to_load.append(name)
+        if to_load:
+            logging.debug("Loading %d volumes for index of %s",
+                          len(to_load), self.path)
+            volumes.update(load(to_load))
+
+        with self._locked():
+            self._write(volumes, signatures, mtime)
+        return volumes
+
+    def _load(self):
+        """ Return (index content, index file mtime), or (None, None) """
+        try:
+            with open(self.index_file) as fh:
+                written = os.fstat(fh.fileno()).st_mtime
+                index = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None, None
+        if index.get(FORMAT) != INDEX_FORMAT:
+            return None, None
+        return index, written
+
+    def _write(self, volumes, signatures, mtime):
+        if mtime is None:
+            return
+        tmp_file = "{0}.{1}.{2}".format(self.index_file, os.getpid(),
+                                        threading.current_thread().ident)
+        try:
+            with open(tmp_file, "w") as fh:
+                json.dump({FORMAT: INDEX_FORMAT, MTIME: mtime,
+                           VOLUMES: volumes, SIGNATURES: signatures}, fh)
+            os.rename(tmp_file, self.index_file)
+        except (IOError, OSError) as ex:
+            logging.warning("Failed to write volume index %s: %s",
+                            self.index_file, ex)
+
+    def _make_dir(self):
+        if not os.path.isdir(self.index_dir):
+            try:
+                os.makedirs(self.index_dir)
+            except OSError:
+                # dockvols may be missing or read-only, or another process
+                # just created it
+                if not os.path.isdir(self.index_dir):
+                    raise
+
+    @contextmanager
+    def _locked(self):
+        with index_locks.lock(os.path.realpath(self.path)):
+            lock_fh = None
+            try:
+                self._make_dir()
+                lock_fh = open(os.path.join(self.index_dir, LOCK_FILE), "a")
+                fcntl.lockf(lock_fh, fcntl.LOCK_EX)
+            except (IOError, OSError) as ex:
+                # dockvols may be missing or read-only; the index is optional
+                logging.debug("Volume index lock for %s failed: %s", self.path, ex)
+            try:
+                yield
+            finally:
+                if lock_fh:
+                    fcntl.lockf(lock_fh, fcntl.LOCK_UN)
+                    lock_fh.close()
@@ -0,0 +1,115 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for vol_index.py
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import vol_index
+
+
+class TestVolumeIndex(unittest.TestCase):
+    """ Test index maintenance and staleness checks """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = vol_index.VolumeIndex(self.dir)
+        self.volumes = {'vol1.vmdk': {'status': 'detached'}}
+        self.signatures = {'vol1.vmdk': (1, 10, 100.0)}
+        self.loaded = []
+        os.mkdir(os.path.join(self.dir, vol_index.INDEX_DIR))
+        self.set_dir_mtime(time.time() - 100)
+        self.refresh()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def set_dir_mtime(self, mtime):
+        os.utime(self.dir, (mtime, mtime))
+
+    def refresh(self):
+        def load(names):
+            self.loaded.extend(names)
+            return dict((name, self.volumes[name]) for name in names)
+        return self.index.refresh(lambda: dict(self.signatures), load)
+
+    def test_read_after_refresh(self):
+        self.assertEqual(self.index.read(), self.volumes)
+        self.assertEqual(self.loaded, ['vol1.vmdk'])
+
+    def test_update(self):
+        with self.index.update() as changes:
+            self.set_dir_mtime(time.time())
+            changes['vol1.vmdk'] = None
+            changes['vol2.vmdk'] = ({'status': 'attached'}, (2, 10, 100.0))
+        self.volumes = {'vol2.vmdk': {'status': 'attached'}}
+        self.signatures = {'vol2.vmdk': (2, 10, 100.0)}
+        # dockvols changed just now: the index needs a check of side cars
+        self.assertEqual(self.index.read(), None)
+        self.assertEqual(self.refresh(), self.volumes)
+        # which have the signatures recorded on update, so none is loaded
+        self.assertEqual(self.loaded, ['vol1.vmdk'])
+
+    def test_same_mtime_change(self):
+        # another process changes a side car, dockvols mtime is unchanged
+        mtime = os.stat(self.dir).st_mtime
+        self.volumes['vol1.vmdk'] = {'status': 'attached'}
+        self.signatures['vol1.vmdk'] = (3, 10, 100.0)
+        self.set_dir_mtime(mtime)
+        self.assertEqual(self.index.read(), {'vol1.vmdk': {'status': 'detached'}})
+        # a racy index is refreshed, which notices the new signature
+        self.set_dir_mtime(time.time())
+        self.refresh()
+        self.assertEqual(self.index.read(), None)
+        self.assertEqual(self.refresh(), self.volumes)
+
+    def test_stale(self):
+        self.set_dir_mtime(time.time() - 50)
+        self.assertEqual(self.index.read(), None)
+        self.signatures['vol1.vmdk'] = None
+        self.refresh()
+        # a side car without signature is always loaded
+        self.assertEqual(self.loaded, ['vol1.vmdk', 'vol1.vmdk'])
+
+    def test_update_by_link(self):
+        # dockvols is reached by datastore name and by URL
+        link = self.dir + '-link'
+        os.symlink(self.dir, link)
+        self.addCleanup(os.remove, link)
+        indexes = [self.index, vol_index.VolumeIndex(link)]
+
+        def add(i):
+            with indexes[i % 2].update() as changes:
+                changes['vol{0}.vmdk'.format(i)] = ({}, (i, 0, 0.0))
+        threads = [threading.Thread(target=add, args=(i,)) for i in range(2, 22)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        index, _ = self.index._load()
+        self.assertEqual(len(index[vol_index.VOLUMES]), 21)
+
+    def test_update_without_index(self):
+        shutil.rmtree(os.path.join(self.dir, vol_index.INDEX_DIR))
+        with self.index.update() as changes:
+            changes['vol2.vmdk'] = ({}, (2, 10, 100.0))
+        self.assertEqual(self.index.read(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
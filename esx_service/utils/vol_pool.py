@@ -0,0 +1,165 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Warm pools of pre-created volumes, one per dockvols folder.
+##
+## Each pool is a hidden dockvols/.pool folder holding default volumes
+## (default size, thin, default policy) with their side cars. A create of a
+## default volume claims a pooled one by moving it into dockvols, and a
+## background thread refills the pools to the configured depth.
+##
+## Disk create and move are done by functions passed in, so this module
+## does not depend on how disks are created.
+##
+
+import logging
+import os
+import threading
+import uuid
+
+import vmdk_utils
+
+# Pool folder, inside dockvols
+POOL_DIR = ".pool"
+
+# Pooled volume names are POOL_PREFIX + uuid
+POOL_PREFIX = "pool-"
+
+# Seconds between pool checks, in addition to refills after claims
+REFILL_SEC = 60
+
+
+class VolumePools(object):
+    """ Pools of pre-created volumes, keyed by dockvols path """
+
+    def __init__(self, depth, create_disk, move_disk, refill_sec=REFILL_SEC):
+        """
+        depth is the number of volumes to keep in each pool (0 disables pools).
+        create_disk(vmdk_path) creates a default volume with side car,
+        move_disk(src, dst) moves a volume with all its files.
+        Both return True on success.
+        """
+        self.depth = depth
+        self.refill_sec = refill_sec
+        self._create_disk = create_disk
+        self._move_disk = move_disk
+        self._lock = threading.Lock()
+        self._dockvols = set()  # pools to refill
+        self._busy = set()      # pooled vmdk paths being created or claimed
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.claimed = 0
+        self.misses = 0
+        self.created = 0
+
+    def start(self):
+        """ Start the refill thread """
+        if self.depth < 1 or self._thread:
+            return
+        self._thread = threading.Thread(target=self._refill_loop,
+                                        name="VolumePools")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def claim(self, vmdk_path):
+        """
+        Move a pooled volume to vmdk_path.
+        Returns True on success, False if the pool is empty or the move failed.
+        """
+        if self.depth < 1:
+            return False
+        dockvols_path = os.path.dirname(vmdk_path)
+        with self._lock:
+            self._dockvols.add(dockvols_path)
+            pooled = self._take(dockvols_path)
+        self._wakeup.set()
+
+        if not pooled:
+            with self._lock:
+                self.misses += 1
+            return False
+        try:
+            moved = self._move_disk(pooled, vmdk_path)
+        finally:
+            with self._lock:
+                self._busy.discard(pooled)
+        if not moved:
+            logging.warning("Failed to move pooled volume %s to %s",
+                            pooled, vmdk_path)
+            with self._lock:
+                self.misses += 1
+            return False
+        logging.debug("Claimed pooled volume %s for %s", pooled, vmdk_path)
+        with self._lock:
+            self.claimed += 1
+        return True
+
+    def stats(self):
+        """ Return a dict with pool counters """
+        with self._lock:
+            return {'depth': self.depth,
+                    'pools': len(self._dockvols),
+                    'claimed': self.claimed,
+                    'misses': self.misses,
+                    'created': self.created}
+
+    def _pooled(self, dockvols_path):
+        """ Return paths of ready volumes in the pool. Call with _lock held """
+        paths = vmdk_utils.list_vmdk_paths(os.path.join(dockvols_path, POOL_DIR))
+        return [p for p in paths if p not in self._busy]
+
+    def _take(self, dockvols_path):
+        """ Reserve a pooled volume, returns its path or None. Call with _lock held """
+        pooled = self._pooled(dockvols_path)
+        if not pooled:
+            return None
+        self._busy.add(pooled[0])
+        return pooled[0]
+
+    def _refill(self, dockvols_path):
+        pool_path = vmdk_utils.service_dir(dockvols_path, POOL_DIR)
+        if not pool_path:
+            return
+
+        while True:
+            with self._lock:
+                if len(self._pooled(dockvols_path)) >= self.depth:
+                    return
+                vmdk_path = os.path.join(pool_path, "{0}{1}.vmdk".format(
+                    POOL_PREFIX, uuid.uuid4().hex))
+                self._busy.add(vmdk_path)
+            try:
+                created = self._create_disk(vmdk_path)
+            finally:
+                with self._lock:
+                    self._busy.discard(vmdk_path)
+            if not created:
+                logging.warning("Failed to create pooled volume %s", vmdk_path)
+                return
+            with self._lock:
+                self.created += 1
+
+    def _refill_loop(self):
+        while True:
+            self._wakeup.wait(self.refill_sec)
+            self._wakeup.clear()
+            with self._lock:
+                dockvols = list(self._dockvols)
+            for dockvols_path in dockvols:
+                try:
+                    self._refill(dockvols_path)
+                except:
+                    logging.exception("Failed to refill volume pool in %s",
+                                      dockvols_path)
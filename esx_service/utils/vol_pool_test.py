@@ -0,0 +1,61 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for vol_pool.py: claims, refills and failures, see fake_disks_test.py
+
+import os
+import unittest
+import vol_pool
+from fake_disks_test import DockvolsTestCase, create_disk, move_disk, fail
+
+
+class TestVolumePools(DockvolsTestCase):
+    """ Test claiming and refilling pooled volumes """
+
+    def setUp(self):
+        DockvolsTestCase.setUp(self)
+        self.pools = vol_pool.VolumePools(2, create_disk, move_disk)
+
+    def pooled(self):
+        return os.listdir(os.path.join(self.dir, vol_pool.POOL_DIR))
+
+    def test_claim_empty(self):
+        self.assertFalse(self.pools.claim(self.vmdk_path))
+        self.assertEqual(self.pools.stats()['misses'], 1)
+
+    def test_claim(self):
+        self.pools._refill(self.dir)
+        self.assertEqual(len(self.pooled()), 2)
+        self.assertTrue(self.pools.claim(self.vmdk_path))
+        self.assertTrue(os.path.isfile(self.vmdk_path))
+        self.assertEqual(len(self.pooled()), 1)
+        self.pools._refill(self.dir)
+        self.assertEqual(len(self.pooled()), 2)
+        self.assertEqual(self.pools.stats()['created'], 3)
+
+    def test_failed_move(self):
+        self.pools = vol_pool.VolumePools(1, create_disk, fail)
+        self.pools._refill(self.dir)
+        self.assertFalse(self.pools.claim(self.vmdk_path))
+        # the volume stays in the pool
+        self.assertEqual(len(self.pooled()), 1)
+
+    def test_disabled(self):
+        self.pools = vol_pool.VolumePools(0, create_disk, move_disk)
+        self.assertFalse(self.pools.claim(self.vmdk_path))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, vol_pool.POOL_DIR)))
+
+
+if __name__ == '__main__':
+    unittest.main()
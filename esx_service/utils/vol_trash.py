@@ -0,0 +1,145 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+##
+## Deferred volume removal.
+##
+## A removed volume is moved into a hidden dockvols/.trash folder, which is
+## quick, and deleted later by a background thread, one volume at a time
+## with a pause between deletes. Volumes failing to delete stay in the trash
+## and are retried on the next pass, so are volumes left from before a
+## service restart. Trash content is on disk, so other processes (e.g.
+## vmdkops_admin) can report it, see list_trash().
+##
+## Not enabled by default; vmdk_ops starts a VolumeReclaimer with -R.
+##
+
+import logging
+import os
+import threading
+import uuid
+
+import vmdk_utils
+
+# Trash folder, inside dockvols
+TRASH_DIR = ".trash"
+
+# Seconds to pause between deletes, so reclaim does not compete with
+# requests for datastore I/O
+DELETE_INTERVAL_SEC = 1
+
+# Seconds between passes over all trash folders, which retry failed deletes
+RETRY_SEC = 300
+
+
+def list_trash(dockvols_path):
+    """ Return vmdk paths of volumes waiting for deletion in dockvols_path """
+    return vmdk_utils.list_vmdk_paths(os.path.join(dockvols_path, TRASH_DIR))
+
+
+class VolumeReclaimer(object):
+    """ Moves removed volumes to trash folders and deletes them in the background """
+
+    def __init__(self, get_dockvols, move_disk, delete_disk,
+                 interval_sec=DELETE_INTERVAL_SEC, retry_sec=RETRY_SEC):
+        """
+        get_dockvols() returns paths of all dockvols folders,
+        move_disk(src, dst) moves a volume with all its files,
+        delete_disk(vmdk_path) deletes a volume.
+        Both return True on success.
+        """
+        self.interval_sec = interval_sec
+        self.retry_sec = retry_sec
+        self._get_dockvols = get_dockvols
+        self._move_disk = move_disk
+        self._delete_disk = delete_disk
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.trashed = 0
+        self.deleted = 0
+        self.failed = 0
+
+    def start(self):
+        """ Start the reclaim thread, which first deletes leftovers in all trash folders """
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._reclaim_loop,
+                                        name="VolumeReclaimer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def trash(self, vmdk_path):
+        """
+        Move the volume to the trash folder for deletion.
+        Returns True on success, False if the volume could not be moved.
+        """
+        path = vmdk_utils.service_dir(os.path.dirname(vmdk_path), TRASH_DIR)
+        if not path:
+            return False
+
+        # a unique name, as a volume with the same name may be created and
+        # removed again before this one is deleted
+        name = os.path.splitext(os.path.basename(vmdk_path))[0]
+        dst_path = os.path.join(path, "{0}-{1}.vmdk".format(name, uuid.uuid4().hex))
+        if not self._move_disk(vmdk_path, dst_path):
+            return False
+
+        logging.debug("Moved %s to trash as %s", vmdk_path, dst_path)
+        with self._lock:
+            self.trashed += 1
+        self._wakeup.set()
+        return True
+
+    def stats(self):
+        """ Return a dict with reclaim counters """
+        with self._lock:
+            return {'trashed': self.trashed,
+                    'deleted': self.deleted,
+                    'failed': self.failed}
+
+    def stop(self):
+        """ Stop the reclaim thread after the delete in progress """
+        self._stop.set()
+        self._wakeup.set()
+
+    def reclaim(self):
+        """ Delete all volumes in trash folders. Returns the number of failures """
+        failures = 0
+        for dockvols_path in self._get_dockvols():
+            for vmdk_path in list_trash(dockvols_path):
+                if self._stop.is_set():
+                    return failures
+                if self._delete_disk(vmdk_path):
+                    logging.info("Deleted removed volume %s", vmdk_path)
+                    with self._lock:
+                        self.deleted += 1
+                else:
+                    logging.warning("Failed to delete removed volume %s, "
+                                    "will retry", vmdk_path)
+                    failures += 1
+                    with self._lock:
+                        self.failed += 1
+                self._stop.wait(self.interval_sec)
+        return failures
+
+    def _reclaim_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                self.reclaim()
+            except:
+                logging.exception("Volume reclaim failed")
+            self._wakeup.wait(self.retry_sec)
@@ -0,0 +1,62 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for vol_trash.py: trash moves, background deletes and their
+# retries, see fake_disks_test.py
+
+import os
+import unittest
+import vol_trash
+from fake_disks_test import DockvolsTestCase, create_disk, move_disk, delete_disk, fail
+
+
+class TestVolumeReclaimer(DockvolsTestCase):
+    """ Test moving volumes to trash and deleting them """
+
+    def reclaimer(self, move=move_disk, delete=delete_disk):
+        return vol_trash.VolumeReclaimer(lambda: [self.dir], move, delete,
+                                         interval_sec=0)
+
+    def test_trash_reclaim(self):
+        reclaimer = self.reclaimer()
+        create_disk(self.vmdk_path)
+        self.assertTrue(reclaimer.trash(self.vmdk_path))
+        self.assertFalse(os.path.exists(self.vmdk_path))
+        # the name can be reused right away
+        create_disk(self.vmdk_path)
+        self.assertTrue(reclaimer.trash(self.vmdk_path))
+        self.assertEqual(len(vol_trash.list_trash(self.dir)), 2)
+
+        self.assertEqual(reclaimer.reclaim(), 0)
+        self.assertEqual(vol_trash.list_trash(self.dir), [])
+        self.assertEqual(reclaimer.stats(),
+                         {'trashed': 2, 'deleted': 2, 'failed': 0})
+
+    def test_failed_delete(self):
+        reclaimer = self.reclaimer(delete=fail)
+        create_disk(self.vmdk_path)
+        reclaimer.trash(self.vmdk_path)
+        self.assertEqual(reclaimer.reclaim(), 1)
+        # kept for retry
+        self.assertEqual(len(vol_trash.list_trash(self.dir)), 1)
+
+    def test_failed_move(self):
+        reclaimer = self.reclaimer(move=fail)
+        create_disk(self.vmdk_path)
+        self.assertFalse(reclaimer.trash(self.vmdk_path))
+        self.assertTrue(os.path.exists(self.vmdk_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,24 +17,23 @@
 # Simple API to access VSAN policy information.
 # Uses objtool to extract and set policy in VSAN objects
 # 
-# For connecting, use vmdk_ops.connectLocal() and vmdk_ops.si global
+# hostd connection is borrowed from host_session
 #
 
 import logging
 import json
 import os.path
 import vmdk_ops
+import host_session
 
-OBJTOOL = '/usr/lib/vmware/osfs/bin/objtool '
-OBJTOOL_SET_POLICY = OBJTOOL + "setPolicy -u {0} -p '{1}'"
-OBJTOOL_GET_ATTR = OBJTOOL + "getAttr -u {0} --format=json"
+OBJTOOL = '/usr/lib/vmware/osfs/bin/objtool'
+OBJTOOL_SET_POLICY = [OBJTOOL, "setPolicy", "-u"]
+OBJTOOL_GET_ATTR = [OBJTOOL, "getAttr", "-u"]
 
 
 def get_vsan_datastore():
     """Returns Datastore management object for vsanDatastore, or None"""
-    if not vmdk_ops.si:
-        vmdk_ops.connectLocal()
-    stores = vmdk_ops.si.content.rootFolder.childEntity[0].datastore
+    stores = host_session.get_si().content.rootFolder.childEntity[0].datastore
     try:
         return [d for d in stores if d.summary.type == "vsan"][0]
     except:
@@ -68,8 +67,8 @@ def set_policy(vmdk_path, policy_string):
     Returns True on success
     """
     uuid = vmdk_ops.get_vsan_uuid(vmdk_path)
-    rc, out = vmdk_ops.RunCommand(OBJTOOL_SET_POLICY.format(uuid,
-                                                            policy_string))
+    rc, out = vmdk_ops.RunCommand(OBJTOOL_SET_POLICY + [uuid, "-p",
+                                                        policy_string])
     if rc != 0:
         logging.warning("Failed to set policy for %s : %s", vmdk_path, out)
         return False
@@ -92,7 +91,7 @@ def get_policy(vmdk_path):
     Throws exception if the path is not found or it is not a VSAN object
     """
     uuid = vmdk_ops.get_vsan_uuid(vmdk_path)
-    rc, out = vmdk_ops.RunCommand(OBJTOOL_GET_ATTR.format(uuid))
+    rc, out = vmdk_ops.RunCommand(OBJTOOL_GET_ATTR + [uuid, "--format=json"])
     if rc != 0:
         logging.warning("Failed to get policy for %s : %s", vmdk_path, out)
         return None
@@ -30,15 +30,66 @@
 #include <string.h>
 #include <errno.h>
 #include <stdint.h>
+#include <poll.h>
+#include <sys/time.h>
 
 #include "vmci_sockets.h"
 #include "connection_types.h"
 
+// Accept queue counters, see vmci_get_stats().
+// Must be kept in sync with VmciStats in vmdk_ops.py
+typedef struct vmci_stats {
+   uint64_t accepted;        // connections accepted
+   uint64_t rejected;        // connections dropped: non privileged port or bad request
+   uint64_t accept_errors;   // failed accept() calls
+   uint64_t queued;          // connections already waiting in the backlog when we got to accept()
+   uint64_t accept_wait_usec;// total time blocked in accept() waiting for a client
+   uint64_t recv_usec;       // total time from accept() to fully received request
+   uint64_t max_recv_usec;   // max time from accept() to fully received request
+} vmci_stats;
+
+static vmci_stats stats;
+
+static uint64_t
+usec_since(const struct timeval *start)
+{
+   struct timeval now;
+
+   gettimeofday(&now, NULL);
+   return (uint64_t)(now.tv_sec - start->tv_sec) * 1000000 +
+          (now.tv_usec - start->tv_usec);
+}
+
+// Returns 1 if there is a connection waiting to be accepted on listening socket s.
+static int
+vmci_has_pending(const int s)
+{
+   struct pollfd pfd;
 
-// Returns vSocket to listen on, or -1.
+   pfd.fd = s;
+   pfd.events = POLLIN;
+   pfd.revents = 0;
+   return poll(&pfd, 1, 0) == 1 && (pfd.revents & POLLIN);
+}
+
+// Records a dropped connection and closes client socket, preserving errno
+static void
+vmci_reject(const int client_socket)
+{
+   int saved_errno = errno;
+
+   stats.rejected++;
+   close(client_socket);
+   errno = saved_errno;
+}
+
+
+// Returns listening vSocket, or -1.
+// The socket is listening with <backlog> pending connections allowed, and
+// is kept open for the life of the service.
 // errno indicates the reason for a failure, if any.
 int
-vmci_init(unsigned int port)
+vmci_init(unsigned int port, int backlog)
 {
    struct sockaddr_vm addr;
    socklen_t addrLen;
@@ -80,9 +131,31 @@ vmci_init(unsigned int port)
       return CONN_FAILURE;
    }
 
+   /*
+    * Listen for client connections. Connections arriving while we are busy
+    * wait in the backlog, so it needs to be large enough for request bursts.
+    */
+   ret = listen(socket_fd, backlog);
+   if (ret == -1) {
+      saved_errno = errno;
+      perror("Failed to listen on socket");
+      close(socket_fd);
+      errno = saved_errno;
+      return CONN_FAILURE;
+   }
+
    return socket_fd;
 }
 
+// Copies accept queue counters to <out>
+void
+vmci_get_stats(vmci_stats *out)
+{
+   if (out != NULL) {
+      *out = stats;
+   }
+}
+
 // Returns vSocket to communicate on (which needs to be closed later),
 // or -1 on error
 int
@@ -99,31 +172,35 @@ vmci_get_one_op(const int s,    // socket to listen on
    struct sockaddr_vm addr;
    int client_socket = -1; // connected socket to talk to client
    int af = vsock_get_family(); // socket family for vSockets communication
+   struct timeval start; // for accept and receive timing
+   uint64_t recv_usec;
 
    if (af == -1) {
       return CONN_FAILURE;
    }
 
-   /*
-    * listen for client connections.
-    */
-   ret = listen(s, 1);
-   if (ret == -1) {
-      perror("Failed to listen on socket");
-      return CONN_FAILURE;
+   if (vmci_has_pending(s)) {
+      stats.queued++;
    }
 
+   gettimeofday(&start, NULL);
    addrLen = sizeof addr;
    client_socket = accept(s, (struct sockaddr *) &addr, &addrLen);
    if (client_socket == -1) {
+      saved_errno = errno;
+      stats.accept_errors++;
       perror("Failed to accept connection");
+      errno = saved_errno;
       return CONN_FAILURE;
    }
+   stats.accept_wait_usec += usec_since(&start);
+   stats.accepted++;
+   gettimeofday(&start, NULL);
 
    if (addr.svm_port >= START_NON_PRIVILEGED_PORT) {
       fprintf(stderr, "Connection from non root port=%d, cid=%d\n", addr.svm_port, addr.svm_cid);
-      close(client_socket);
-      errno=ECONNABORTED;
+      errno = ECONNABORTED;
+      vmci_reject(client_socket);
       return CONN_FAILURE;
    }
 
@@ -149,8 +226,8 @@ vmci_get_one_op(const int s,    // socket to listen on
       fprintf(stderr,
                "Failed to receive magic: ret %d (%s) got 0x%x (expected 0x%x)\n",
                ret, strerror(errno), b, MAGIC);
-      close(client_socket);
       errno = saved_errno;
+      vmci_reject(client_socket);
       return CONN_FAILURE;
    }
 
@@ -161,15 +238,15 @@ vmci_get_one_op(const int s,    // socket to listen on
       saved_errno = errno;
       fprintf(stderr, "Failed to receive len: ret %d (%s) got %d\n", ret,
                strerror(errno), b);
-      close(client_socket);
       errno = saved_errno;
+      vmci_reject(client_socket);
       return CONN_FAILURE;
    }
 
    if (b > bsize) {
       fprintf(stderr, "Query is too large: %d (max %d)\n", b, bsize);
-      close(client_socket);
       errno = ERANGE; // result too large for the buffer
+      vmci_reject(client_socket);
       return CONN_FAILURE;
    }
 
@@ -179,19 +256,24 @@ vmci_get_one_op(const int s,    // socket to listen on
       saved_errno = errno;
       fprintf(stderr, "Failed to receive content: ret %d (%s) expected %d\n",
                ret, strerror(errno), b);
-      close(client_socket);
       errno = saved_errno;
+      vmci_reject(client_socket);
       return CONN_FAILURE;
    }
    // do protocol sanity check
    if (strlen(buf) + 1 != b) {
       fprintf(stderr, "Protocol error: len mismatch, expected %d, got %d\n",
                strlen(buf), b);
-      close(client_socket);
       errno = EBADMSG;
+      vmci_reject(client_socket);
       return CONN_FAILURE;
    }
 
+   recv_usec = usec_since(&start);
+   stats.recv_usec += recv_usec;
+   if (recv_usec > stats.max_recv_usec) {
+      stats.max_recv_usec = recv_usec;
+   }
    return client_socket;
 }
 
@@ -28,10 +28,14 @@ Commands ("cmd" in request):
 		"get"    - get info about an individual volume (vmdk)
 		"attach" - attach a VMDK to the requesting VM
 		"detach" - detach a VMDK from the requesting VM (assuming it's unmounted)
+		"attach_batch" - attach several VMDKs to the requesting VM in one VM reconfigure
+		"detach_batch" - detach several VMDKs from the requesting VM in one VM reconfigure
+
+For "attach_batch" and "detach_batch", "Name" in request is a list of volume names
+and the reply is a dictionary {volume name: reply for the volume}
 
 '''
 
-import atexit
 import getopt
 import json
 import logging
@@ -39,7 +43,6 @@ import os
 import os.path
 import re
 import signal
-import subprocess
 import sys
 import traceback
 import threading
@@ -48,11 +51,10 @@ from ctypes import *
 
 from vmware import vsi
 
-import pyVim
 from pyVim.connect import Connect, Disconnect
 from pyVim import vmconfig
 
-from pyVmomi import VmomiSupport, vim, vmodl
+from pyVmomi import vim, vmodl
 
 sys.dont_write_bytecode = True
 
@@ -76,20 +78,47 @@ import volume_kv as kv
 import vmdk_utils
 import vsan_policy
 import vsan_info
+import threadutils
+import vm_cache
+import vm_devices
+import task_waiter
+import vol_pool
+import vol_trash
+import cmd_runner
+from host_session import get_si
+import host_session
 
 # Python version 3.5.1
 PYTHON64_VERSION = 50659824
 
 # External tools used by the plugin.
-OBJ_TOOL_CMD = "/usr/lib/vmware/osfs/bin/objtool open -u "
-OSFS_MKDIR_CMD = "/usr/lib/vmware/osfs/bin/osfs-mkdir -n "
+OBJ_TOOL = "/usr/lib/vmware/osfs/bin/objtool"
+OBJ_TOOL_CMD = [OBJ_TOOL, "open", "-u"]
+OSFS_MKDIR = "/usr/lib/vmware/osfs/bin/osfs-mkdir"
+OSFS_MKDIR_CMD = [OSFS_MKDIR, "-n"]
 VMDK_CREATE_CMD = "/sbin/vmkfstools"
-VMDK_DELETE_CMD = "/sbin/vmkfstools -U "
+VMDK_DELETE_CMD = [VMDK_CREATE_CMD, "-U"]
+VMDK_MOVE_CMD = [VMDK_CREATE_CMD, "-E"]
+
+# Seconds external tools may run before they are killed. vmkfstools also
+# zeroes eagerzeroedthick disks on create.
+TOOL_TIMEOUTS_SEC = {VMDK_CREATE_CMD: 3600,
+                     OBJ_TOOL: 120,
+                     OSFS_MKDIR: 120}
+
+# Helper processes running external tools, see cmd_runner.py
+TOOL_HELPERS = 4
 
 # Defaults
 DOCK_VOLS_DIR = "dockvols"  # place in the same (with Docker VM) datastore
 MAX_JSON_SIZE = 1024 * 4  # max buf size for query json strings. Queries are limited in size
 MAX_SKIP_COUNT = 16       # max retries on VMCI Get Ops failures
+DEFAULT_WORKERS = 1       # requests executed in parallel. 1 means serial execution
+DEFAULT_BACKLOG = 128     # VMCI connections allowed to wait for accept
+STATS_LOG_INTERVAL = 100  # log service stats every that many requests
+
+# Commands operating on a list of volumes, see executeBatchRequest
+BATCH_COMMANDS = ("attach_batch", "detach_batch")
 
 # Volume data returned on Get request
 CAPACITY = 'capacity'
@@ -102,15 +131,40 @@ ATTACHED_TO_VM = 'attached to VM'
 # Virtual machine power states
 VM_POWERED_OFF = "poweredOff"
 
-# Maximum number of PVSCSI targets
-PVSCSI_MAX_TARGETS = 16
-
-# Service instance provide from connection to local hostd
-si = None
+# SCSI Controller keys are in the range of 1000 to 1003 (1000 + bus_number)
+SCSI_CONTROLLER_KEY_OFFSET = 1000
+MAX_SCSI_CONTROLLERS = 4
 
 # VMCI library used to communicate with clients
 lib = None
 
+# Per volume (and per VM) locks for requests executed in parallel
+vol_locks = threadutils.LockManager("vol")
+
+# VM managed objects by BIOS UUID. Populated only when started (see main())
+vm_objects = vm_cache.VmCache(get_si)
+
+# Shared waiter for reconfigure (and other) tasks. Started in main()
+task_dispatcher = task_waiter.TaskWaiter(get_si)
+
+# Pools of pre-created default volumes (vol_pool.VolumePools),
+# set up in main() if enabled with -P
+vol_pools = None
+
+# If True, createVMDK checks the new disk backing (flat file or VSAN object)
+# can be opened. Set with -V
+verify_create = False
+
+# Deletes removed volumes in the background (vol_trash.VolumeReclaimer),
+# set up in main() if enabled with -R. Without it volumes are deleted during
+# the remove request
+vol_reclaimer = None
+
+# Runs external tools from TOOL_TIMEOUTS_SEC in helper processes.
+# Started in main(); until then commands are run directly
+tool_runner = cmd_runner.CommandRunner(TOOL_HELPERS, TOOL_TIMEOUTS_SEC)
+tool_runner_started = False
+
 # Run executable on ESX as needed for vmkfstools invocation (until normal disk create is written)
 # Returns the integer return value and the stdout str on success and integer return value and
 # the stderr str on error
@@ -119,21 +173,24 @@ def RunCommand(cmd):
 
    Runs command specified by user
 
-   @param command to execute
+   @param command to execute: a string run by the shell, or an argument
+          list executed directly, without starting a shell. Lists for tools
+          in TOOL_TIMEOUTS_SEC are run by tool_runner helpers, and killed
+          if they run longer than the timeout
    """
     logging.debug("Running cmd %s", cmd)
 
-    p = subprocess.Popen(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True)
-    o, e = p.communicate()
-    s = p.returncode
-
-    if s != 0:
-        return (s, e)
+    timeout = None
+    if tool_runner.allowed(cmd):
+        timeout = TOOL_TIMEOUTS_SEC[cmd[0]]
+        if tool_runner_started:
+            result = tool_runner.run(cmd)
+            if result:
+                return result
+            # no helper got the command, so it is safe to run it here
+            logging.warning("No command helper, running %s directly", cmd)
 
-    return (s, o)
+    return cmd_runner.run_command(cmd, timeout)
 
 
 # returns error, or None for OK
@@ -149,23 +206,34 @@ def createVMDK(vmdk_path, vm_name, vol_name, opts={}):
     except ValidationError as e:
         return err(e.msg)
 
-    cmd = make_create_cmd(opts, vmdk_path)
-    rc, out = RunCommand(cmd)
-    if rc != 0:
-        return err("Failed to create %s. %s" % (vmdk_path, out))
+    # Volume index is updated with the new volume by create_kv_store()
+    pooled = vol_pools is not None and pool_eligible(opts) and \
+             vol_pools.claim(vmdk_path)
+    if not pooled:
+        cmd = make_create_cmd(opts, vmdk_path)
+        rc, out = RunCommand(cmd)
+        if rc != 0:
+            return err("Failed to create %s. %s" % (vmdk_path, out))
 
-    if not create_kv_store(vm_name, vmdk_path, opts):
+    if not create_kv_store(vm_name, vmdk_path, opts, pooled):
         msg = "Failed to create metadata kv store for {0}".format(vmdk_path)
         logging.warning(msg)
         removeVMDK(vmdk_path)
         return err(msg)
 
-    backing, needs_cleanup = get_backing_device(vmdk_path)
-    cleanup_backing_device(backing, needs_cleanup)
+    # The disk backing is otherwise first opened by the attach reconfigure
+    if verify_create:
+        backing, needs_cleanup = get_backing_device(vmdk_path)
+        cleanup_backing_device(backing, needs_cleanup)
+        if not backing:
+            msg = "Failed to access backing device for {0}".format(vmdk_path)
+            logging.warning(msg)
+            removeVMDK(vmdk_path)
+            return err(msg)
 
 
 def make_create_cmd(opts, vmdk_path):
-    """ Return the command used to create a VMDK """
+    """ Return the command (argument list) used to create a VMDK """
     if not "size" in opts:
         size = kv.DEFAULT_DISK_SIZE
     else:
@@ -183,19 +251,64 @@ def make_create_cmd(opts, vmdk_path):
         # Note that the --policyFile option gets ignored if the
         # datastore is not VSAN
         policy_file = vsan_policy.policy_path(opts[kv.VSAN_POLICY_NAME])
-        return "{0} -d {1} -c {2} --policyFile {3} {4}".format(VMDK_CREATE_CMD, disk_format, size,
-                                                               policy_file, vmdk_path)
+        return [VMDK_CREATE_CMD, "-d", disk_format, "-c", size,
+                "--policyFile", policy_file, vmdk_path]
     else:
-        return "{0} -d {1} -c {2} {3}".format(VMDK_CREATE_CMD, disk_format, size, vmdk_path)
+        return [VMDK_CREATE_CMD, "-d", disk_format, "-c", size, vmdk_path]
 
 
-def create_kv_store(vm_name, vmdk_path, opts):
-    """ Create the metadata kv store for a volume """
+def create_kv_store(vm_name, vmdk_path, opts, pooled=False):
+    """
+    Create the metadata kv store for a volume.
+    Volumes taken from vol_pools already have a side car, which is rewritten.
+    """
     vol_meta = {kv.STATUS: kv.DETACHED,
                 kv.VOL_OPTS: opts,
                 kv.CREATED: time.asctime(time.gmtime()),
                 kv.CREATED_BY: vm_name}
-    return kv.create(vmdk_path, vol_meta)
+    # Open the new disk once for all side car operations
+    with kv.disk_open(vmdk_path):
+        if pooled and kv.getAll(vmdk_path) is not None:
+            return kv.setAll(vmdk_path, vol_meta)
+        return kv.create(vmdk_path, vol_meta)
+
+
+def pool_eligible(opts):
+    """ Returns True if a volume with opts can be taken from vol_pools """
+    size = str(opts.get(kv.SIZE, kv.DEFAULT_DISK_SIZE)).lower()
+    disk_format = opts.get(kv.DISK_ALLOCATION_FORMAT, kv.DEFAULT_ALLOCATION_FORMAT)
+    return size == kv.DEFAULT_DISK_SIZE and \
+           disk_format == kv.DEFAULT_ALLOCATION_FORMAT and \
+           kv.VSAN_POLICY_NAME not in opts
+
+
+def create_pool_disk(vmdk_path):
+    """ Create a default volume with side car for vol_pools """
+    rc, out = RunCommand(make_create_cmd({}, vmdk_path))
+    if rc != 0:
+        logging.warning("Failed to create %s. %s", vmdk_path, out)
+        return False
+    # pooled volumes are indexed when claimed, see create_kv_store()
+    with kv.disk_open(vmdk_path):
+        return kv.create(vmdk_path, {kv.STATUS: kv.DETACHED}, indexed=False)
+
+
+def delete_disk(vmdk_path):
+    """ Delete a volume with all its files. Returns True on success """
+    rc, out = RunCommand(VMDK_DELETE_CMD + [vmdk_path])
+    if rc != 0:
+        logging.warning("Failed to delete %s. %s", vmdk_path, out)
+        return False
+    return True
+
+
+def move_disk(src_path, dst_path):
+    """ Rename a volume with all its files. Returns True on success """
+    rc, out = RunCommand(VMDK_MOVE_CMD + [src_path, dst_path])
+    if rc != 0:
+        logging.warning("Failed to move %s to %s. %s", src_path, dst_path, out)
+        return False
+    return True
 
 
 def validate_opts(opts, vmdk_path):
@@ -301,7 +414,7 @@ def get_vsan_devfs_path(uuid):
 
     # Objtool creates a link thats usable to
     # read write to vsan object.
-    cmd = "{0} {1}".format(OBJ_TOOL_CMD, uuid)
+    cmd = OBJ_TOOL_CMD + [uuid]
     rc, out = RunCommand(cmd)
     fpath="/vmfs/devices/vsan/{0}".format(uuid)
     if rc == 0 and os.path.isfile(fpath):
@@ -346,14 +459,26 @@ def cleanup_backing_device(backing, cleanup_device):
     return True
 
 # Return volume ingo
+def convert_size(size):
+    """ Return size in bytes in the format Docker shows, e.g. 100MB """
+    if size < vmdk_utils.KB:
+        return size
+    elif size < vmdk_utils.MB:
+        return '{0}{1}'.format(size / vmdk_utils.KB, 'KB')
+    elif size < vmdk_utils.GB:
+        return '{0}{1}'.format(size / vmdk_utils.MB, 'MB')
+    else:
+        return '{0}{1}'.format(size / vmdk_utils.GB, 'GB')
+
+
 def vol_info(vol_meta, vol_size_info, datastore):
     vinfo = {CREATED_BY_VM : vol_meta[kv.CREATED_BY],
              kv.CREATED : vol_meta[kv.CREATED],
              kv.STATUS : vol_meta[kv.STATUS]}
 
     vinfo[CAPACITY] = {}
-    vinfo[CAPACITY][SIZE] = vol_size_info[SIZE]
-    vinfo[CAPACITY][ALLOCATED] = vol_size_info[ALLOCATED]
+    vinfo[CAPACITY][SIZE] = convert_size(vol_size_info[kv.VOL_SIZE])
+    vinfo[CAPACITY][ALLOCATED] = convert_size(vol_size_info[kv.VOL_ALLOC])
     vinfo[LOCATION] = datastore
 
     if kv.ATTACHED_VM_NAME in vol_meta:
@@ -382,10 +507,14 @@ def vol_info(vol_meta, vol_size_info, datastore):
 # Return error, or None for OK
 def removeVMDK(vmdk_path):
     logging.info("*** removeVMDK: %s", vmdk_path)
-    cmd = "{0} {1}".format(VMDK_DELETE_CMD, vmdk_path)
-    rc, out = RunCommand(cmd)
-    if rc != 0:
-        return err("Failed to remove %s. %s" % (vmdk_path, out))
+    with kv.index_update(vmdk_path) as changes:
+        # with vol_reclaimer the disk is deleted later, in the background
+        removed = ((vol_reclaimer and vol_reclaimer.trash(vmdk_path)) or
+                   delete_disk(vmdk_path))
+        if removed:
+            changes[vmdk_path] = None
+    if not removed:
+        return err("Failed to remove %s" % vmdk_path)
 
     return None
 
@@ -413,16 +542,21 @@ def listVMDK(vm_datastore):
     Each volume name is returned as either `volume@datastore`, or just `volume`
     for volumes on vm_datastore
     """
-    vmdks = vmdk_utils.get_volumes()
-    # build  fully qualified vol name for each volume found
-    return [{u'Name': get_full_vol_name(x['filename'], x['datastore'], vm_datastore),
-             u'Attributes': {}} \
-            for x in vmdks]
+    volumes = []
+    for (datastore, url_name, path) in vmdk_utils.get_datastores():
+        for file_name in kv.list_volumes(path):
+            # build  fully qualified vol name for each volume found
+            volumes.append({u'Name': get_full_vol_name(file_name, datastore, vm_datastore),
+                            u'Attributes': {}})
+    return volumes
 
 
 # Return VM managed object, reconnect if needed. Throws if fails twice.
 def findVmByUuid(vm_uuid):
-    vm = None
+    vm = vm_objects.get(vm_uuid)
+    if vm:
+        return vm
+    si = get_si()
     try:
         vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True, False)
     except Exception as ex:
@@ -434,7 +568,7 @@ def findVmByUuid(vm_uuid):
     # Retry. It can throw if connect/search fails. But search can't return None
     # since we get UUID from VMM so VM must exist
     #
-    connectLocal()
+    si = host_session.session.reconnect(si)
     vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True, False)
     logging.info("Found VM name=%s, id=%s ", vm.config.name, vm_uuid)
     return vm
@@ -443,16 +577,14 @@ def findVmByUuid(vm_uuid):
 # Return error, or None for OK.
 def attachVMDK(vmdk_path, vm_uuid):
     vm = findVmByUuid(vm_uuid)
-    logging.info("*** attachVMDK: %s to %s VM uuid = %s",
-                 vmdk_path, vm.config.name, vm_uuid)
+    logging.info("*** attachVMDK: %s to VM uuid = %s", vmdk_path, vm_uuid)
     return disk_attach(vmdk_path, vm)
 
 
 # Return error, or None for OK.
 def detachVMDK(vmdk_path, vm_uuid):
     vm = findVmByUuid(vm_uuid)
-    logging.info("*** detachVMDK: %s from %s VM uuid = %s",
-                 vmdk_path, vm.config.name, vm_uuid)
+    logging.info("*** detachVMDK: %s from VM uuid = %s", vmdk_path, vm_uuid)
     return disk_detach(vmdk_path, vm)
 
 
@@ -467,20 +599,34 @@ def get_vol_path(datastore):
         return path
 
     # The osfs tools are usable for all datastores
-    cmd = "{0} {1}".format(OSFS_MKDIR_CMD, path)
+    cmd = OSFS_MKDIR_CMD + [path]
     rc, out = RunCommand(cmd)
     if rc == 0:
         logging.info("Created %s", path)
         return path
 
+    # A parallel request may have just created it
+    if os.path.isdir(path):
+        logging.debug("Found %s created concurrently, returning", path)
+        return path
+
     logging.warning("Failed to create %s", path)
     return None
 
 
+def get_dockvols():
+    """returns paths of dockvols folders on all datastores"""
+    return [i[2] for i in vmdk_utils.get_datastores()]
+
 def known_datastores():
     """returns names of know datastores"""
     return [i[0] for i in vmdk_utils.get_datastores()]
 
+def is_known_datastore(datastore):
+    """returns True if datastore is a name of a known datastore"""
+    ds = vmdk_utils.get_datastore(datastore)
+    return ds is not None and ds[0] == datastore
+
 def parse_vol_name(full_vol_name):
     """
     Parses volume[@datastore] and returns (volume, datastore)
@@ -528,12 +674,23 @@ def get_datastore_name(config_path):
     """Returns datastore NAME in config_path (not url-name which may be used in path)"""
     # path is always /vmfs/volumes/<datastore>/... , so extract datastore:
     config_ds_name = config_path.split("/")[3]
-    ds_name = [x[0] for x in vmdk_utils.get_datastores() \
-                    if x[0] == config_ds_name or x[1] == config_ds_name ]
-    if len(ds_name) != 1:
-        logging.error("get_datastore_name: found more than one match: %s" % ds_name)
-    logging.debug("get_datastore_name: path=%s name=%s" % (config_ds_name, ds_name))
-    return ds_name[0]
+    ds = vmdk_utils.get_datastore(config_ds_name)
+    if not ds:
+        logging.error("get_datastore_name: no datastore matches %s", config_ds_name)
+        return None
+    logging.debug("get_datastore_name: path=%s name=%s", config_ds_name, ds[0])
+    return ds[0]
+
+def vol_lock_key(vmdk_path):
+    """
+    Returns key for vol_locks for a volume. The same VMDK can be addressed via
+    datastore name or datastore url-name, so the path is resolved first.
+    """
+    return os.path.realpath(vmdk_path)
+
+def vm_lock_key(vm_uuid):
+    """Returns key for vol_locks for a VM"""
+    return "vm:{0}".format(vm_uuid)
 
 # gets the requests, calculates path for volumes, and calls the relevant handler
 def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts):
@@ -548,17 +705,57 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts):
     """
 
     vm_datastore = get_datastore_name(config_path)
+    if not vm_datastore:
+        return err("Failed to find datastore for VM config {0}".format(config_path))
     if cmd == "list":
         return listVMDK(vm_datastore)
 
+    if cmd in BATCH_COMMANDS:
+        return executeBatchRequest(vm_uuid, vm_datastore, cmd, full_vol_name)
+
+    vol_name, datastore, vmdk_path, error = resolve_vol_name(full_vol_name,
+                                                             vm_datastore)
+    if error:
+        return error
+
+    # Requests may run in parallel (see handleVmciRequests), so serialize
+    # requests for the same volume. Attach and detach also change the VM
+    # device list (slot placement), so serialize them per VM as well.
+    lock_keys = [vol_lock_key(vmdk_path)]
+    if cmd in ("attach", "detach"):
+        lock_keys.append(vm_lock_key(vm_uuid))
+
+    with vol_locks.lock(*lock_keys):
+        if cmd == "get":
+            response = getVMDK(vmdk_path, vol_name, datastore)
+        elif cmd == "create":
+            response = createVMDK(vmdk_path, vm_name, vol_name, opts)
+        elif cmd == "remove":
+            response = removeVMDK(vmdk_path)
+        elif cmd == "attach":
+            response = attachVMDK(vmdk_path, vm_uuid)
+        elif cmd == "detach":
+            response = detachVMDK(vmdk_path, vm_uuid)
+        else:
+            return err("Unknown command:" + cmd)
+
+    return response
+
+def resolve_vol_name(full_vol_name, vm_datastore):
+    """
+    Parses volume[@datastore] and locates the volume VMDK.
+    Returns (vol_name, datastore, vmdk_path, None) or
+    (None, None, None, err(msg)) on failure.
+    """
     try:
         vol_name, datastore = parse_vol_name(full_vol_name)
     except ValidationError as ex:
-        return err(str(ex))
+        return None, None, None, err(str(ex))
     if not datastore:
         datastore = vm_datastore
-    elif datastore not in known_datastores():
-        return err("Invalid datastore '%s'.\n" \
+    elif not is_known_datastore(datastore):
+        return None, None, None, \
+               err("Invalid datastore '%s'.\n" \
                    "Known datastores: %s.\n" \
                    "Default datastore: %s" \
                    % (datastore, ", ".join(known_datastores()), vm_datastore))
@@ -567,91 +764,93 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts):
     path = get_vol_path(datastore)
 
     if path is None:
-        return err("Failed to initialize volume path {0}".format(path))
-
-    vmdk_path = vmdk_utils.get_vmdk_path(path, vol_name)
+        return None, None, None, \
+               err("Failed to initialize volume path {0}".format(path))
 
-    if cmd == "get":
-        response = getVMDK(vmdk_path, vol_name, datastore)
-    elif cmd == "create":
-        response = createVMDK(vmdk_path, vm_name, vol_name, opts)
-    elif cmd == "remove":
-        response = removeVMDK(vmdk_path)
-    elif cmd == "attach":
-        response = attachVMDK(vmdk_path, vm_uuid)
-    elif cmd == "detach":
-        response = detachVMDK(vmdk_path, vm_uuid)
-    else:
-        return err("Unknown command:" + cmd)
-
-    return response
+    return vol_name, datastore, vmdk_utils.get_vmdk_path(path, vol_name), None
 
-def connectLocal():
-    '''
-	connect and do stuff on local machine
-	'''
-    global si  #
-
-    # Connect to localhost as dcui
-    # User "dcui" is a local Admin that does not lose permissions
-    # when the host is in lockdown mode.
-    si = pyVim.connect.Connect(host='localhost', user='dcui')
-    if not si:
-        raise SystemExit("Failed to connect to localhost as 'dcui'.")
+def executeBatchRequest(vm_uuid, vm_datastore, cmd, full_vol_names):
+    """
+    Executes attach_batch or detach_batch request for a list of volumes.
+    All disks are attached (or detached) using a single VM reconfigure.
 
-    atexit.register(pyVim.connect.Disconnect, si)
+    Returns err(msg) if the request failed as a whole, or a dictionary
+    {volume name: dev_info, None or err(msg)}
+    """
+    if not isinstance(full_vol_names, list):
+        return err("{0} expects a list of volume names".format(cmd))
+
+    response = {}
+    vmdk_paths = {}  # full volume name -> vmdk path
+    for full_vol_name in full_vol_names:
+        _, _, vmdk_path, error = resolve_vol_name(full_vol_name, vm_datastore)
+        if error:
+            response[full_vol_name] = error
+        else:
+            vmdk_paths[full_vol_name] = vmdk_path
+
+    if not vmdk_paths:
+        return response
+
+    # Names resolving to the same disk (e.g. vol1 and vol1@datastore) are
+    # attached or detached once
+    unique_paths = sorted(set(vmdk_paths.values()))
+    lock_keys = [vol_lock_key(p) for p in unique_paths]
+    lock_keys.append(vm_lock_key(vm_uuid))
+    with vol_locks.lock(*lock_keys):
+        vm = findVmByUuid(vm_uuid)
+        if not vm:
+            return err("Failed to find VM with uuid {0}".format(vm_uuid))
+        logging.info("*** %s: VM uuid = %s %s", cmd, vm_uuid, unique_paths)
+        if cmd == "attach_batch":
+            result = disk_attach_batch(unique_paths, vm)
+        else:
+            result = disk_detach_batch(unique_paths, vm)
 
-    # set out ID in context to be used in request - so we'll see it in logs
-    reqCtx = VmomiSupport.GetRequestContext()
-    reqCtx["realUser"] = 'dvolplug'
-    return si
+    if is_error(result):
+        return result
 
+    for full_vol_name, vmdk_path in vmdk_paths.items():
+        response[full_vol_name] = result[vmdk_path]
+    return response
 
-def findDeviceByPath(vmdk_path, vm):
+def findDeviceByPath(vmdk_path, vm, vm_devs=None):
+    '''
+    Returns VirtualDisk device of the vm backed by vmdk_path, or None.
+    vm_devs is the VM device inventory, fetched if not passed.
+    '''
     logging.debug("findDeviceByPath: Looking for device {0}".format(vmdk_path))
-    for d in vm.config.hardware.device:
-        if type(d) != vim.vm.device.VirtualDisk:
-            continue
-
-        # Disks of all backing have a backing object with a filename attribute.
-        # The filename identifies the virtual disk by name and can be used
-        # to match with the given volume name.
-        # Filename format is as follows:
-        #   "[<datastore name>] <parent-directory>/<vmdk-descriptor-name>"
-        backing_disk = d.backing.fileName.split(" ")[1]
-
-        # Construct the parent dir and vmdk name, resolving
-        # links if any.
-        dvol_dir = os.path.dirname(vmdk_path)
-        real_vol_dir = os.path.basename(os.path.realpath(dvol_dir))
-        virtual_disk = os.path.join(real_vol_dir, os.path.basename(vmdk_path))
-        if virtual_disk == backing_disk:
-            logging.debug("findDeviceByPath: MATCH: %s", backing_disk)
-            return d
-    return None
+    if not vm_devs:
+        vm_devs = vm_devices.VmDevices.retrieve(get_si(), vm)
+
+    # Disk backing file name identifies the virtual disk as
+    # "<parent-directory>/<vmdk-descriptor-name>", with links resolved,
+    # so construct the same from vmdk_path and look it up.
+    dvol_dir = os.path.dirname(vmdk_path)
+    vmdk_name = os.path.basename(vmdk_path)
+    real_vol_dir = vmdk_utils.get_real_dir_name(dvol_dir)
+    device = vm_devs.find_disk(os.path.join(real_vol_dir, vmdk_name))
+    if not device and vm_devs.has_disk_named(vmdk_name):
+        # The folder may have been re-created (and resolve elsewhere) since
+        # we remembered it, so check again. Not needed if the VM has no disk
+        # of that name, the usual case when attaching.
+        fresh_vol_dir = vmdk_utils.get_real_dir_name(dvol_dir, refresh=True)
+        if fresh_vol_dir != real_vol_dir:
+            device = vm_devs.find_disk(os.path.join(fresh_vol_dir, vmdk_name))
+    if device:
+        logging.debug("findDeviceByPath: MATCH: %s", device.backing.fileName)
+    return device
 
 # Find the PCI slot number
-def get_controller_pci_slot(vm, pvscsi, key_offset):
+def get_controller_pci_slot(vm_devs, pvscsi, key_offset):
     ''' Return PCI slot number of the given PVSCSI controller
     Input parameters:
-    vm: VM configuration
+    vm_devs: VM device inventory (vm_devices.VmDevices)
     pvscsi: given PVSCSI controller
     key_offset: offset from the bus number, controller_key - key_offset
     is equal to the slot number of this given PVSCSI controller
     '''
-    if pvscsi.slotInfo:
-       return str(pvscsi.slotInfo.pciSlotNumber)
-    else:
-       # Slot number is got from from the VM config
-       key = 'scsi{0}.pciSlotNumber'.format(pvscsi.key -
-                                            key_offset)                
-       slot = [cfg for cfg in vm.config.extraConfig \
-               if cfg.key == key]
-       # If the given controller exists
-       if slot:
-          return slot[0].value
-       else:
-          return None
+    return vm_devs.pci_slot(pvscsi, key_offset)
 
 def dev_info(unit_number, pci_slot_number):
     '''Return a dictionary with Unit/Bus for the vmdk (or error)'''
@@ -669,42 +868,29 @@ def reset_vol_meta(vmdk_path):
                         vmdk_path, vol_meta[kv.STATUS],
                         vol_meta[kv.ATTACHED_VM_NAME],
                         vol_meta[kv.ATTACHED_VM_UUID])
-    vol_meta[kv.STATUS] = kv.DETACHED
-    vol_meta[kv.ATTACHED_VM_UUID] = None
-    vol_meta[kv.ATTACHED_VM_NAME] = None
-    if not kv.setAll(vmdk_path, vol_meta):
+    if kv.update(vmdk_path, {kv.STATUS: kv.DETACHED,
+                             kv.ATTACHED_VM_UUID: None,
+                             kv.ATTACHED_VM_NAME: None}) is None:
        msg = "Failed to save volume metadata for {0}.".format(vmdk_path)
        logging.warning("reset_vol_meta: " + msg)
        return err(msg)
 
-def setStatusAttached(vmdk_path, vm):
+def setStatusAttached(vmdk_path, vm_devs):
     '''Sets metadata for vmdk_path to (attached, attachedToVM=uuid'''
     logging.debug("Set status=attached disk=%s VM name=%s uuid=%s", vmdk_path,
-                  vm.config.name, vm.config.uuid)
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-        vol_meta = {}
-    vol_meta[kv.STATUS] = kv.ATTACHED
-    vol_meta[kv.ATTACHED_VM_UUID] = vm.config.uuid
-    vol_meta[kv.ATTACHED_VM_NAME] = vm.config.name
-    if not kv.setAll(vmdk_path, vol_meta):
+                  vm_devs.name, vm_devs.uuid)
+    if kv.update(vmdk_path, {kv.STATUS: kv.ATTACHED,
+                             kv.ATTACHED_VM_UUID: vm_devs.uuid,
+                             kv.ATTACHED_VM_NAME: vm_devs.name}) is None:
         logging.warning("Attach: Failed to save Disk metadata for %s", vmdk_path)
 
 
 def setStatusDetached(vmdk_path):
     '''Sets metadata for vmdk_path to "detached"'''
     logging.debug("Set status=detached disk=%s", vmdk_path)
-    vol_meta = kv.getAll(vmdk_path)
-    if not vol_meta:
-        vol_meta = {}
-    vol_meta[kv.STATUS] = kv.DETACHED
-    # If attachedVMName is present, so is attachedVMUuid
-    try:
-        del vol_meta[kv.ATTACHED_VM_UUID]
-        del vol_meta[kv.ATTACHED_VM_NAME]
-    except:
-        pass
-    if not kv.setAll(vmdk_path, vol_meta):
+    if kv.update(vmdk_path, {kv.STATUS: kv.DETACHED,
+                             kv.ATTACHED_VM_UUID: kv.DELETE,
+                             kv.ATTACHED_VM_NAME: kv.DELETE}) is None:
         logging.warning("Detach: Failed to save Disk metadata for %s", vmdk_path)
 
 
@@ -736,34 +922,43 @@ def handle_stale_attach(vmdk_path, kv_uuid):
        cur_vm = findVmByUuid(kv_uuid)
 
        if cur_vm:
+          cur_devs = vm_devices.VmDevices.retrieve(get_si(), cur_vm)
           # Detach the disk only if VM is powered off
           if cur_vm.runtime.powerState == VM_POWERED_OFF:
              logging.info("Detaching disk %s from VM(powered off) - %s\n",
-                             vmdk_path, cur_vm.config.name)
-             device = findDeviceByPath(vmdk_path, cur_vm)
+                             vmdk_path, cur_devs.name)
+             device = findDeviceByPath(vmdk_path, cur_vm, cur_devs)
              if device:
                 msg = disk_detach_int(vmdk_path, cur_vm, device)
                 if msg:
                    msg += " failed to detach disk {0} from VM={1}.".format(vmdk_path,
-                                                                           cur_vm.config.name)
+                                                                           cur_devs.name)
                    return err(msg)
              else:
                 logging.warning("Failed to find disk %s in powered off VM - %s, resetting volume metadata\n",
-                                vmdk_path, cur_vm.config.name)
+                                vmdk_path, cur_devs.name)
                 ret = reset_vol_meta(vmdk_path)
                 if ret:
                    return ret
           else:
              msg = "Disk {0} already attached to VM={1}".format(vmdk_path,
-                                                                cur_vm.config.name)
+                                                                cur_devs.name)
              return err(msg)
        else:
           logging.warning("Failed to find VM %s that attached the disk %s, resetting volume metadata",
-                          cur_vm.config.name, vmdk_path)
+                          kv_uuid, vmdk_path)
           ret = reset_vol_meta(vmdk_path)
           if ret:
              return ret
 
+def pvscsi_controller_spec(controller_key, bus_number):
+    '''Return device change spec adding a PVSCSI controller'''
+    return vim.VirtualDeviceConfigSpec(
+        operation='add',
+        device=vim.ParaVirtualSCSIController(key=controller_key,
+                                                busNumber=bus_number,
+                                                sharedBus='noSharing', ), )
+
 def add_pvscsi_controller(vm, controllers, max_scsi_controllers, offset_from_bus_number):
     ''' 
     Add a new PVSCSI controller, return (controller_key, err) pair
@@ -775,11 +970,7 @@ def add_pvscsi_controller(vm, controllers, max_scsi_controllers, offset_from_bus
     key = avail.pop()  # bus slot
     controller_key = key + offset_from_bus_number
     disk_slot = 0
-    controller_spec = vim.VirtualDeviceConfigSpec(
-        operation='add',
-        device=vim.ParaVirtualSCSIController(key=controller_key,
-                                                busNumber=key,
-                                                sharedBus='noSharing', ), )
+    controller_spec = pvscsi_controller_spec(controller_key, key)
     # changes spec content goes here
     pvscsi_change = []
     pvscsi_change.append(controller_spec)
@@ -787,39 +978,32 @@ def add_pvscsi_controller(vm, controllers, max_scsi_controllers, offset_from_bus
     spec.deviceChange = pvscsi_change
 
     try:
-        wait_for_tasks(si, [vm.ReconfigVM_Task(spec=spec)])
+        wait_for_tasks(get_si(), [vm.ReconfigVM_Task(spec=spec)])
     except vim.fault.VimFault as ex:
         msg=("Failed to add PVSCSI Controller: %s", ex.msg)
         return None, err(msg)
     logging.debug("Added a PVSCSI controller, controller_id=%d", controller_key)    
     return controller_key, None
 
-def find_disk_slot_in_controller(vm, devices, pvsci, idx, offset_from_bus_number):
+def find_disk_slot_in_controller(vm_devs, pvsci, idx):
     '''
     Find an empty disk slot in the given controller, return disk_slot if an empty slot
     can be found, otherwise, return None
     '''
     disk_slot = None
     controller_key = pvsci[idx].key
-    taken = set([dev.unitNumber
-             for dev in devices
-             if type(dev) == vim.VirtualDisk and dev.controllerKey ==
-             controller_key])
     # search in 15 slots, with unit_number 7 reserved for scsi controller
-    avail_slots = (set(range(0, 7)) | set(range(8, PVSCSI_MAX_TARGETS))) - taken
+    avail_slots = vm_devs.free_disk_units(controller_key)
     logging.debug("idx=%d controller_key=%d avail_slots=%d", idx, controller_key, len(avail_slots))
 
     if len(avail_slots) != 0:
-        disk_slot = avail_slots.pop()
-        pci_slot_number = get_controller_pci_slot(vm, pvsci[idx],
-                                                  offset_from_bus_number)
-                 
+        disk_slot = avail_slots[0]
         logging.debug("Find an available slot: controller_key = %d slot = %d", controller_key, disk_slot)
     else:
         logging.warning("No available slot in this controller: controller_key = %d", controller_key)
     return disk_slot        
 
-def find_available_disk_slot(vm, devices, pvsci, offset_from_bus_number):
+def find_available_disk_slot(vm_devs, pvsci):
     '''
     Iterate through all the existing PVSCSI controllers attached to a VM to find an empty
     disk slot. Return disk_slot is an empty slot can be found, otherwise, return None
@@ -827,7 +1011,7 @@ def find_available_disk_slot(vm, devices, pvsci, offset_from_bus_number):
     idx = 0
     disk_slot = None
     while ((disk_slot is None) and (idx < len(pvsci))):
-            disk_slot = find_disk_slot_in_controller(vm, devices, pvsci, idx, offset_from_bus_number)
+            disk_slot = find_disk_slot_in_controller(vm_devs, pvsci, idx)
             if (disk_slot is None):
                 idx = idx + 1;
     return idx, disk_slot            
@@ -839,12 +1023,17 @@ def disk_attach(vmdk_path, vm):
     return error or unit:bus numbers of newly attached disk.
     '''
 
+    # VM name, uuid and devices, fetched once. Slot placement below is done
+    # on this inventory, without going back to hostd.
+    vm_devs = vm_devices.VmDevices.retrieve(get_si(), vm)
+
     kv_status_attached, kv_uuid, attach_mode = getStatusAttached(vmdk_path)
-    logging.info("Attaching {0} as {1}".format(vmdk_path, attach_mode))
+    logging.info("Attaching {0} as {1} to VM {2}".format(vmdk_path, attach_mode,
+                                                         vm_devs.name))
 
     # If the volume is attached then check if the attach is stale (VM is powered off).
     # Otherwise, detach the disk from the VM it's attached to.
-    if kv_status_attached and kv_uuid != vm.config.uuid:
+    if kv_status_attached and kv_uuid != vm_devs.uuid:
        ret_err = handle_stale_attach(vmdk_path, kv_uuid)
        if ret_err:
           return ret_err
@@ -855,44 +1044,37 @@ def disk_attach(vmdk_path, vm):
     # 0 to 15 with 7 being reserved (for older SCSI controllers).
     # It is up to the API client to add controllers as needed.
     # SCSI Controller keys are in the range of 1000 to 1003 (1000 + bus_number).
-    offset_from_bus_number = 1000
-    max_scsi_controllers = 4
-
-
-    devices = vm.config.hardware.device
+    offset_from_bus_number = SCSI_CONTROLLER_KEY_OFFSET
+    max_scsi_controllers = MAX_SCSI_CONTROLLERS
 
     # get all scsi controllers (pvsci, lsi logic, whatever)
-    controllers = [d for d in devices
-                   if isinstance(d, vim.VirtualSCSIController)]
+    controllers = vm_devs.controllers()
 
     # Check if this disk is already attached, and if it is - skip the disk
     # attach and the checks on attaching a controller if needed.
-    device = findDeviceByPath(vmdk_path, vm)
+    device = findDeviceByPath(vmdk_path, vm, vm_devs)
     if device:
         # Disk is already attached.
         logging.warning("Disk %s already attached. VM=%s",
-                        vmdk_path, vm.config.uuid)
-        setStatusAttached(vmdk_path, vm)
+                        vmdk_path, vm_devs.uuid)
+        setStatusAttached(vmdk_path, vm_devs)
         # Get that controller to which the device is configured for
-        pvsci = [d for d in controllers
-                   if type(d) == vim.ParaVirtualSCSIController and
-                      d.key == device.controllerKey]
+        controller = vm_devs.controller(device.controllerKey)
         
         return dev_info(device.unitNumber,
-                        get_controller_pci_slot(vm, pvsci[0],
+                        get_controller_pci_slot(vm_devs, controller,
                                                 offset_from_bus_number))
         
 
     # Disk isn't attached, make sure we have a PVSCI and add it if we don't
     # check if we already have a pvsci one
-    pvsci = [d for d in controllers
-             if type(d) == vim.ParaVirtualSCSIController]
+    pvsci = vm_devs.pvscsi_controllers()
     disk_slot = None         
     if len(pvsci) > 0:
-        idx, disk_slot = find_available_disk_slot(vm, devices, pvsci, offset_from_bus_number);
+        idx, disk_slot = find_available_disk_slot(vm_devs, pvsci);
         if (disk_slot is not None):
             controller_key = pvsci[idx].key
-            pci_slot_number = get_controller_pci_slot(vm, pvsci[idx],
+            pci_slot_number = get_controller_pci_slot(vm_devs, pvsci[idx],
                                                       offset_from_bus_number)
             logging.debug("Find an available disk slot, controller_key=%d, slot_id=%d",
                           controller_key, disk_slot)
@@ -901,7 +1083,7 @@ def disk_attach(vmdk_path, vm):
         disk_slot = 0  # starting on a fresh controller
         if len(controllers) >= max_scsi_controllers:
             msg = "Failed to place new disk - The maximum number of supported volumes has been reached."
-            logging.error(msg + " VM=%s", vm.config.uuid)
+            logging.error(msg + " VM=%s", vm_devs.uuid)
             return err(msg)
 
         logging.info("Adding a PVSCSI controller")
@@ -912,29 +1094,16 @@ def disk_attach(vmdk_path, vm):
         if (ret_err):
             return ret_err    
             
-        # Find the controller just added
-        devices = vm.config.hardware.device
-        pvsci = [d for d in devices
-                 if type(d) == vim.ParaVirtualSCSIController and
-                 d.key == controller_key]
-        pci_slot_number = get_controller_pci_slot(vm, pvsci[0],
+        # Find the controller just added. Its PCI slot is assigned by hostd,
+        # so this is the one case where the inventory is fetched again.
+        vm_devs = vm_devices.VmDevices.retrieve(get_si(), vm)
+        pci_slot_number = get_controller_pci_slot(vm_devs,
+                                                  vm_devs.controller(controller_key),
                                                   offset_from_bus_number)
         logging.info("Added a PVSCSI controller, controller_key=%d pci_slot_number=%s",
                       controller_key, pci_slot_number)
     
-    # add disk as independent, so it won't be snapshotted with the Docker VM
-    disk_spec = vim.VirtualDeviceConfigSpec(
-        operation='add',
-        device=
-        vim.VirtualDisk(backing=vim.VirtualDiskFlatVer2BackingInfo(
-            fileName="[] " + vmdk_path,
-            diskMode=attach_mode, ),
-                        deviceInfo=vim.Description(
-                            # TODO: use docker volume name here. Issue #292
-                            label="dockerDataVolume",
-                            summary="dockerDataVolume", ),
-                        unitNumber=disk_slot,
-                        controllerKey=controller_key, ), )
+    disk_spec = attach_disk_spec(vmdk_path, attach_mode, controller_key, disk_slot)
     disk_changes = []
     disk_changes.append(disk_spec)
 
@@ -942,7 +1111,7 @@ def disk_attach(vmdk_path, vm):
     spec.deviceChange = disk_changes
 
     try:
-        wait_for_tasks(si, [vm.ReconfigVM_Task(spec=spec)])
+        wait_for_tasks(get_si(), [vm.ReconfigVM_Task(spec=spec)])
     except vim.fault.VimFault as ex:
         msg = ex.msg
         # Use metadata (KV) for extra logging
@@ -950,30 +1119,160 @@ def disk_attach(vmdk_path, vm):
             # KV  claims we are attached to a different VM'.
             msg += " disk {0} already attached to VM={1}".format(vmdk_path,
                                                                  kv_uuid)
-            if kv_uuid == vm.config.uuid:
+            if kv_uuid == vm_devs.uuid:
                 msg += "(Current VM)"
         return err(msg)
 
-    setStatusAttached(vmdk_path, vm)
+    setStatusAttached(vmdk_path, vm_devs)
     logging.info("Disk %s successfully attached. controller pci_slot_number=%s, disk_slot=%d",
                  vmdk_path, pci_slot_number, disk_slot)
     return dev_info(disk_slot, pci_slot_number)
 
 
+def attach_disk_spec(vmdk_path, attach_mode, controller_key, disk_slot):
+    '''Return device change spec adding vmdk_path at disk_slot of controller_key'''
+    # add disk as independent, so it won't be snapshotted with the Docker VM
+    return vim.VirtualDeviceConfigSpec(
+        operation='add',
+        device=
+        vim.VirtualDisk(backing=vim.VirtualDiskFlatVer2BackingInfo(
+            fileName="[] " + vmdk_path,
+            diskMode=attach_mode, ),
+                        deviceInfo=vim.Description(
+                            # TODO: use docker volume name here. Issue #292
+                            label="dockerDataVolume",
+                            summary="dockerDataVolume", ),
+                        unitNumber=disk_slot,
+                        controllerKey=controller_key, ), )
+
+
+def disk_attach_batch(vmdk_paths, vm):
+    '''
+    Attaches several *existing* disks to a vm using a single VM reconfigure.
+    PVSCSI controllers needed to place the disks are added in the same reconfigure.
+    Returns err(msg) if the reconfigure failed, otherwise a dict
+    {vmdk_path: unit:bus numbers of the attached disk or err(msg)}
+    '''
+    offset_from_bus_number = SCSI_CONTROLLER_KEY_OFFSET
+    vm_devs = vm_devices.VmDevices.retrieve(get_si(), vm)
+    result = {}
+    to_attach = []  # (vmdk_path, attach_mode, kv_status_attached, kv_uuid)
+
+    for vmdk_path in vmdk_paths:
+        kv_status_attached, kv_uuid, attach_mode = getStatusAttached(vmdk_path)
+        if kv_status_attached and kv_uuid != vm_devs.uuid:
+            ret_err = handle_stale_attach(vmdk_path, kv_uuid)
+            if ret_err:
+                result[vmdk_path] = ret_err
+                continue
+        to_attach.append((vmdk_path, attach_mode, kv_status_attached, kv_uuid))
+
+    # Disks already attached are only reported back
+    pending = []
+    for vmdk_path, attach_mode, kv_status_attached, kv_uuid in to_attach:
+        device = findDeviceByPath(vmdk_path, vm, vm_devs)
+        if device:
+            logging.warning("Disk %s already attached. VM=%s",
+                            vmdk_path, vm_devs.uuid)
+            setStatusAttached(vmdk_path, vm_devs)
+            controller = vm_devs.controller(device.controllerKey)
+            result[vmdk_path] = dev_info(device.unitNumber,
+                                         get_controller_pci_slot(vm_devs, controller,
+                                                                 offset_from_bus_number))
+        else:
+            pending.append((vmdk_path, attach_mode, kv_status_attached, kv_uuid))
+
+    if not pending:
+        return result
+
+    # Place disks in memory. Devices to add are recorded in vm_devs as we go,
+    # so the next disk sees the slots (and controllers) taken by previous ones.
+    new_controllers = {}  # temporary (negative) controller key -> bus number
+    dev_changes = []
+    placement = []  # (vmdk_path, controller_key, disk_slot, kv_status_attached, kv_uuid)
+    for vmdk_path, attach_mode, kv_status_attached, kv_uuid in pending:
+        idx, disk_slot = find_available_disk_slot(vm_devs, vm_devs.pvscsi_controllers())
+        if disk_slot is not None:
+            controller_key = vm_devs.pvscsi_controllers()[idx].key
+        else:
+            taken_buses = set([c.busNumber for c in vm_devs.controllers()])
+            avail = set(range(0, MAX_SCSI_CONTROLLERS)) - taken_buses
+            if not avail:
+                msg = "Failed to place new disk - The maximum number of supported volumes has been reached."
+                logging.error(msg + " VM=%s disk=%s", vm_devs.uuid, vmdk_path)
+                result[vmdk_path] = err(msg)
+                continue
+            bus = min(avail)
+            # New devices get temporary negative keys, to be referred to
+            # by other devices within the same reconfigure
+            controller_key = -(bus + offset_from_bus_number)
+            new_controllers[controller_key] = bus
+            controller_spec = pvscsi_controller_spec(controller_key, bus)
+            dev_changes.append(controller_spec)
+            vm_devs.device_added(controller_spec.device)
+            disk_slot = 0  # starting on a fresh controller
+            logging.info("Adding a PVSCSI controller on bus %d", bus)
+        disk_spec = attach_disk_spec(vmdk_path, attach_mode,
+                                     controller_key, disk_slot)
+        dev_changes.append(disk_spec)
+        vm_devs.device_added(disk_spec.device)
+        placement.append((vmdk_path, controller_key, disk_slot,
+                          kv_status_attached, kv_uuid))
+
+    if not placement:
+        return result
+
+    spec = vim.vm.ConfigSpec()
+    spec.deviceChange = dev_changes
+    try:
+        wait_for_tasks(get_si(), [vm.ReconfigVM_Task(spec=spec)])
+    except vim.fault.VimFault as ex:
+        msg = ex.msg
+        # Use metadata (KV) for extra logging
+        for vmdk_path, _, _, kv_status_attached, kv_uuid in placement:
+            if kv_status_attached:
+                msg += " disk {0} already attached to VM={1}".format(vmdk_path,
+                                                                     kv_uuid)
+        return err(msg)
+
+    # PCI slots of new controllers are assigned by hostd, so fetch the
+    # inventory again if we added any. New controllers are matched by bus number.
+    if new_controllers:
+        vm_devs = vm_devices.VmDevices.retrieve(get_si(), vm)
+    for vmdk_path, controller_key, disk_slot, _, _ in placement:
+        if controller_key in new_controllers:
+            controller = vm_devs.controller_by_bus(new_controllers[controller_key])
+        else:
+            controller = vm_devs.controller(controller_key)
+        pci_slot_number = get_controller_pci_slot(vm_devs, controller,
+                                                  offset_from_bus_number)
+        setStatusAttached(vmdk_path, vm_devs)
+        logging.info("Disk %s successfully attached. controller pci_slot_number=%s, disk_slot=%d",
+                     vmdk_path, pci_slot_number, disk_slot)
+        result[vmdk_path] = dev_info(disk_slot, pci_slot_number)
+    return result
+
+
 def err(string):
     return {u'Error': string}
 
 
+def is_error(ret):
+    """Returns True if ret is an err(msg) reply"""
+    return isinstance(ret, dict) and list(ret.keys()) == [u'Error']
+
+
 def disk_detach(vmdk_path, vm):
     """detach disk (by full path) from a vm amd return None or err(msg)"""
 
-    device = findDeviceByPath(vmdk_path, vm)
+    vm_devs = vm_devices.VmDevices.retrieve(get_si(), vm)
+    device = findDeviceByPath(vmdk_path, vm, vm_devs)
 
     if not device:
        # Could happen if the disk attached to a different VM - attach fails
        # and docker will insist to sending "unmount/detach" which also fails.
        msg = "*** Detach failed: disk={0} not found. VM={1}".format(
-       vmdk_path, vm.config.uuid)
+       vmdk_path, vm_devs.uuid)
        logging.warning(msg)
        return err(msg)
 
@@ -990,7 +1289,7 @@ def disk_detach_int(vmdk_path, vm, device):
     spec.deviceChange = dev_changes
 
     try:
-        wait_for_tasks(si, [vm.ReconfigVM_Task(spec=spec)])
+        wait_for_tasks(get_si(), [vm.ReconfigVM_Task(spec=spec)])
     except vim.Fault.VimFault as ex:
         ex_type, ex_value, ex_traceback = sys.exc_info()
         msg = "Failed to detach %s: %s" % (vmdk_path, ex.msg)
@@ -1002,6 +1301,49 @@ def disk_detach_int(vmdk_path, vm, device):
     return None
 
 
+def disk_detach_batch(vmdk_paths, vm):
+    '''
+    Detaches several disks (by full path) from a vm using a single VM reconfigure.
+    Returns err(msg) if the reconfigure failed, otherwise a dict
+    {vmdk_path: None or err(msg)}
+    '''
+    vm_devs = vm_devices.VmDevices.retrieve(get_si(), vm)
+    result = {}
+    dev_changes = []
+    detached = []
+    for vmdk_path in vmdk_paths:
+        device = findDeviceByPath(vmdk_path, vm, vm_devs)
+        if not device:
+            msg = "*** Detach failed: disk={0} not found. VM={1}".format(
+                vmdk_path, vm_devs.uuid)
+            logging.warning(msg)
+            result[vmdk_path] = err(msg)
+            continue
+        disk_spec = vim.vm.device.VirtualDeviceSpec()
+        disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.remove
+        disk_spec.device = device
+        dev_changes.append(disk_spec)
+        detached.append(vmdk_path)
+
+    if not detached:
+        return result
+
+    spec = vim.vm.ConfigSpec()
+    spec.deviceChange = dev_changes
+    try:
+        wait_for_tasks(get_si(), [vm.ReconfigVM_Task(spec=spec)])
+    except vim.fault.VimFault as ex:
+        msg = "Failed to detach %s: %s" % (", ".join(detached), ex.msg)
+        logging.warning(msg)
+        return err(msg)
+
+    for vmdk_path in detached:
+        setStatusDetached(vmdk_path)
+        logging.info("Disk detached %s", vmdk_path)
+        result[vmdk_path] = None
+    return result
+
+
 # Edit settings for a volume identified by its full path
 def set_vol_opts(name, options):
     # Create a dict of the options, the options are provided as
@@ -1061,13 +1403,13 @@ def set_vol_opts(name, options):
     if has_invalid_opt_value:
         return False   
     
-    vol_meta = kv.getAll(vmdk_path)
-    if vol_meta:
-       if not vol_meta[kv.VOL_OPTS]:
-           vol_meta[kv.VOL_OPTS] = {} 
-       for key in opts.keys():
-           vol_meta[kv.VOL_OPTS][key] = opts[key]
-       return kv.setAll(vmdk_path, vol_meta)
+    with vol_locks.lock(vol_lock_key(vmdk_path)):
+        vol_meta, version = kv.load(vmdk_path)
+        if vol_meta:
+           vol_opts = vol_meta[kv.VOL_OPTS] or {}
+           vol_opts.update(opts)
+           return kv.update(vmdk_path, {kv.VOL_OPTS: vol_opts},
+                            version) is not None
 
     return False
 
@@ -1075,6 +1417,16 @@ def signal_handler_stop(signalnum, frame):
     logging.warn("Received signal num: ' %d '", signalnum)
     sys.exit(0)
 
+class VmciStats(Structure):
+   """ VMCI accept queue counters. Must be kept in sync with vmci_stats in vmci_server.c """
+   _fields_ = [('accepted', c_uint64),
+               ('rejected', c_uint64),
+               ('accept_errors', c_uint64),
+               ('queued', c_uint64),
+               ('accept_wait_usec', c_uint64),
+               ('recv_usec', c_uint64),
+               ('max_recv_usec', c_uint64)]
+
 def load_vmci():
    global lib
 
@@ -1084,8 +1436,98 @@ def load_vmci():
    else:
        lib = CDLL(os.path.join(LIB_LOC, "libvmci_srv.so"), use_errno=True)
 
+   lib.vmci_init.argtypes = [c_uint, c_int]
+   lib.vmci_init.restype = c_int
+   lib.vmci_get_stats.argtypes = [POINTER(VmciStats)]
+   lib.vmci_get_stats.restype = None
+
+def get_vmci_stats():
+    """ Returns VMCI accept queue counters as a dict """
+    stats = VmciStats()
+    lib.vmci_get_stats(byref(stats))
+    return dict((name, getattr(stats, name)) for name, _ in VmciStats._fields_)
+
+def log_service_stats(pool):
+    """
+    Logs VMCI accept queue counters (used to size the listen backlog),
+    volume lock waits, VM and meta-data cache hits and task waiter counters.
+    """
+    stats = get_vmci_stats()
+    accepted = max(stats['accepted'], 1)
+    logging.info("VMCI stats: accepted=%d rejected=%d accept_errors=%d "
+                 "found_queued=%d avg_accept_wait_ms=%.2f avg_recv_ms=%.2f "
+                 "max_recv_ms=%.2f requests_pending=%d",
+                 stats['accepted'], stats['rejected'], stats['accept_errors'],
+                 stats['queued'], stats['accept_wait_usec'] / 1000.0 / accepted,
+                 stats['recv_usec'] / 1000.0 / accepted,
+                 stats['max_recv_usec'] / 1000.0,
+                 pool.pending() if pool else 0)
+    logging.info("Lock stats: %s", vol_locks.stats())
+    if vol_pools:
+        logging.info("Volume pool stats: %s", vol_pools.stats())
+    if vol_reclaimer:
+        logging.info("Volume reclaim stats: %s", vol_reclaimer.stats())
+    logging.info("Command helper stats: %s", tool_runner.stats())
+    logging.info("VM cache stats: %s", vm_objects.stats())
+    logging.info("Task waiter stats: %s", task_dispatcher.stats())
+    logging.info("hostd session stats: %s", host_session.session.stats())
+    logging.info("Volume meta-data cache stats: %s", kv.cache_stats())
+    logging.info("Volume size cache stats: %s", kv.size_cache_stats())
+
+def execRequestThread(client_socket, cartel, request):
+    '''
+    Execute a single (already received) request and reply on client_socket.
+    Runs either inline in the VMCI loop or in a worker thread, see handleVmciRequests.
+    '''
+    VMCI_ERROR = -1 # VMCI C code uses '-1' to indicate failures
+
+    try:
+        # Get VM name & ID from VSI (we only get cartelID from vmci, need to convert)
+        vmm_leader = vsi.get("/userworld/cartel/%s/vmmLeader" % str(cartel))
+        group_info = vsi.get("/vm/%s/vmmGroupInfo" % vmm_leader)
+
+        vm_name = group_info["displayName"]
+        cfg_path = group_info["cfgPath"]
+        uuid = group_info["uuid"]
+        # pyVmomi expects uuid like this one: 564dac12-b1a0-f735-0df3-bceb00b30340
+        # to get it from uuid in VSI vms/<id>/vmmGroup, we use the following format:
+        UUID_FORMAT = "{0}{1}{2}{3}-{4}{5}-{6}{7}-{8}{9}-{10}{11}{12}{13}{14}{15}"
+        vm_uuid = UUID_FORMAT.format(*uuid.replace("-",  " ").split())
+
+        try:
+            req = json.loads(request.decode('utf-8'))
+        except ValueError as e:
+            ret = {u'Error': "Failed to parse json '%s'." % request}
+        else:
+            details = req["details"]
+            opts = details["Opts"] if "Opts" in details else {}
+            threading.currentThread().setName(vm_name)
+            ret = executeRequest(vm_uuid=vm_uuid,
+                                 vm_name=vm_name,
+                                 config_path=cfg_path,
+                                 cmd=req["cmd"],
+                                 full_vol_name=details["Name"],
+                                 opts=opts)
+            logging.info("executeRequest '%s' completed with ret=%s",
+                         req["cmd"], ret)
+    except Exception as ex:
+        # Never leave the client without a reply
+        logging.exception("Failed to execute request '%s'", request)
+        ret = err("Internal error: {0}".format(str(ex)))
+
+    ret_string = json.dumps(ret)
+    response = lib.vmci_reply(client_socket, c_char_p(ret_string.encode()))
+    errno = get_errno()
+    logging.debug("lib.vmci_reply: VMCI replied with errcode %s", response)
+    if response == VMCI_ERROR:
+        logging.warning("vmci_reply returned error %s (errno=%d)",
+                        os.strerror(errno), errno)
+
 # load VMCI shared lib , listen on vSocket in main loop, handle requests
-def handleVmciRequests(port):
+# If workers > 1, requests are handed over to a pool of worker threads and
+# the reply is sent from the worker, so a slow request does not block the others.
+# The listening socket is created once, with room for <backlog> pending connections.
+def handleVmciRequests(port, workers=DEFAULT_WORKERS, backlog=DEFAULT_BACKLOG):
     VMCI_ERROR = -1 # VMCI C code uses '-1' to indicate failures
     ECONNABORTED = 103 # Error on non privileged client
 
@@ -1093,13 +1535,21 @@ def handleVmciRequests(port):
     txt = create_string_buffer(bsize)
 
     cartel = c_int32()
-    sock = lib.vmci_init(c_uint(port))
+    sock = lib.vmci_init(c_uint(port), c_int(backlog))
     if sock == VMCI_ERROR:
         errno = get_errno()
         raise OSError("Failed to initialize vSocket listener: %s (errno=%d)" \
                         %  (os.strerror(errno), errno))
+    logging.info("Listening on vSocket port %d, backlog %d", port, backlog)
+
+    pool = None
+    if workers > 1:
+        pool = threadutils.WorkerPool("req", workers)
+    else:
+        logging.info("Executing requests serially")
 
     skip_count = MAX_SKIP_COUNT  # retries for vmci_get_one_op failures
+    op_count = 0
     while True:
         c = lib.vmci_get_one_op(sock, byref(cartel), txt, c_int(bsize))
         logging.debug("lib.vmci_get_one_op returns %d, buffer '%s'",
@@ -1121,57 +1571,42 @@ def handleVmciRequests(port):
         else:
             skip_count = MAX_SKIP_COUNT  # reset the counter, just in case
 
-        # Get VM name & ID from VSI (we only get cartelID from vmci, need to convert)
-        vmm_leader = vsi.get("/userworld/cartel/%s/vmmLeader" %
-                            str(cartel.value))
-        group_info = vsi.get("/vm/%s/vmmGroupInfo" % vmm_leader)
-
-        vm_name = group_info["displayName"]
-        cfg_path = group_info["cfgPath"]
-        uuid = group_info["uuid"]
-        # pyVmomi expects uuid like this one: 564dac12-b1a0-f735-0df3-bceb00b30340
-        # to get it from uuid in VSI vms/<id>/vmmGroup, we use the following format:
-        UUID_FORMAT = "{0}{1}{2}{3}-{4}{5}-{6}{7}-{8}{9}-{10}{11}{12}{13}{14}{15}"
-        vm_uuid = UUID_FORMAT.format(*uuid.replace("-",  " ").split())
+        op_count += 1
+        if op_count % STATS_LOG_INTERVAL == 0:
+            log_service_stats(pool)
 
-        try:
-            req = json.loads(txt.value.decode('utf-8'))
-        except ValueError as e:
-            ret = {u'Error': "Failed to parse json '%s'." % txt.value}
+        # txt buffer is reused by the next vmci_get_one_op, so pass a copy along
+        if pool:
+            pool.submit(execRequestThread, c, cartel.value, txt.value)
         else:
-            details = req["details"]
-            opts = details["Opts"] if "Opts" in details else {}
-            threading.currentThread().setName(vm_name)
-            ret = executeRequest(vm_uuid=vm_uuid,
-                                 vm_name=vm_name,
-                                 config_path=cfg_path,
-                                 cmd=req["cmd"],
-                                 full_vol_name=details["Name"],
-                                 opts=opts)
-            logging.info("executeRequest '%s' completed with ret=%s",
-                         req["cmd"], ret)
-
-        ret_string = json.dumps(ret)
-        response = lib.vmci_reply(c, c_char_p(ret_string.encode()))
-        errno = get_errno()
-        logging.debug("lib.vmci_reply: VMCI replied with errcode %s", response)
-        if response == VMCI_ERROR:
-            logging.warning("vmci_reply returned error %s (errno=%d)",
-                            os.strerror(errno), errno)
+            execRequestThread(c, cartel.value, txt.value)
 
-    lib.close(sock)  # close listening socket when the loop is over
+    lib.vmci_close(sock)  # close listening socket when the loop is over
 
 def usage():
-    print("Usage: %s -p <vSocket Port to listen on>" % sys.argv[0])
+    print("Usage: %s -p <vSocket Port to listen on> "
+          "[-w <number of requests to execute in parallel>] "
+          "[-b <max number of pending connections>] "
+          "[-P <pre-created volumes to keep per datastore>] "
+          "[-V (verify disk backing on create)] "
+          "[-R (delete removed volumes in the background)]" % sys.argv[0])
 
 def main():
+    global vol_pools
+    global vol_reclaimer
+    global verify_create
+    global tool_runner_started
     log_config.configure()
     logging.info("=== Starting vmdkops service ====")
     signal.signal(signal.SIGINT, signal_handler_stop)
     signal.signal(signal.SIGTERM, signal_handler_stop)
     try:
         port = 1019
-        opts, args = getopt.getopt(sys.argv[1:], 'hp:')
+        workers = DEFAULT_WORKERS
+        backlog = DEFAULT_BACKLOG
+        pool_depth = 0
+        reclaim = False
+        opts, args = getopt.getopt(sys.argv[1:], 'hp:w:b:P:VR')
     except getopt.error as msg:
         if msg:
            logging.exception(msg)
@@ -1180,17 +1615,42 @@ def main():
     for a, v in opts:
         if a == '-p':
             port = int(v)
+        if a == '-w':
+            workers = int(v)
+        if a == '-b':
+            backlog = int(v)
+        if a == '-P':
+            pool_depth = int(v)
+        if a == '-V':
+            verify_create = True
+        if a == '-R':
+            reclaim = True
         if a == '-h':
             usage()
             return 0
 
     try:
+        # Start helpers first, so they are forked from a small process
+        tool_runner.start()
+        tool_runner_started = True
+
         # Load and use DLL with vsocket shim to listen for docker requests
         load_vmci()
 
         kv.init()
-        connectLocal()
-        handleVmciRequests(port)
+        host_session.session.get()
+        host_session.session.start_keepalive()
+        vm_objects.start()
+        task_dispatcher.start()
+        if pool_depth > 0:
+            vol_pools = vol_pool.VolumePools(pool_depth, create_pool_disk,
+                                             move_disk)
+            vol_pools.start()
+        if reclaim:
+            vol_reclaimer = vol_trash.VolumeReclaimer(get_dockvols, move_disk,
+                                                      delete_disk)
+            vol_reclaimer.start()
+        handleVmciRequests(port, workers, backlog)
     except Exception as e:
         logging.exception(e)
 
@@ -1229,6 +1689,10 @@ def wait_for_tasks(service_instance, tasks):
     """Given the service instance si and tasks, it returns after all the
    tasks are complete
    """
+    if task_dispatcher.wait(tasks):
+        return
+
+    # Task dispatcher is not running (yet), watch the tasks with our own filter
     task_list = [str(task) for task in tasks]
     property_collector = service_instance.content.propertyCollector
     try:
@@ -1236,8 +1700,8 @@ def wait_for_tasks(service_instance, tasks):
     except vim.fault.NotAuthenticated:
         # Reconnect and retry
         logging.warning("Reconnecting and retry")
-        connectLocal()
-        property_collector = si.content.propertyCollector
+        service_instance = host_session.session.reconnect(service_instance)
+        property_collector = service_instance.content.propertyCollector
         pcfilter = getTaskList(property_collector, tasks)
 
     try:
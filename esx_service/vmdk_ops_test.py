@@ -23,6 +23,7 @@ import logging
 import glob
 import os
 import os.path
+import time
 
 import vmdk_ops
 import log_config
@@ -30,6 +31,8 @@ import volume_kv
 import vsan_policy
 import vsan_info
 import vmdk_utils
+import vm_cache
+import kvESX
 from pyVim import connect
 from pyVmomi import vim
 
@@ -117,6 +120,73 @@ class VmdkCreateRemoveTestCase(unittest.TestCase):
             os.path.isfile(self.name), False,
             "VMDK {0} is still present after delete.".format(self.name))
 
+    def testMetaCache(self):
+        err = vmdk_ops.createVMDK(vm_name=self.vm_name,
+                                  vmdk_path=self.name,
+                                  vol_name=self.volName)
+        self.assertEqual(err, None, err)
+
+        vol_meta = volume_kv.getAll(self.name)
+        hits = volume_kv.cache_stats()['hits']
+        self.assertEqual(volume_kv.getAll(self.name), vol_meta)
+        self.assertEqual(volume_kv.cache_stats()['hits'], hits + 1)
+
+        # writes through volume_kv are seen without re-reading the side car
+        self.assertTrue(volume_kv.set_kv(self.name, volume_kv.STATUS,
+                                         volume_kv.ATTACHED))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS),
+                         volume_kv.ATTACHED)
+
+        # writes bypassing the cache (e.g. from another process) are noticed
+        time.sleep(1)
+        vol_meta[volume_kv.STATUS] = volume_kv.DETACHED
+        vol_meta[volume_kv.CREATED_BY] = 'other-vm'
+        self.assertTrue(kvESX.save(self.name, vol_meta))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.CREATED_BY),
+                         'other-vm')
+
+    def testMetaVersion(self):
+        err = vmdk_ops.createVMDK(vm_name=self.vm_name,
+                                  vmdk_path=self.name,
+                                  vol_name=self.volName)
+        self.assertEqual(err, None, err)
+
+        meta_file = kvESX.get_meta_file(self.name)
+        vol_meta, version = kvESX.read_meta_file(meta_file)
+        self.assertNotEqual(vol_meta, None)
+        self.assertEqual(kvESX.save(self.name, vol_meta), version + 1)
+        self.assertEqual(kvESX.read_meta_file(meta_file), (vol_meta, version + 1))
+
+        # damaged meta-data is detected
+        with open(meta_file, "r") as fh:
+            content = fh.read()
+        with open(meta_file, "w") as fh:
+            fh.write(content.replace(self.vm_name, self.vm_name[::-1]))
+        self.assertEqual(kvESX.read_meta_file(meta_file), (None, None))
+
+    def testMetaUpdate(self):
+        err = vmdk_ops.createVMDK(vm_name=self.vm_name,
+                                  vmdk_path=self.name,
+                                  vol_name=self.volName)
+        self.assertEqual(err, None, err)
+
+        _, version = volume_kv.load(self.name)
+        changes = {volume_kv.STATUS: volume_kv.ATTACHED,
+                   volume_kv.ATTACHED_VM_UUID: 'uuid'}
+        new_version = volume_kv.update(self.name, changes, version)
+        self.assertEqual(new_version, version + 1)
+        # no changes, no write
+        self.assertEqual(volume_kv.update(self.name, changes), new_version)
+        # stale version is refused
+        self.assertEqual(volume_kv.update(self.name, {volume_kv.STATUS: volume_kv.DETACHED},
+                                          version), None)
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.STATUS), volume_kv.ATTACHED)
+
+        self.assertEqual(volume_kv.update(self.name,
+                                          {volume_kv.ATTACHED_VM_UUID: volume_kv.DELETE}),
+                         new_version + 1)
+        self.assertFalse(volume_kv.ATTACHED_VM_UUID in volume_kv.getAll(self.name))
+
     def testBadOpts(self):
         err = vmdk_ops.createVMDK(vm_name=self.vm_name,
                                   vmdk_path=self.name,
@@ -284,7 +354,41 @@ class ValidationTestCase(unittest.TestCase):
             with self.assertRaises(vmdk_ops.ValidationError):
                 vmdk_ops.validate_opts(opts, self.path)
 
+
+class VmCacheTestCase(unittest.TestCase):
+    """ Test VM managed object cache """
+
+    def testCacheLoad(self):
+        cache = vm_cache.VmCache(vmdk_ops.get_si)
+        cache.start()
+        for _ in range(30):
+            if cache.stats()['ready']:
+                break
+            time.sleep(1)
+        self.assertTrue(cache.stats()['ready'], "VM cache failed to load")
+
+        for vm in vmdk_ops.get_si().content.rootFolder.childEntity[0].vmFolder.childEntity:
+            if not isinstance(vm, vim.VirtualMachine) or not vm.config:
+                continue
+            self.assertEqual(cache.get(vm.config.uuid), vm)
+        self.assertEqual(cache.stats()['misses'], 0)
+        self.assertEqual(cache.get("00000000-0000-0000-0000-000000000000"), None)
+
     
+class DatastoreRegistryTestCase(unittest.TestCase):
+    """ Test datastore lookups """
+
+    def testFind(self):
+        datastores = vmdk_utils.get_datastores()
+        self.assertTrue(len(datastores) > 0)
+        for ds in datastores:
+            self.assertEqual(vmdk_utils.get_datastore(ds[0]), ds)
+            self.assertEqual(vmdk_utils.get_datastore(ds[1]), ds)
+            self.assertTrue(vmdk_ops.is_known_datastore(ds[0]))
+        self.assertEqual(vmdk_utils.get_datastore("NoSuchDatastore"), None)
+        self.assertFalse(vmdk_ops.is_known_datastore("NoSuchDatastore"))
+
+
 class VmdkAttachDetachTestCase(unittest.TestCase):
     """ Unit test for VMDK Attach and Detach ops """
 
@@ -311,10 +415,7 @@ class VmdkAttachDetachTestCase(unittest.TestCase):
                                                                  self.datastore_path)   
         
         # get service_instance, and create a VM
-        if not vmdk_ops.si:
-            vmdk_ops.connectLocal()
-
-        self.create_vm(vmdk_ops.si, self.vm_name, self.datastore_name)
+        self.create_vm(vmdk_ops.get_si(), self.vm_name, self.datastore_name)
 
         # create max_vol_count+1 VMDK files
         for id in range(1, self.max_vol_count+2):
@@ -388,9 +489,7 @@ class VmdkAttachDetachTestCase(unittest.TestCase):
     
     def cleanup(self):
         # remove VM
-        if not vmdk_ops.si:
-            vmdk_ops.connectLocal()
-        self.remove_vm(vmdk_ops.si, self.vm_name)
+        self.remove_vm(vmdk_ops.get_si(), self.vm_name)
 
         for v in self.get_testvols():
             self.assertEqual(
@@ -405,11 +504,8 @@ class VmdkAttachDetachTestCase(unittest.TestCase):
     
     def testAttachDetach(self):
         logging.debug("Start VMDKAttachDetachTest")
-
-        if not vmdk_ops.si:
-            vmdk_ops.connectLocal()
         #find test_vm
-        vm = [d for d in vmdk_ops.si.content.rootFolder.childEntity[0].vmFolder.childEntity 
+        vm = [d for d in vmdk_ops.get_si().content.rootFolder.childEntity[0].vmFolder.childEntity 
               if d.config.name == self.vm_name]
         self.assertNotEqual(None, vm)
 
@@ -435,6 +531,62 @@ class VmdkAttachDetachTestCase(unittest.TestCase):
             ret = vmdk_ops.disk_detach(vmdk_path=fullpath,
                                        vm=vm[0])
             self.assertTrue(ret is None)
+
+    def testAttachDetachBatch(self):
+        logging.debug("Start VMDKAttachDetachBatchTest")
+        #find test_vm
+        vm = [d for d in vmdk_ops.get_si().content.rootFolder.childEntity[0].vmFolder.childEntity 
+              if d.config.name == self.vm_name]
+        self.assertNotEqual(None, vm)
+
+        # attach enough disks at once to need more than one PVSCSI controller
+        batch_count = 20
+        paths = [os.path.join(self.datastore_path,
+                              'VmdkAttachDetachTestVol' + str(id) + '.vmdk')
+                 for id in range(1, batch_count + 1)]
+        ret = vmdk_ops.disk_attach_batch(vmdk_paths=paths, vm=vm[0])
+        self.assertFalse(vmdk_ops.is_error(ret), ret)
+        self.assertEqual(sorted(ret.keys()), sorted(paths))
+        for p in paths:
+            self.assertFalse("Error" in ret[p], ret[p])
+        # all disks are placed in unique slots
+        slots = set([(ret[p]['ControllerPciSlotNumber'], ret[p]['Unit']) for p in paths])
+        self.assertEqual(len(slots), batch_count)
+
+        # attaching again just reports the disks as attached
+        ret = vmdk_ops.disk_attach_batch(vmdk_paths=paths[:2], vm=vm[0])
+        for p in paths[:2]:
+            self.assertFalse("Error" in ret[p], ret[p])
+
+        ret = vmdk_ops.disk_detach_batch(vmdk_paths=paths, vm=vm[0])
+        self.assertFalse(vmdk_ops.is_error(ret), ret)
+        for p in paths:
+            self.assertTrue(ret[p] is None)
+
+    def testAttachDetachTaskWaiter(self):
+        logging.debug("Start VMDKAttachDetachTaskWaiterTest")
+        vmdk_ops.task_dispatcher.start()
+        for _ in range(30):
+            if vmdk_ops.task_dispatcher.stats()['ready']:
+                break
+            time.sleep(1)
+        self.assertTrue(vmdk_ops.task_dispatcher.stats()['ready'],
+                        "Task waiter failed to start")
+        #find test_vm
+        vm = [d for d in vmdk_ops.get_si().content.rootFolder.childEntity[0].vmFolder.childEntity 
+              if d.config.name == self.vm_name]
+        self.assertNotEqual(None, vm)
+
+        # reconfigure tasks complete through the dispatcher, not own filters
+        stats = vmdk_ops.task_dispatcher.stats()
+        fullpath = os.path.join(self.datastore_path, 'VmdkAttachDetachTestVol1.vmdk')
+        ret = vmdk_ops.disk_attach(vmdk_path=fullpath, vm=vm[0])
+        self.assertFalse("Error" in ret)
+        ret = vmdk_ops.disk_detach(vmdk_path=fullpath, vm=vm[0])
+        self.assertTrue(ret is None)
+        new_stats = vmdk_ops.task_dispatcher.stats()
+        self.assertEqual(new_stats['fallbacks'], stats['fallbacks'])
+        self.assertTrue(new_stats['completed'] >= stats['completed'] + 2)
         
                                                   
     
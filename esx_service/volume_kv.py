@@ -18,8 +18,38 @@
 ## module exposes a set of functions that allow creat/delete/get/set
 ## on the kv store. Currently uses side cars to keep KV pairs for
 ## a given volume.
+##
+## Side cars are accessed through a backend module selected by init():
+## kvESX (DiskLib side cars, the default) or kvLocal (files in a local
+## directory, to run and measure this code off ESX). A backend provides
+## init, create, delete, save, load, get_info, get_meta_file,
+## read_meta_file and disk_open.
+##
+## Parsed meta-data is cached in memory (see MetaCache), so repeated reads
+## of the same volume do not go to the datastore. Meta-data of all volumes in
+## a dockvols folder is also kept in a per folder index (see vol_index.py),
+## used to list volumes.
+
+import copy
+import fcntl
+import logging
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import kvESX
+import kvLocal
+import threadutils
+import vmdk_utils
+import vol_index
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # All possible metadata keys for the volume. New keys should be added here as
 # constants pointing to strings.
@@ -84,17 +114,210 @@ ACCESS_TYPES = [ACCESS_READWRITE, ACCESS_READONLY]
 FILESYSTEM_TYPE = 'fstype'
 DEFAULT_FILESYSTEM_TYPE = ''
 
+# Max number of volumes with meta-data cached in memory
+META_CACHE_SIZE = 1024
+
+# Keys of get_vol_info() result, sizes in bytes
+VOL_SIZE = kvESX.VOL_SIZE
+VOL_ALLOC = kvESX.VOL_ALLOC
+
+# Max number of volumes with size info cached in memory
+SIZE_CACHE_SIZE = 1024
+
+# Threads reading side cars in get_many(). Side car reads wait on datastore
+# I/O (especially on VSAN), not CPU.
+BULK_LOAD_WORKERS = 8
+
+# Value in update() changes removing the key
+DELETE = object()
+
+# Side car backends, see init()
+ESX_BACKEND = 'esx'
+LOCAL_BACKEND = 'local'
+BACKENDS = {ESX_BACKEND: kvESX, LOCAL_BACKEND: kvLocal}
+
+# Backend in use
+backend = kvESX
+
+
+def file_signature(path):
+    """
+    Return (inode, size, mtime) of the file at path, or None if it can't be
+    accessed. Used to notice side car changes made by other processes
+    (e.g. vmdkops_admin).
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+class MetaCache(object):
+    """
+    LRU cache of parsed volume meta-data, keyed by vmdk path.
+    An entry is used only while the side car file signature is unchanged, so
+    writes from other processes are picked up on the next read. Writes from
+    this process go through setAll() and update the entry.
+    """
+
+    def __init__(self, size=META_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        # vol_path -> (meta_file, signature, meta, version)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, vol_path):
+        """
+        Return (copy of the cached meta-data, version),
+        or (None, None) if not cached or not valid.
+        """
+        with self._lock:
+            entry = self._entries.pop(vol_path, None)
+            if entry:
+                self._entries[vol_path] = entry  # most recently used
+        if entry and file_signature(entry[0]) == entry[1]:
+            with self._lock:
+                self.hits += 1
+            return copy.deepcopy(entry[2]), entry[3]
+        with self._lock:
+            self.misses += 1
+        return None, None
+
+    def put(self, vol_path, meta_file, signature, vol_meta, version):
+        """ Cache vol_meta as read from (or written to) meta_file """
+        if not signature:
+            self.invalidate(vol_path)
+            return
+        with self._lock:
+            self._entries.pop(vol_path, None)
+            self._entries[vol_path] = (meta_file, signature,
+                                       copy.deepcopy(vol_meta), version)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, vol_path):
+        with self._lock:
+            self._entries.pop(vol_path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'volumes': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+meta_cache = MetaCache()
+
+
+def disk_signature(vol_path):
+    """
+    Return signatures of the descriptor and flat files of vol_path, which
+    change when the disk is written or resized.
+    """
+    flat_path = "{0}-flat.vmdk".format(os.path.splitext(vol_path)[0])
+    return (file_signature(vol_path), file_signature(flat_path))
+
+
+class SizeCache(object):
+    """
+    LRU cache of volume size info, keyed by vmdk path and valid while the
+    disk signature (see disk_signature()) is unchanged.
+    """
+
+    def __init__(self, size=SIZE_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        # vol_path -> (signature, size info)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, vol_path, signature):
+        """ Return a copy of cached size info, or None """
+        with self._lock:
+            entry = self._entries.pop(vol_path, None)
+            if entry and entry[0] == signature:
+                self._entries[vol_path] = entry
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+            return None
+
+    def put(self, vol_path, signature, size_info):
+        with self._lock:
+            self._entries.pop(vol_path, None)
+            self._entries[vol_path] = (signature, dict(size_info))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'volumes': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+size_cache = SizeCache()
+
+# Serializes read-modify-write of the same volume meta-data, see meta_lock()
+update_locks = threadutils.LockManager("kv")
+
+# Lock file in each dockvols folder. A process holds a one byte lock in it,
+# at an offset given by the volume name, while updating a volume side car.
+META_LOCK_FILE = os.path.join(vol_index.INDEX_DIR, "meta.lock")
+META_LOCK_RANGE = 1 << 24
+
+# Open lock files, {dockvols path: file}. They are never closed, as closing
+# any descriptor of a file drops all locks the process has on that file.
+_lock_files = {}
+_lock_files_lock = threading.Lock()
+
+# Meta-data locks held by the current thread, {lock key: depth}
+_held = threading.local()
+
+
 # Create a kv store object for this volume identified by vol_path
 # Create the side car or open if it exists.
-def init():
-    kvESX.kv_esx_init()
-
-def create(vol_path, vol_meta):
+def init(backend_name=ESX_BACKEND):
+    global backend
+    backend = BACKENDS[backend_name]
+    meta_cache.clear()
+    size_cache.clear()
+    backend.init()
+
+def create(vol_path, vol_meta, indexed=True):
     """
-    Create a side car KV store for given vol_path.
+    Create a side car KV store for given vol_path, and record the volume in
+    the volume index unless indexed is False (volumes outside dockvols).
     Return true if successful, false otherwise
     """
-    return kvESX.create(vol_path, vol_meta)
+    meta_cache.invalidate(vol_path)
+    res = backend.create(vol_path, vol_meta)
+    if res and indexed:
+        index_changed(vol_path, vol_meta,
+                      file_signature(backend.get_meta_file(vol_path)))
+    return res
+
+
+def disk_open(vol_path):
+    """
+    Context manager keeping the volume disk open, so that meta-data and size
+    operations within it share one disk open. Usage:
+        with disk_open(vol_path):
+            create(vol_path, vol_meta)
+    """
+    return backend.disk_open(vol_path)
 
 
 def delete(vol_path):
@@ -102,7 +325,28 @@ def delete(vol_path):
     Delete a kv store object for this volume identified by vol_path.
     Return true if successful, false otherwise
     """
-    return kvESX.delete(vol_path)
+    meta_cache.invalidate(vol_path)
+    # Volume index is refreshed, since dockvols changes
+    return backend.delete(vol_path)
+
+
+def load(vol_path):
+    """
+    Return (meta-data, version) for the given vol_path,
+    or (None, None) on failure.
+    """
+    vol_meta, version = meta_cache.get(vol_path)
+    if vol_meta is not None:
+        return vol_meta, version
+
+    meta_file = backend.get_meta_file(vol_path)
+    # Take the signature before reading, so a concurrent write is not
+    # hidden behind a signature of the newer file
+    signature = file_signature(meta_file)
+    vol_meta, version = backend.read_meta_file(meta_file)
+    if vol_meta is not None:
+        meta_cache.put(vol_path, meta_file, signature, vol_meta, version)
+    return vol_meta, version
 
 
 def getAll(vol_path):
@@ -110,7 +354,8 @@ def getAll(vol_path):
     Return the entire meta-data for the given vol_path.
     Return true if successful, false otherwise
     """
-    return kvESX.load(vol_path)
+    vol_meta, _ = load(vol_path)
+    return vol_meta
 
 
 def setAll(vol_path, vol_meta):
@@ -118,29 +363,261 @@ def setAll(vol_path, vol_meta):
     Store the meta-data for a given vol-path
     Return true if successful, false otherwise
     """
-    if vol_meta:
-        return kvESX.save(vol_path, vol_meta)
-    # No data to save
-    return True
+    if not vol_meta:
+        # No data to save
+        return True
+
+    with meta_lock(vol_path):
+        _, version = meta_cache.get(vol_path)
+        if version is not None:
+            version += 1  # otherwise the backend takes the next one from the side car
+        return save(vol_path, vol_meta, version) is not None
+
+
+def save(vol_path, vol_meta, version):
+    """
+    Store the meta-data as the given version (None for the next one)
+    Return the saved version, or None on failure
+    """
+    # The lock keeps the signature taken below that of our own write
+    with meta_lock(vol_path):
+        version = backend.save(vol_path, vol_meta, version)
+        if not version:
+            meta_cache.invalidate(vol_path)
+            return None
+        meta_file = backend.get_meta_file(vol_path)
+        signature = file_signature(meta_file)
+        meta_cache.put(vol_path, meta_file, signature, vol_meta, version)
+        index_changed(vol_path, vol_meta, signature)
+    return version
+
+
+def meta_lock_file(dockvols_path):
+    """ Return the open meta-data lock file of dockvols_path, or None """
+    with _lock_files_lock:
+        fh = _lock_files.get(dockvols_path)
+        if fh:
+            return fh
+        lock_path = os.path.join(dockvols_path, META_LOCK_FILE)
+        try:
+            if not os.path.isdir(os.path.dirname(lock_path)):
+                os.makedirs(os.path.dirname(lock_path))
+            fh = open(lock_path, "a")
+        except (IOError, OSError) as ex:
+            # dockvols may be read-only; threads are still serialized
+            logging.debug("Failed to open %s: %s", lock_path, ex)
+            return None
+        _lock_files[dockvols_path] = fh
+        return fh
+
+
+@contextmanager
+def meta_lock(vol_path):
+    """
+    Context manager serializing read-modify-write of vol_path meta-data
+    between threads and, with a lock in the dockvols lock file, between
+    processes (e.g. vmdkops_admin). Reentrant.
+    """
+    # dockvols is reached by datastore name and by URL, which must share
+    # the locks (and the lock file descriptor, see _lock_files)
+    dockvols_path = os.path.realpath(os.path.dirname(vol_path))
+    name = index_name(vol_path)
+    offset = zlib.crc32(name.encode('utf-8')) % META_LOCK_RANGE
+    # Volumes sharing an offset share the lock, as a process can't hold
+    # the same byte twice
+    key = (dockvols_path, offset)
+    held = _held.__dict__.setdefault('depth', {})
+    with update_locks.lock(key):
+        if held.get(key):
+            held[key] += 1
+            try:
+                yield
+            finally:
+                held[key] -= 1
+            return
+
+        fh = meta_lock_file(dockvols_path)
+        if fh:
+            fcntl.lockf(fh, fcntl.LOCK_EX, 1, offset)
+        held[key] = 1
+        try:
+            yield
+        finally:
+            del held[key]
+            if fh:
+                fcntl.lockf(fh, fcntl.LOCK_UN, 1, offset)
+
+
+def update(vol_path, changes, expected_version=None):
+    """
+    Apply changes {key: value} to the meta-data for a given vol_path.
+    A DELETE value removes the key. If expected_version is passed, changes
+    are applied only if the meta-data is still at that version.
+    Read and write are done under meta_lock(), so concurrent updates from
+    this and other processes are not lost.
+    The side car is not written if the changes do not modify anything.
+    Return the (new) meta-data version, or None on failure or version mismatch.
+    """
+    with meta_lock(vol_path):
+        vol_meta, version = load(vol_path)
+        if vol_meta is None:
+            if expected_version is not None:
+                return None
+            logging.warning("Failed to read meta-data for %s, starting "
+                            "from empty meta-data", vol_path)
+            vol_meta, version = {}, 0
+        elif expected_version is not None and version != expected_version:
+            logging.warning("Meta-data for %s changed (version %s, expected %s)",
+                            vol_path, version, expected_version)
+            return None
+
+        new_meta = dict(vol_meta)
+        for key, val in changes.items():
+            if val is DELETE:
+                new_meta.pop(key, None)
+            else:
+                new_meta[key] = val
+        if new_meta == vol_meta:
+            return version
+
+        return save(vol_path, new_meta, version + 1)
+
+
+def index_name(vol_path):
+    """
+    Return volume index key for vol_path: vmdk file name of the volume,
+    i.e. without snapshot (delta disk) suffix
+    """
+    return re.sub(vmdk_utils.SNAP_SUFFIX_REGEXP, ".vmdk",
+                  os.path.basename(vol_path))
+
+
+def index_changed(vol_path, vol_meta, signature):
+    """
+    Record new meta-data of vol_path in the volume index.
+    signature is that of the side car just written.
+    """
+    index = vol_index.VolumeIndex(os.path.dirname(vol_path))
+    index.apply({index_name(vol_path): (vol_meta, signature)})
+
+
+@contextmanager
+def index_update(vol_path):
+    """
+    Context manager for removal of a volume from the volume index.
+    Yields a dict to be set as {vol_path: None} once the volume is removed;
+    leave it empty if nothing changed. No lock is held meanwhile.
+    """
+    index = vol_index.VolumeIndex(os.path.dirname(vol_path))
+    with index.update() as index_changes:
+        changes = {}
+        yield changes
+        for path, vol_meta in changes.items():
+            index_changes[index_name(path)] = vol_meta
+
+
+def list_volumes(dockvols_path):
+    """
+    Return {vmdk file name: meta-data} for volumes in dockvols_path.
+    Meta-data is None for volumes with unreadable meta-data.
+    """
+    if not os.path.isdir(dockvols_path):
+        return {}
+
+    index = vol_index.VolumeIndex(dockvols_path)
+    volumes = index.read()
+    if volumes is None:
+        logging.debug("Refreshing volume index for %s", dockvols_path)
+        volumes = index.refresh(lambda: scan_dir(dockvols_path),
+                                lambda names: load_dir(dockvols_path, names))
+    return volumes
+
+
+def scan_dir(dockvols_path):
+    """ Return {vmdk file name: side car signature} for volumes in dockvols_path """
+    # side car writes of crashed processes leave temp files behind
+    kvESX.remove_stale_tmp_files(dockvols_path)
+    signatures = {}
+    for f in vmdk_utils.list_vmdks(dockvols_path):
+        meta_file = backend.get_meta_file(os.path.join(dockvols_path, f))
+        signatures[f] = file_signature(meta_file)
+    return signatures
+
+
+def load_dir(dockvols_path, names=None):
+    """
+    Return {vmdk file name: meta-data} read from side cars in dockvols_path,
+    for the given vmdk file names or else all volumes
+    """
+    if names is None:
+        names = vmdk_utils.list_vmdks(dockvols_path)
+    paths = [os.path.join(dockvols_path, f) for f in names]
+    return dict((os.path.basename(path), vol_meta)
+                for path, vol_meta in get_many(paths))
+
+
+def get_many(vol_paths, max_workers=BULK_LOAD_WORKERS):
+    """
+    Generator reading meta-data of vol_paths in up to max_workers threads.
+    Yields (vol_path, meta-data or None on failure) in completion order.
+    """
+    vol_paths = list(vol_paths)
+    workers = min(max_workers, len(vol_paths))
+    if workers <= 1:
+        for vol_path in vol_paths:
+            yield vol_path, getAll(vol_path)
+        return
+
+    results = queue.Queue()
+    stopped = threading.Event()
+
+    def load_one(vol_path):
+        if stopped.is_set():
+            return
+        try:
+            vol_meta = getAll(vol_path)
+        except:
+            logging.exception("Failed to read meta-data for %s", vol_path)
+            vol_meta = None
+        results.put((vol_path, vol_meta))
+
+    # all jobs fit in the queue, so submit() does not block
+    pool = threadutils.WorkerPool("kv-load", workers,
+                                  max_pending=len(vol_paths) + workers)
+    try:
+        for vol_path in vol_paths:
+            pool.submit(load_one, vol_path)
+        for _ in vol_paths:
+            yield results.get()
+    finally:
+        # the caller may stop early; skip the jobs not started yet
+        stopped.set()
+        pool.shutdown(wait=False)
+
+
+def cache_stats():
+    """ Return meta-data cache counters """
+    return meta_cache.stats()
+
+
+def size_cache_stats():
+    """ Return size info cache counters """
+    return size_cache.stats()
 
 
 # Set a string value for a given key(index)
 def set_kv(vol_path, key, val):
-    vol_meta = kvESX.load(vol_path)
-
-    if not vol_meta:
+    if not getAll(vol_path):
         return False
 
-    vol_meta[key] = val
-
-    return kvESX.save(vol_path, vol_meta)
+    return update(vol_path, {key: val}) is not None
 
 
 def get_kv(vol_path, key):
     """
     Return a string value for the given key, or None if the key is not present.
     """
-    vol_meta = kvESX.load(vol_path)
+    vol_meta = getAll(vol_path)
 
     if not vol_meta:
         return None
@@ -156,15 +633,26 @@ def remove(vol_path, key):
     Remove a key/value pair from the store. Return true on success, false on
     error.
     """
-    vol_meta = kvESX.load(vol_path)
-
-    if not vol_meta:
+    if not getAll(vol_path):
         return False
 
-    if key in vol_meta:
-        del vol_meta[key]
-
-    return kvESX.save(vol_path, vol_meta)
+    return update(vol_path, {key: DELETE}) is not None
 
 def get_vol_info(vol_path):
-   return kvESX.get_info(vol_path)
+    """
+    Return {VOL_SIZE: bytes, VOL_ALLOC: bytes} for the given vol_path,
+    or None on failure. Results are cached while the disk files are unchanged.
+    Disks without a flat extent next to the descriptor (e.g. VSAN, sesparse
+    or delta disks) are not cached, as their data changes would go unnoticed.
+    """
+    signature = disk_signature(vol_path)
+    cacheable = signature[0] and signature[1]
+    if cacheable:
+        size_info = size_cache.get(vol_path, signature)
+        if size_info:
+            return size_info
+
+    size_info = backend.get_info(vol_path)
+    if size_info and cacheable:
+        size_cache.put(vol_path, signature, size_info)
+    return size_info
@@ -0,0 +1,185 @@
+# Copyright 2016 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for volume_kv.py with the local directory backend (kvLocal).
+# These do not need ESX and run anywhere, e.g.
+#   PYTHONPATH=utils python volume_kv_test.py
+# VOLUME_KV_TEST_COUNT sets the number of volumes in the throughput test.
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import volume_kv as kv
+
+# Number of volumes in TestThroughput
+VOLUME_COUNT = int(os.environ.get('VOLUME_KV_TEST_COUNT', 1000))
+
+
+def make_volume(path, vol_meta):
+    """ Create an empty volume file and its meta-data """
+    open(path, 'w').close()
+    return kv.create(path, vol_meta)
+
+
+class TestVolumeKv(unittest.TestCase):
+    """ Test meta-data operations on the local backend """
+
+    def setUp(self):
+        kv.init(kv.LOCAL_BACKEND)
+        self.dir = tempfile.mkdtemp()
+        self.vol_path = os.path.join(self.dir, 'vol1.vmdk')
+        self.vol_meta = {kv.STATUS: kv.DETACHED,
+                         kv.VOL_OPTS: {kv.SIZE: '10gb'}}
+        self.assertTrue(make_volume(self.vol_path, self.vol_meta))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_create_load(self):
+        self.assertEqual(kv.load(self.vol_path), (self.vol_meta, 1))
+        self.assertEqual(kv.getAll(self.vol_path), self.vol_meta)
+
+    def test_update(self):
+        version = kv.update(self.vol_path, {kv.STATUS: kv.ATTACHED}, 1)
+        self.assertEqual(version, 2)
+        # stale version is refused
+        self.assertEqual(kv.update(self.vol_path, {kv.STATUS: kv.DETACHED}, 1), None)
+        self.assertEqual(kv.get_kv(self.vol_path, kv.STATUS), kv.ATTACHED)
+        self.assertTrue(kv.remove(self.vol_path, kv.STATUS))
+        self.assertEqual(kv.get_kv(self.vol_path, kv.STATUS), None)
+
+    def test_set_kv_after_external_change(self):
+        kv.getAll(self.vol_path)
+        kv.backend.save(self.vol_path, self.vol_meta, 5)
+        # last writer wins, as set_kv() does not expect a version
+        self.assertTrue(kv.set_kv(self.vol_path, kv.STATUS, kv.ATTACHED))
+        self.assertEqual(kv.load(self.vol_path), (
+            dict(self.vol_meta, status=kv.ATTACHED), 6))
+
+    def test_update_other_process(self):
+        count = 20
+        pid = os.fork()
+        key = 'child' if pid == 0 else 'parent'
+        for i in range(count):
+            kv.update(self.vol_path, {'{0}{1}'.format(key, i): i})
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        # no update lost
+        vol_meta, version = kv.load(self.vol_path)
+        self.assertEqual(version, 1 + 2 * count)
+        self.assertEqual(len(vol_meta), len(self.vol_meta) + 2 * count)
+
+    def test_external_change(self):
+        kv.getAll(self.vol_path)
+        # e.g. vmdkops_admin writing the side car
+        meta = dict(self.vol_meta)
+        meta[kv.STATUS] = kv.ATTACHED
+        kv.backend.save(self.vol_path, meta, 5)
+        self.assertEqual(kv.load(self.vol_path), (meta, 5))
+
+    def test_list_delete(self):
+        self.assertEqual(kv.list_volumes(self.dir), {'vol1.vmdk': self.vol_meta})
+        self.assertTrue(kv.delete(self.vol_path))
+        self.assertEqual(kv.getAll(self.vol_path), None)
+
+    def test_list_external_change(self):
+        kv.list_volumes(self.dir)
+        meta = dict(self.vol_meta)
+        meta[kv.STATUS] = kv.ATTACHED
+        # written without updating the index, in the same mtime tick
+        kv.backend.save(self.vol_path, meta, 5)
+        self.assertEqual(kv.list_volumes(self.dir), {'vol1.vmdk': meta})
+
+    def test_vol_info(self):
+        hits = kv.size_cache_stats()['hits']
+        self.assertEqual(kv.get_vol_info(self.vol_path)[kv.VOL_SIZE], 0)
+        kv.get_vol_info(self.vol_path)
+        # no flat extent, not cached
+        self.assertEqual(kv.size_cache_stats()['hits'], hits)
+        open(os.path.join(self.dir, 'vol1-flat.vmdk'), 'w').close()
+        kv.get_vol_info(self.vol_path)
+        kv.get_vol_info(self.vol_path)
+        self.assertEqual(kv.size_cache_stats()['hits'], hits + 1)
+        with open(self.vol_path, 'w') as fh:
+            fh.write('x' * 100)
+        self.assertEqual(kv.get_vol_info(self.vol_path)[kv.VOL_SIZE], 100)
+
+    def test_get_many(self):
+        vol_paths = [self.vol_path]
+        for i in range(2, 20):
+            vol_paths.append(os.path.join(self.dir, 'vol{0}.vmdk'.format(i)))
+            make_volume(vol_paths[-1], {kv.STATUS: kv.ATTACHED})
+        missing = os.path.join(self.dir, 'missing.vmdk')
+        results = dict(kv.get_many(vol_paths + [missing], max_workers=4))
+        self.assertEqual(sorted(results.keys()), sorted(vol_paths + [missing]))
+        self.assertEqual(results[self.vol_path], self.vol_meta)
+        self.assertEqual(results[missing], None)
+
+    def test_create_not_indexed(self):
+        # e.g. a pooled volume
+        pool_dir = os.path.join(self.dir, '.pool')
+        vol_path = os.path.join(pool_dir, 'vol2.vmdk')
+        os.mkdir(pool_dir)
+        open(vol_path, 'w').close()
+        self.assertTrue(kv.create(vol_path, {}, indexed=False))
+        self.assertEqual(kv.getAll(vol_path), {})
+        self.assertFalse(os.path.exists(os.path.join(pool_dir, '.vol_index')))
+
+    def test_create_missing_volume(self):
+        self.assertFalse(kv.create(os.path.join(self.dir, 'vol2.vmdk'), {}))
+
+
+class TestThroughput(unittest.TestCase):
+    """ Measure meta-data operations on VOLUME_COUNT volumes """
+
+    def setUp(self):
+        kv.init(kv.LOCAL_BACKEND)
+        self.dir = tempfile.mkdtemp()
+        self.vol_paths = [os.path.join(self.dir, 'vol{0}.vmdk'.format(i))
+                          for i in range(VOLUME_COUNT)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def timed(self, name, func):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        logging.info("%s: %d volumes in %.3fs (%.0f/s)", name, VOLUME_COUNT,
+                     elapsed, VOLUME_COUNT / max(elapsed, 1e-6))
+
+    def test_throughput(self):
+        vol_meta = {kv.STATUS: kv.DETACHED, kv.VOL_OPTS: {kv.SIZE: '1gb'}}
+        self.timed("create", lambda: [make_volume(p, vol_meta)
+                                      for p in self.vol_paths])
+        self.timed("update", lambda: [kv.update(p, {kv.STATUS: kv.ATTACHED})
+                                      for p in self.vol_paths])
+        kv.meta_cache.clear()
+        self.timed("load (cold)", lambda: [kv.load(p) for p in self.vol_paths])
+        self.timed("load (cached)", lambda: [kv.load(p) for p in self.vol_paths])
+        self.timed("list", lambda: kv.list_volumes(self.dir))
+
+        volumes = kv.list_volumes(self.dir)
+        self.assertEqual(len(volumes), VOLUME_COUNT)
+        self.assertTrue(all(meta[kv.STATUS] == kv.ATTACHED
+                            for meta in volumes.values()))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
@@ -236,8 +236,8 @@ def list_volumes_and_policies():
     if not path:
         return []
 
-    for vmdk in vmdk_utils.list_vmdks(path):
-        policy = kv_get_vsan_policy_name(os.path.join(path, vmdk))
+    for vmdk, vol_meta in sorted(kv.list_volumes(path).items()):
+        policy = vsan_policy_name(vol_meta)
         vmdks_and_policies.append({'volume': vmdk, 'policy': policy})
     return vmdks_and_policies
 
@@ -264,8 +264,13 @@ def kv_get_vsan_policy_name(path):
     Take a path for a vmdk and return a policy name if it exists or None if it
     doesn't
     """
+    return vsan_policy_name(kv.getAll(path))
+
+
+def vsan_policy_name(vol_meta):
+    """ Return policy name from volume meta-data, or None if there is none """
     try:
-        return kv.getAll(path)[kv.VOL_OPTS][kv.VSAN_POLICY_NAME]
+        return vol_meta[kv.VOL_OPTS][kv.VSAN_POLICY_NAME]
     except:
         return None
 
@@ -275,9 +280,8 @@ def policy_in_use(path, name):
     Check if a policy is in use by a VMDK and return the name of the first VMDK
     using it if it is, None otherwise
     """
-    for vmdk in vmdk_utils.list_vmdks(path):
-        policy = kv_get_vsan_policy_name(os.path.join(path, vmdk))
-        if policy == name:
+    for vmdk, vol_meta in sorted(kv.list_volumes(path).items()):
+        if vsan_policy_name(vol_meta) == name:
             return vmdk
     return None
 